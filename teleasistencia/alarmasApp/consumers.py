@@ -1,12 +1,51 @@
 import json
 from channels.generic.websocket import WebsocketConsumer
 from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
 from channels.layers import get_channel_layer
 
-from utilidad.logging import magenta, cyan
+from utilidad.logging import magenta, cyan, debug
+from utilidad.metricas import gauge
+
+WEBSOCKETS_ABIERTOS = gauge('teleasistencia_websockets_abiertos', 'Conexiones websocket abiertas', ['consumer'])
+
+
+class TenantConsumerMixin:
+    """
+    Ejecuta cada evento del consumer con la BBDD (tenant) del usuario de la conexión como tenant en curso,
+    igual que TenantDatabaseMiddleware en las peticiones HTTP. El tenant se resuelve una vez por conexión.
+
+    `dispatch` de SyncConsumer devuelve una corrutina (database_sync_to_async) que ejecuta el handler en un hilo:
+    se espera dentro de use_tenant para que el handler vea el tenant (el hilo copia el contexto), y la consulta
+    del tenant también se hace en un hilo, fuera del bucle de eventos.
+    """
+    _tenant_database = None
+    _tenant_resolved = False
+
+    async def dispatch(self, message):
+        from teleasistenciaApp.routers import use_tenant
+        if not self._tenant_resolved:
+            self._tenant_database = await database_sync_to_async(self._get_tenant_database)()
+            self._tenant_resolved = True
+        with use_tenant(self._tenant_database):
+            return await super().dispatch(message)
+
+    def _get_tenant_database(self):
+        user = self.scope.get('user')
+        if user is not None and user.is_authenticated:
+            from teleasistenciaApp.models import Database_User
+            from teleasistenciaApp.rest_django.utils import getTenantByUser
+            try:
+                return getTenantByUser(user).alias
+            except Database_User.DoesNotExist:
+                pass
+        return None
+
 
 # URL Protocolo://dominioOIP:Puerto/ws/webRTC/socket-server/
-class Consumer(WebsocketConsumer):
+class Consumer(TenantConsumerMixin, WebsocketConsumer):
+    # Si la conexión ya se ha sumado a WEBSOCKETS_ABIERTOS
+    _websocket_counted = False
 
     # Función que se ejecutará cuando un WebSocket cliente trate de conectarse al servidor
     def __init__(self, *args, **kwargs):
@@ -20,11 +59,17 @@ class Consumer(WebsocketConsumer):
             self.room_group_name,
             self.channel_name
         )
+        WEBSOCKETS_ABIERTOS.labels('Consumer').inc()
+        self._websocket_counted = True
         self.accept()
 
     # Función que se ejecutará cuando un WebSocket cliente se desconecte del servidor
     def disconnect(self, code):
-        magenta("Consumer", f"Closed websocket with code {code}")
+        magenta("Consumer", "Closed websocket with code %s", code)
+        # Sólo si connect llegó a contarla (puede fallar antes, en group_add o al rechazar la conexión)
+        if self._websocket_counted:
+            self._websocket_counted = False
+            WEBSOCKETS_ABIERTOS.labels('Consumer').dec()
         async_to_sync(self.channel_layer.group_discard)(
             'teleoperadores',
             self.channel_name
@@ -42,12 +87,14 @@ class Consumer(WebsocketConsumer):
             'alarma': alarma
         })
 
-        magenta("Consumer", f"Notificando clientes: {body}")
+        # El cuerpo completo de la alarma sólo se escribe con la etiqueta Consumer en DEBUG
+        debug("Consumer", "Notificando clientes: %s", body)
         self.send(text_data=body)
 
 
 # URL Protocolo://dominioOIP:Puerto/ws/webRTC/NombreDeLaSala/
-class ConsumerWebRTC(WebsocketConsumer):
+class ConsumerWebRTC(TenantConsumerMixin, WebsocketConsumer):
+    _websocket_counted = False
 
     def __init__(self, *args, **kwargs):
         super().__init__(args, kwargs)
@@ -63,11 +110,17 @@ class ConsumerWebRTC(WebsocketConsumer):
             self.room_group_name,
             self.channel_name
         )
+        WEBSOCKETS_ABIERTOS.labels('ConsumerWebRTC').inc()
+        self._websocket_counted = True
         self.accept()
 
     # Función que se ejecutará cuando un WebSocket cliente se desconecte del servidor
     def disconnect(self, code):
-        magenta("Consumer", f"Closed websocket with code {code}")
+        magenta("ConsumerWebRTC", "Closed websocket with code %s", code)
+        # Sólo si connect llegó a contarla (puede fallar antes, en group_add o al rechazar la conexión)
+        if self._websocket_counted:
+            self._websocket_counted = False
+            WEBSOCKETS_ABIERTOS.labels('ConsumerWebRTC').dec()
         async_to_sync(self.channel_layer.group_discard)(
             self.room_group_name,
             self.channel_name
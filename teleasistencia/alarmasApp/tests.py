@@ -1,3 +1,69 @@
-from django.test import TestCase
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.exceptions import DenyConnection
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.test import TestCase, TransactionTestCase
+
+from teleasistenciaApp.models import Database, Database_User
+from teleasistenciaApp.rest_django.utils import tenant_cache
+from teleasistenciaApp.routers import current_tenant
+
+from .consumers import WEBSOCKETS_ABIERTOS, Consumer
+
+
+def abiertos():
+    return WEBSOCKETS_ABIERTOS.samples().get(('Consumer',), 0)
+
+
+class WebsocketsAbiertosTests(TestCase):
+
+    def conectar_y_cerrar(self):
+        # (conexión aceptada, conexiones contadas mientras estaba abierta)
+        async def conectar():
+            communicator = WebsocketCommunicator(Consumer.as_asgi(), '/ws/socket-server/')
+            connected, _ = await communicator.connect()
+            durante = abiertos()
+            await communicator.disconnect()
+            return connected, durante
+
+        return async_to_sync(conectar)()
+
+    def test_cuenta_las_conexiones_aceptadas(self):
+        antes = abiertos()
+        self.assertEqual(self.conectar_y_cerrar(), (True, antes + 1))
+        self.assertEqual(abiertos(), antes)
+
+    def test_conexion_rechazada_antes_de_contarla_no_descuenta(self):
+        antes = abiertos()
+        with mock.patch('channels.layers.InMemoryChannelLayer.group_add', side_effect=DenyConnection):
+            self.assertEqual(self.conectar_y_cerrar(), (False, antes))
+        self.assertEqual(abiertos(), antes)
+
+
+class ConsumerTenantTests(TransactionTestCase):
+    databases = '__all__'
+
+    def test_el_handler_ve_el_tenant_del_usuario(self):
+        user = User.objects.create_user('usuario_ws')
+        database = Database.objects.create(nameDescritive='db2', engine='django.db.backends.sqlite3', name='db2')
+        Database_User.objects.create(user=user, database=database)
+        tenant_cache.invalidate()
+        tenants = []
+
+        def connect(consumer):
+            tenants.append(current_tenant())
+            consumer.accept()
+
+        async def conectar():
+            communicator = WebsocketCommunicator(Consumer.as_asgi(), '/ws/socket-server/')
+            communicator.scope['user'] = user
+            connected, _ = await communicator.connect()
+            await communicator.disconnect()
+            return connected
+
+        # El tenant se consulta en la BBDD (no está en tenant_cache) sin SynchronousOnlyOperation
+        with mock.patch.object(Consumer, 'connect', connect):
+            self.assertTrue(async_to_sync(conectar)())
+        self.assertEqual(tenants, ['db2'])
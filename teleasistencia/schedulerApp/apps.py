@@ -8,7 +8,14 @@ import schedule
 from schedule import repeat, every
 import threading
 
-from utilidad.logging import info, red, green
+from utilidad.logging import info, red, green, error
+from utilidad.metricas import gauge, histogram
+
+SCHEDULER_RETRASO = gauge('teleasistencia_scheduler_retraso_segundos',
+                          'Retraso de la alarma programada pendiente más antigua al ejecutar la tarea',
+                          ['tarea'], multiprocess_mode='max')
+SCHEDULER_DURACION = histogram('teleasistencia_scheduler_duracion_segundos', 'Duración de las tareas del scheduler',
+                               ['tarea'])
 
 
 class SchedulerAppConfig(AppConfig):
@@ -91,13 +98,46 @@ class SchedulerAppConfig(AppConfig):
 @repeat(every(1).minute)
 def procesar_alarmas_programadas():
     """
-        Procesa todas las Alarma_Programadas culla fecha de registro sea <= now()
+        Procesa todas las Alarma_Programadas culla fecha de registro sea <= now(), en la BBDD de cada tenant
     """
     # Hacemos esto porque no podemos importarlos antes de que django cargue y ejecute las apps
+    from teleasistenciaApp.databases import refresh_connections
+    from teleasistenciaApp.routers import tenant_aliases, use_tenant
     modelo_alarmas = apps.get_model('teleasistenciaApp', 'Alarma_Programada')
 
     # Query para identificar si una alarma está pendiente o todavía no se tiene que lanzar
-    query_pendientes = Q(fecha_registro__lte=now())
-    pendientes = modelo_alarmas.objects.filter(query_pendientes)
-    for alarma in pendientes:
-        alarma.disparar()
+    inicio = time.perf_counter()
+    ahora = now()
+    query_pendientes = Q(fecha_registro__lte=ahora)
+    retraso = 0
+    refresh_connections()
+    for alias in tenant_aliases():
+        # Una BBDD caída o corrupta no puede dejar sin sus alarmas al resto de tenants
+        try:
+            # Las alarmas que se disparan (y sus Alarma) se crean en la BBDD del tenant (routers.TenantRouter)
+            with use_tenant(alias):
+                pendientes = list(modelo_alarmas.objects.filter(query_pendientes).order_by('fecha_registro'))
+                for alarma in pendientes:
+                    alarma.disparar()
+        except Exception as e:
+            error("[SchedulerApp] No se han podido procesar las alarmas programadas de %s: %s", alias, e)
+            continue
+
+        # Cuánto tarde se dispara la alarma que más ha esperado (0 si no hay ninguna pendiente)
+        if pendientes:
+            retraso = max(retraso, (ahora - pendientes[0].fecha_registro).total_seconds())
+    SCHEDULER_RETRASO.labels('procesar_alarmas_programadas').set(retraso)
+    SCHEDULER_DURACION.labels('procesar_alarmas_programadas').observe(time.perf_counter() - inicio)
+
+
+@repeat(every().day.at("03:00"))
+def archivar_logs():
+    """
+        Resume los logs del día anterior y archiva los que superan el periodo de retención
+    """
+    # Se importa aquí porque el módulo usa los modelos de teleasistenciaApp
+    from teleasistenciaApp.logs_archive import run_retention
+    try:
+        run_retention()
+    except Exception as e:
+        red("SchedulerApp", f"Fallo al archivar los logs: {e}")
@@ -8,13 +8,18 @@ https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
 """
 
 import os
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'teleasistencia.settings')
+# Inicializar Django antes de importar los consumers, la cadena de middlewares HTTP se ejecuta en modo asíncrono
+django_asgi_app = get_asgi_application()
+
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
 from alarmasApp import routing
 
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'teleasistencia.settings')
-
 application = ProtocolTypeRouter({
+    'http': django_asgi_app,
     'websocket':AuthMiddlewareStack(
         URLRouter(
             routing.websocket_urlpatterns
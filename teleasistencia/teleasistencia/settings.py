@@ -108,8 +108,120 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'teleasistenciaApp.middleware.LoggingMiddleware',
+    'teleasistenciaApp.middleware.TenantDatabaseMiddleware',
 ]
 
+# Segundos que se guarda en memoria la base de datos asignada a cada usuario (rest_django/utils.py)
+TENANT_CACHE_TTL = 300
+
+# Escritor en segundo plano de los logs de acciones (teleasistenciaApp/log_writer.py)
+#	LOGS_WRITER_BATCH_SIZE: número de registros que se guardan en cada bulk_create
+#	LOGS_WRITER_FLUSH_INTERVAL_MS: tiempo máximo que un registro espera en la cola antes de guardarse
+#	LOGS_WRITER_QUEUE_SIZE: tamaño máximo de la cola, a partir del cual los logs se descartan
+LOGS_WRITER_BATCH_SIZE = 100
+LOGS_WRITER_FLUSH_INTERVAL_MS = 500
+LOGS_WRITER_QUEUE_SIZE = 10000
+# Tamaño máximo (bytes) del body de login que guarda el LoggingMiddleware para sacar el username
+LOGS_LOGIN_BODY_MAX_SIZE = 4096
+
+# Qué peticiones de la API REST se guardan en Logs_AccionesUsuarios (teleasistenciaApp/log_policy.py)
+#	Las que modifican datos (POST, PUT, PATCH, DELETE) se guardan siempre, salvo las rutas de IGNORAR
+#	LECTURA_POR_DEFECTO: fracción (0-1) de las lecturas (GET, HEAD, OPTIONS) que se guardan
+#	MUESTREO: fracción de lecturas que se guardan por prefijo de ruta (gana el prefijo más largo). Con '$' al final
+#	sólo la ruta exacta: p.ej. '/api-rest/alarma$': 0.2 muestrea el listado que consultan periódicamente los
+#	clientes pero sigue guardando todas las lecturas de una alarma (/api-rest/alarma/<id>). Las rutas con datos de
+#	pacientes se guardan todas salvo que se configure aquí expresamente
+#	IGNORAR: prefijos de ruta que no se guardan nunca
+LOGS_ACCIONES_POLITICA = {
+    'LECTURA_POR_DEFECTO': 1.0,
+    'MUESTREO': {
+        # Catálogos que los clientes consultan periódicamente (sin datos de pacientes)
+        '/api-rest/tipo_alarma': 0.1,
+        '/api-rest/clasificacion_alarma': 0.1,
+    },
+    'IGNORAR': [
+        '/api-rest/metricas_rutas',
+        '/api-rest/metricas_conexiones',
+    ],
+}
+
+# Estadísticas por ruta en memoria (/api-rest/metricas_rutas)
+#	REQUEST_METRICS_RESERVOIR_SIZE: número de duraciones que se guardan por ruta para calcular los percentiles
+#	REQUEST_METRICS_MAX_ROUTES: número máximo de rutas, las siguientes se acumulan en la ruta "otros"
+REQUEST_METRICS_RESERVOIR_SIZE = 1024
+REQUEST_METRICS_MAX_ROUTES = 500
+
+# Mensajes por terminal de utilidad/logging.py (red, green, yellow...)
+#	LEVEL: nivel por defecto (DEBUG, INFO, WARNING, ERROR)
+#	TAGS: nivel por etiqueta, p.ej. {'LoggingMiddleware': 'WARNING'} para no mostrar cada petición
+#	JSON: escribir cada mensaje como una línea JSON (para recogerlos con otras herramientas)
+UTILIDAD_LOGGING = {
+    'LEVEL': os.getenv('UTILIDAD_LOGGING_LEVEL', 'INFO'),
+    'TAGS': {},
+    'JSON': os.getenv('UTILIDAD_LOGGING_JSON', 'False') == 'True',
+    'QUEUE_SIZE': 10000,
+}
+
+# Métricas en formato Prometheus (/metrics, utilidad/metricas.py)
+#	METRICS_TOKEN: token que Prometheus envía en la cabecera "Authorization: Bearer <token>". Sin él /metrics
+#		sólo responde al personal (is_staff) con sesión iniciada
+#	METRICS_MULTIPROCESS_DIR: directorio compartido para sumar las métricas de varios procesos (None = un proceso)
+#	METRICS_FLUSH_INTERVAL: cada cuántos segundos vuelca cada proceso sus métricas al directorio compartido
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+METRICS_MULTIPROCESS_DIR = os.getenv('METRICS_MULTIPROCESS_DIR')
+METRICS_FLUSH_INTERVAL = 5
+
+# Caché de la autenticación JWT (teleasistenciaApp/authentication.py)
+#	TTL: segundos que se reutiliza el usuario resuelto de un token
+#	MAX_SIZE: número máximo de tokens en caché
+JWT_USER_CACHE = {
+    'TTL': 60,
+    'MAX_SIZE': 1024,
+}
+
+# Cifrado de contraseñas en paralelo (teleasistenciaApp/hashing.py)
+#	PROCESOS: procesos del pool (None: uno por CPU)
+#	MINIMO_PARALELO: por debajo de este número de contraseñas se cifran en el propio hilo
+#	VERIFICAR_EN_POOL: comprobar también en el pool las contraseñas del login
+PASSWORD_HASHING = {
+    'PROCESOS': int(os.getenv('PASSWORD_HASHING_PROCESOS', 0)) or None,
+    'MINIMO_PARALELO': 8,
+    'VERIFICAR_EN_POOL': True,
+}
+
+# Guardar User.last_login del login en segundo plano y por lotes (teleasistenciaApp/log_writer.py)
+LAST_LOGIN_WRITE_BEHIND = True
+
+# Grupos de los usuarios para los permisos (teleasistenciaApp/roles.py)
+#	CACHE: alias de CACHES donde se guarda la versión de los grupos de cada usuario. Tiene que ser una caché
+#	compartida entre procesos (memcached, redis, BBDD...) para usar los grupos del token: los cambios de grupos se
+#	aplican al momento en todos los procesos. Con la caché local por defecto (LocMemCache) los grupos se leen de la
+#	BBDD en cada petición
+#	TTL: segundos que se guarda la versión; al caducar se comprueban una vez los grupos en la BBDD
+USER_GROUPS_CACHE = {
+    'CACHE': 'default',
+    'TTL': 300,
+}
+
+# Límite de intentos de login en /api/token (teleasistenciaApp/login_throttle.py): (intentos, segundos)
+#	IP: intentos fallidos por IP. Los logins correctos no cuentan, así no se bloquea a los teleoperadores de un
+#	centro que salen por la misma IP y entran a la vez en el cambio de turno
+#	USERNAME: intentos por nombre de usuario, se olvidan tras un login correcto
+#	CACHE: alias de CACHES para compartir los contadores entre procesos, con None son de cada proceso
+LOGIN_THROTTLE = {
+    'IP': (30, 60),
+    'USERNAME': (5, 60),
+    'CACHE': None,
+}
+
+# Almacenamiento de los logs
+#	LOGS_DATABASE: alias de DATABASES donde se guardan los logs, permite separarlos de los datos clínicos
+#	LOGS_RETENCION_DIAS: días que se conservan los logs en la BBDD antes de archivarlos
+#	LOGS_ARCHIVO_DIR: carpeta donde se guardan los logs archivados (un fichero .jsonl.gz por tabla y mes)
+LOGS_DATABASE = os.getenv('LOGS_DATABASE', 'default')
+LOGS_RETENCION_DIAS = 90
+LOGS_ARCHIVO_DIR = os.path.join(BASE_DIR, 'backup', 'logs')
+
 #Definimos las  variables de configuración del CORS
 #	CORS_ALLOW_ALL_ORIGINS: En verdadero true permite que se hagan peticiones HTTP desde todos los orígenes
 #	CORS_ALLOW_CREDENTIALS: en verdadero permite incluir cookies en las peticiones HTTP
@@ -163,7 +275,8 @@ REST_FRAMEWORK = {
         # OAuth
         'oauth2_provider.contrib.rest_framework.OAuth2Authentication',  # django-oauth-toolkit >= 1.0.0
         #'rest_framework_social_oauth2.authentication.SocialAuthentication',
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        # JWTAuthentication con caché de usuarios (teleasistenciaApp/authentication.py)
+        'teleasistenciaApp.authentication.CachedJWTAuthentication',
     ),
 
     'DEFAULT_PERMISSION_CLASSES': [
@@ -192,7 +305,8 @@ AUTHENTICATION_BACKENDS = (
     # django-rest-framework-social-oauth2
         'rest_framework_social_oauth2.backends.DjangoOAuth2',
     # Django
-    'django.contrib.auth.backends.ModelBackend',
+    # ModelBackend con la contraseña comprobada en el pool de procesos (teleasistenciaApp/hashing.py)
+    'teleasistenciaApp.authentication.PooledModelBackend',
     'rest_framework_simplejwt.authentication.JWTAuthentication',
 )
 
@@ -218,6 +332,21 @@ WSGI_APPLICATION = 'teleasistencia.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/3.2/ref/settings/#databases
 
+# Conexiones a las BBDD (teleasistenciaApp/db_pool.py)
+#	MAX_AGE: segundos que se reutiliza una conexión entre peticiones. Se lee de la variable de entorno CONN_MAX_AGE
+#	(60 si no está definida): 0 cierra la conexión al terminar cada petición y 'None' la mantiene abierta sin límite
+#	HEALTH_CHECK_AFTER: una conexión que lleva más de estos segundos sin usarse se comprueba antes de reutilizarla
+#	(None para no comprobar)
+#	MAX_CONNECTIONS: peticiones simultáneas (conexiones en uso) como máximo con cada BBDD, por proceso
+#	WAIT_TIMEOUT: segundos que espera una petición por un hueco antes de responder 503
+conn_max_age = os.getenv('CONN_MAX_AGE', '60').strip()
+TENANT_CONNECTIONS = {
+    'MAX_AGE': None if conn_max_age.lower() == 'none' else int(conn_max_age),
+    'HEALTH_CHECK_AFTER': 30,
+    'MAX_CONNECTIONS': 20,
+    'WAIT_TIMEOUT': 10,
+}
+
 # Obtenemos los datos de conexión de la base de datos de la variable .env
 #En el caso de encontrar algún archvio sqlite3 actualizamos la ruta
 database =""
@@ -227,6 +356,8 @@ if (os.getenv('DATABASES')):
         if "sqlite" in database[data]["ENGINE"]:
             # Añadirmos la ruta absoluta en la que se encuentra la base de datos
             database[data]["NAME"] = str(BASE_DIR / database[data]["NAME"])
+        # Conexiones persistentes salvo que el .env indique otra cosa
+        database[data].setdefault("CONN_MAX_AGE", TENANT_CONNECTIONS['MAX_AGE'])
 
 # Comprobamos si se ha cargado bien la base de datos sino cargamos la de por defecto
 if database:
@@ -236,8 +367,40 @@ else:
         'default': {
             'ENGINE': 'django.db.backends.sqlite3',
             'NAME': str(BASE_DIR / 'db.sqlite3'),
+            'CONN_MAX_AGE': TENANT_CONNECTIONS['MAX_AGE'],
         }
     }
+
+# Agregados de todas las BBDD de los tenants (teleasistenciaApp/cross_tenant.py)
+#	MAX_WORKERS: BBDD que se consultan a la vez
+#	TIMEOUT: segundos que se espera a cada BBDD, desde que empieza su consulta, antes de dar su resultado por fallido
+CROSS_TENANT = {
+    'MAX_WORKERS': 8,
+    'TIMEOUT': 10,
+}
+
+# Alta de BBDD de centros en segundo plano (teleasistenciaApp/provisioning.py)
+#	APROVISIONAMIENTO_TIMEOUT: segundos tras los que un alta sin terminar de otro proceso se da por perdida (el
+#	proceso se reinició) y se puede volver a lanzar
+APROVISIONAMIENTO_TIMEOUT = 3600
+
+# Registro en caliente de las BBDD de los tenants (teleasistenciaApp/databases.py)
+#	TENANT_DATABASES_VERSION_FILE: fichero que cambia cada vez que se modifica la tabla Database, con él se avisa
+#	al resto de procesos del servidor. Con None sólo se actualiza el proceso que hace el cambio
+#	TENANT_DATABASES_SYNC_INTERVAL: cada cuántos segundos, como mucho, comprueba cada proceso el fichero
+#	TENANT_DATABASES_HEALTH_CHECK_TIMEOUT: segundos que espera la conexión de prueba antes de activar una BBDD
+#	(PostgreSQL y MySQL)
+TENANT_DATABASES_VERSION_FILE = os.getenv('TENANT_DATABASES_VERSION_FILE', str(BASE_DIR / '.tenant_databases'))
+TENANT_DATABASES_SYNC_INTERVAL = 2
+TENANT_DATABASES_HEALTH_CHECK_TIMEOUT = 5
+
+# Routers que deciden en qué BBDD se lee/escribe cada modelo (teleasistenciaApp/routers.py)
+DATABASE_ROUTERS = [
+    'teleasistenciaApp.routers.LogsRouter',
+    # Modelos de datos a la BBDD del tenant de la petición (ver TenantDatabaseMiddleware)
+    'teleasistenciaApp.routers.TenantRouter',
+]
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
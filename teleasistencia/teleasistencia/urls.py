@@ -26,11 +26,10 @@ from rest_framework import routers
 from teleasistenciaApp.rest_django import views_rest
 
 # Para recuperación de contraseñas
-from .views import get_csrf_token, TokenObtainPairSerializerWithLastLogin
+from .views import get_csrf_token, metrics, token_obtain_pair
 
 #Autenticación rest con JWT:
 from rest_framework_simplejwt.views import (
-    TokenObtainPairView,
     TokenRefreshView,
 )
 
@@ -46,6 +45,7 @@ from teleasistenciaApp.rest_django.api_v2.const import API_V2_BASE_PATH
 # Con trailing_slash=False hacemos que no intermprete la / final de la url, con esto podemos hacer GET, POST y DELETE
 router = routers.DefaultRouter(trailing_slash=False)
 router.register(r'users', views_rest.UserViewSet)
+router.register(r'directorio_usuarios', views_rest.Directorio_Usuarios_ViewSet, basename='directorio_usuarios')
 router.register(r'groups', views_rest.GroupViewSet)
 router.register(r'permission', views_rest.PermissionViewSet)
 router.register(r'databases', views_rest.DatabaseViewSet)
@@ -76,6 +76,12 @@ router.register(r'gestion_base_datos', views_rest.Gestion_Base_Datos_ViewSet)
 router.register(r'profile', views_rest.ProfileViewSet)
 router.register(r'desarrollador_tecnologia', views_rest.DesarrolladorTecnologiaViewSet)
 router.register(r'seguimiento_teleoperador', views_rest.SeguimientoTeleoperador)
+router.register(r'logs_acciones_usuarios', views_rest.Logs_Acciones_Usuarios_ViewSet)
+router.register(r'logs_conexiones_usuarios', views_rest.Logs_Conexiones_Usuarios_ViewSet)
+router.register(r'metricas_rutas', views_rest.Metricas_Rutas_ViewSet, basename='metricas_rutas')
+router.register(r'metricas_conexiones', views_rest.Metricas_Conexiones_ViewSet, basename='metricas_conexiones')
+router.register(r'agregados_tenants', views_rest.Agregados_Tenants_ViewSet, basename='agregados_tenants')
+router.register(r'aprovisionamiento_base_datos', views_rest.Aprovisionamiento_Base_Datos_ViewSet)
 
 # API v2
 router.register(rf"{API_V2_BASE_PATH}/groups", views_rest_v2.GroupViewSet)
@@ -110,9 +116,13 @@ urlpatterns = [
     #Django Rest social Auth:
     url(r'^auth/', include('rest_framework_social_oauth2.urls')),
     #Django Rest Simple JWT:
-    path('api/token/', TokenObtainPairView.as_view(serializer_class=TokenObtainPairSerializerWithLastLogin), name='token_obtain_pair'),
+    # Vista asíncrona: espera la comprobación de la contraseña (pool de hashing) sin ocupar un hilo
+    path('api/token/', token_obtain_pair, name='token_obtain_pair'),
     path('api/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
 
+    # Métricas del servidor en formato Prometheus
+    path('metrics', metrics, name='metrics'),
+
     # URLs de recuperación de contraseñas de usuarios de Django (desde navegador)
     path('api-rest/password_reset/csrf', get_csrf_token, name='password_reset_csrf'),
     # [password_reset_form.html] Aqui se hace la petición, enviando el correo que algún usuario (User) + token csrf)
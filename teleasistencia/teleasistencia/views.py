@@ -1,8 +1,22 @@
+import hmac
+import json
+
+from asgiref.sync import sync_to_async
 from django.middleware.csrf import get_token
-from django.http import JsonResponse
+from django.conf import settings
+from django.http import JsonResponse, HttpResponse, HttpResponseNotAllowed
 
 from django.utils.timezone import now
+from rest_framework.exceptions import AuthenticationFailed, ParseError, Throttled, ValidationError
+from rest_framework.fields import empty
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
+from rest_framework_simplejwt.settings import api_settings
+
+from teleasistenciaApp.authentication import aauthenticate
+from teleasistenciaApp.login_throttle import check_login, login_failed, login_succeeded
+from teleasistenciaApp.roles import token_claims
+from teleasistenciaApp.log_writer import last_login_writer
+from utilidad.metricas import registry, CONTENT_TYPE
 
 
 def get_csrf_token(request):
@@ -11,16 +25,121 @@ def get_csrf_token(request):
     return JsonResponse({'csrf_token': token})
 
 
+def metrics(request):
+    # Métricas en formato Prometheus: para Prometheus con "Authorization: Bearer <METRICS_TOKEN>" o para el personal
+    # (is_staff) con la sesión del panel de administración. Sin METRICS_TOKEN configurado sólo el personal
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    if settings.METRICS_TOKEN and hmac.compare_digest(authorization, 'Bearer %s' % settings.METRICS_TOKEN):
+        return HttpResponse(registry.exposition(), content_type=CONTENT_TYPE)
+    if request.user.is_authenticated and request.user.is_staff:
+        return HttpResponse(registry.exposition(), content_type=CONTENT_TYPE)
+    return HttpResponse(status=403 if request.user.is_authenticated else 401)
+
+
 class TokenObtainPairSerializerWithLastLogin(TokenObtainPairSerializer):
     """
     TokenObtainPairSerializar customizado para que se guarde la fecha de último login
+    y se añadan al token los grupos del usuario (teleasistenciaApp/roles.py)
     """
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        for claim, value in token_claims(user).items():
+            token[claim] = value
+        return token
+
     def validate(self, attrs):
-        data = super().validate(attrs)
+        # Rechazar los intentos por encima del límite antes de comprobar la contraseña (el hash es lo costoso).
+        # El LoggingMiddleware registra el intento rechazado (429) en Logs_ConexionesUsuarios
+        request = self.context.get('request')
+        ip = request.META.get('REMOTE_ADDR') if request is not None else None
+        wait = check_login(ip, attrs.get(self.username_field))
+        if wait:
+            raise Throttled(wait=wait, detail="Demasiados intentos de inicio de sesión.")
+
+        try:
+            data = super().validate(attrs)
+        except AuthenticationFailed:
+            login_failed(ip)
+            raise
         user = self.user
+        login_succeeded(attrs.get(self.username_field))
 
-        # Actualizar timestamp last login
+        # Actualizar timestamp last login: sólo ese campo y, con LAST_LOGIN_WRITE_BEHIND, fuera de la petición
         user.last_login = now()
-        user.save()
+        if settings.LAST_LOGIN_WRITE_BEHIND:
+            last_login_writer.enqueue(user.pk, user.last_login)
+        else:
+            user.save(update_fields=['last_login'])
 
         return data
+
+
+async def _throttle(function, *args):
+    # Con LOGIN_THROTTLE['CACHE'] los contadores están en una caché compartida (BBDD, redis, memcached...) cuyas
+    # llamadas bloquean (o no se permiten, la de BBDD) en el bucle de eventos: se hacen en un hilo
+    if settings.LOGIN_THROTTLE.get('CACHE'):
+        return await sync_to_async(function)(*args)
+    return function(*args)
+
+
+async def token_obtain_pair(request):
+    """
+    /api/token/ asíncrono, con las mismas respuestas que TokenObtainPairView con
+    TokenObtainPairSerializerWithLastLogin. La contraseña se comprueba en el pool de procesos de hashing.py esperándola con await, así un login no ocupa
+    un hilo mientras se calcula el hash. Sólo las consultas a la BBDD pasan a un hilo (sync_to_async).
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    if request.content_type == 'application/json':
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError:
+            return JsonResponse({'detail': ParseError.default_detail}, status=400)
+    else:
+        data = request.POST
+    if not hasattr(data, 'get'):
+        data = {}
+
+    # Los mismos campos y errores de validación que el serializer
+    serializer = TokenObtainPairSerializerWithLastLogin(context={'request': request})
+    attrs = {}
+    errors = {}
+    for name, field in serializer.fields.items():
+        try:
+            attrs[name] = field.run_validation(data.get(name, empty))
+        except ValidationError as e:
+            errors[name] = e.detail
+    if errors:
+        return JsonResponse(errors, status=400)
+
+    username = attrs[serializer.username_field]
+    ip = request.META.get('REMOTE_ADDR')
+    wait = await _throttle(check_login, ip, username)
+    if wait:
+        throttled = Throttled(wait=wait, detail="Demasiados intentos de inicio de sesión.")
+        response = JsonResponse({'detail': throttled.detail}, status=throttled.status_code)
+        response['Retry-After'] = '%d' % throttled.wait
+        return response
+
+    user = await aauthenticate(request, **{serializer.username_field: username, 'password': attrs['password']})
+    if not api_settings.USER_AUTHENTICATION_RULE(user):
+        await _throttle(login_failed, ip)
+        response = JsonResponse({'detail': serializer.error_messages['no_active_account']}, status=401)
+        response['WWW-Authenticate'] = '%s realm="api"' % api_settings.AUTH_HEADER_TYPES[0]
+        return response
+
+    refresh = await sync_to_async(serializer.get_token)(user)
+    await _throttle(login_succeeded, username)
+
+    user.last_login = now()
+    if settings.LAST_LOGIN_WRITE_BEHIND:
+        last_login_writer.enqueue(user.pk, user.last_login)
+    else:
+        await sync_to_async(user.save)(update_fields=['last_login'])
+
+    return JsonResponse({'refresh': str(refresh), 'access': str(refresh.access_token)})
+
+
+# Como TokenObtainPairView, sin CSRF (csrf_exempt de Django 3.2 no admite vistas asíncronas)
+token_obtain_pair.csrf_exempt = True
@@ -1,14 +1,14 @@
-import fileinput
+from django.contrib import admin, messages
+from django.db import transaction
 
-from django.contrib import admin
-
-from pathlib import Path
+from . import databases
 from .models import *
 
 # Register your models here.
 
 admin.site.register(Logs_AccionesUsuarios)
 admin.site.register(Logs_ConexionesUsuarios)
+admin.site.register(Logs_ResumenDiario)
 admin.site.register(Imagen_User)
 admin.site.register(Tipo_Agenda)
 admin.site.register(Direccion)
@@ -37,53 +37,22 @@ admin.site.register(Tecnologia)
 admin.site.register(Desarrollador_Tecnologia)
 admin.site.register(Convocatoria_Proyecto)
 admin.site.register(Database_User)
+admin.site.register(Aprovisionamiento_Base_Datos)
 
 
 class Database_form_admin(admin.ModelAdmin):
 
-    # Actualiza los datos de conexión de la base de datos
+    # Las conexiones se actualizan en todos los procesos al guardar o borrar (ver databases.py y signals.py).
+    # Aquí sólo se avisa si la base de datos no responde y por tanto no se ha activado. Se usa el resultado del
+    # health check de esa sincronización (la señal de guardado se registra antes, así que su on_commit va antes)
     def save_model(self, request, obj, form, change):
-
         super().save_model(request, obj, form, change)
-        self.updateEnvDatabase()
-
-    def delete_model(self, request, obj):
-        super().delete_model(request, obj)
-        self.updateEnvDatabase()
-    def delete_queryset(self, request, obj):
-        super().delete_queryset(request, obj)
-        self.updateEnvDatabase()
-
-    # Actualiza la constante DATABASES del archivo .env relativa a la base de datos
-    def updateEnvDatabase(self):
+        transaction.on_commit(lambda: self._check_database(request, obj))
 
-        databases = Database.objects.all()
-        jsonDatabase = {}
-        for database in databases:
-            if "sqlite" in database.engine:
-                jsonDatabase[database.nameDescritive] = {
-                    "ENGINE": database.engine,
-                    "NAME": database.name
-                }
-            else:
-                jsonDatabase[database.nameDescritive] = {
-                    "ENGINE": database.engine,
-                    "NAME": database.name,
-                    "USER": database.user,
-                    "PASSWORD": database.password,
-                    "HOST": database.host,
-                    "PORT": database.port
-                }
-
-            ## TODO Hay que añadir el caso de postgres
-
-        with fileinput.FileInput(str(Path(__file__).resolve().parent.parent)+"\.env", inplace=True) as f:
-            for line in f:
-                if "DATABASES" in line:
-                    print("DATABASES = '" + str(jsonDatabase).replace("'", '"') + "'", end='\n')
-                else:
-                    print(line, end='')
-        print (jsonDatabase)
+    def _check_database(self, request, obj):
+        problem = databases.activation_problem(obj.nameDescritive)
+        if problem:
+            self.message_user(request, "La base de datos %s no se ha activado: %s" % (obj.nameDescritive, problem),
+                              messages.WARNING)
 
 admin.site.register(Database, Database_form_admin)
-
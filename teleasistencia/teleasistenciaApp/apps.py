@@ -4,3 +4,29 @@ from django.apps import AppConfig
 class TeleasistenciaAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'teleasistenciaApp'
+
+    def ready(self):
+        # Aplicar settings.UTILIDAD_LOGGING (niveles por etiqueta, salida JSON)
+        from utilidad import logging
+        logging.configure()
+
+        from django.db.backends.signals import connection_created
+        from .request_metrics import install_query_counter
+        # Registra las señales que invalidan las cachés de usuarios (autenticación JWT), de sus grupos
+        # y de sus bases de datos
+        from . import authentication, roles, signals  # noqa: F401
+
+        # Contar las consultas de cada petición en todas las conexiones (LoggingMiddleware)
+        connection_created.connect(install_query_counter, dispatch_uid='request_metrics_query_counter')
+
+        # Bases de datos de los tenants registradas en caliente (tabla Database)
+        from django.core.signals import request_started, request_finished
+        from .databases import refresh_connections
+        request_started.connect(refresh_connections, dispatch_uid='tenant_databases_request_started')
+        request_finished.connect(refresh_connections, dispatch_uid='tenant_databases_request_finished')
+
+        # Comprobar las conexiones persistentes antes de reutilizarlas y llevar la cuenta de las abiertas
+        from .db_pool import track_connection, check_connections, connections_released
+        connection_created.connect(track_connection, dispatch_uid='db_pool_track_connection')
+        request_started.connect(check_connections, dispatch_uid='db_pool_check_connections')
+        request_finished.connect(connections_released, dispatch_uid='db_pool_connections_released')
@@ -0,0 +1,202 @@
+"""
+Autenticación JWT con caché de usuarios.
+
+JWTAuthentication hace un `User.objects.get` en cada petición. CachedJWTAuthentication guarda, por firma del token,
+el token validado y el usuario durante settings.JWT_USER_CACHE['TTL'] segundos (nunca más allá de la caducidad del
+token), con un máximo de settings.JWT_USER_CACHE['MAX_SIZE'] entradas (se descartan las menos usadas).
+
+La usan DRF (settings.REST_FRAMEWORK) y el LoggingMiddleware, así que ambos comparten el mismo usuario resuelto.
+Las entradas de un usuario se invalidan al guardarlo o borrarlo (p. ej. desactivarlo desde UserViewSet).
+
+PooledModelBackend (settings.AUTHENTICATION_BACKENDS) es el ModelBackend de Django con la comprobación de la
+contraseña hecha en el pool de procesos de hashing.py. `aauthenticate` es el authenticate de Django para la vista
+asíncrona de /api/token/: espera la contraseña con await y sólo pasa a un hilo las consultas a la BBDD.
+"""
+import copy
+import inspect
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import _clean_credentials, _get_backends
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.signals import user_login_failed
+from django.core.exceptions import PermissionDenied
+from django.contrib.auth.models import User
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+from .hashing import amake_password_in_pool, averify_password, make_password_in_pool, verify_password
+
+
+class UserCache:
+    """
+    Caché LRU con TTL: firma del token -> (token, token validado, usuario, caducidad).
+    """
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._by_user = {}  # id de usuario -> firmas de sus tokens en caché
+        self._lock = threading.Lock()
+
+    def get(self, raw_token):
+        signature = _signature(raw_token)
+        with self._lock:
+            entry = self._entries.get(signature)
+            if entry is None:
+                return None
+            token, validated_token, user, expires = entry
+            if token != raw_token or expires <= time.time():
+                self._remove(signature)
+                return None
+            self._entries.move_to_end(signature)
+        # Cada petición recibe su propia copia para no compartir estado (cachés de relaciones, etc.)
+        return copy.copy(user), validated_token
+
+    def set(self, raw_token, validated_token, user):
+        signature = _signature(raw_token)
+        expires = min(time.time() + self.ttl, validated_token.get('exp', float('inf')))
+        with self._lock:
+            self._remove(signature)
+            self._entries[signature] = (raw_token, validated_token, copy.copy(user), expires)
+            self._by_user.setdefault(user.pk, set()).add(signature)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            for signature in list(self._by_user.get(user_id, ())):
+                self._remove(signature)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_user.clear()
+
+    def _remove(self, signature):
+        entry = self._entries.pop(signature, None)
+        if entry is not None:
+            signatures = self._by_user.get(entry[2].pk)
+            if signatures is not None:
+                signatures.discard(signature)
+                if not signatures:
+                    del self._by_user[entry[2].pk]
+
+
+def _signature(raw_token):
+    return raw_token.rsplit(b'.', 1)[-1]
+
+
+user_cache = UserCache(settings.JWT_USER_CACHE['TTL'], settings.JWT_USER_CACHE['MAX_SIZE'])
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    JWTAuthentication que reutiliza el token validado y el usuario de `user_cache`.
+    """
+
+    def authenticate(self, request):
+        header = self.get_header(request)
+        if header is None:
+            return None
+
+        raw_token = self.get_raw_token(header)
+        if raw_token is None:
+            return None
+
+        cached = user_cache.get(raw_token)
+        if cached is not None:
+            return cached
+
+        validated_token = self.get_validated_token(raw_token)
+        user = self.get_user(validated_token)
+        user_cache.set(raw_token, validated_token, user)
+        return user, validated_token
+
+
+class PooledModelBackend(ModelBackend):
+    """
+    ModelBackend que comprueba la contraseña en el pool de procesos (hashing.verify_password).
+    """
+
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        if username is None:
+            username = kwargs.get(User.USERNAME_FIELD)
+        if username is None or password is None:
+            return None
+        try:
+            user = User._default_manager.get_by_natural_key(username)
+        except User.DoesNotExist:
+            # Igual que ModelBackend: se calcula un hash para que el tiempo de respuesta no revele
+            # si el usuario existe
+            make_password_in_pool(password)
+            return None
+
+        valid, must_update = verify_password(password, user.password)
+        if not valid:
+            return None
+        if must_update:
+            user.set_password(password)
+            user.save(update_fields=['password'])
+        return user if self.user_can_authenticate(user) else None
+
+    async def aauthenticate(self, request, username=None, password=None, **kwargs):
+        """
+        authenticate para código asíncrono: las consultas van con sync_to_async y la contraseña se espera con await.
+        """
+        if username is None:
+            username = kwargs.get(User.USERNAME_FIELD)
+        if username is None or password is None:
+            return None
+        try:
+            user = await sync_to_async(User._default_manager.get_by_natural_key)(username)
+        except User.DoesNotExist:
+            await amake_password_in_pool(password)
+            return None
+
+        valid, must_update = await averify_password(password, user.password)
+        if not valid:
+            return None
+        if must_update:
+            user.set_password(password)
+            await sync_to_async(user.save)(update_fields=['password'])
+        return user if self.user_can_authenticate(user) else None
+
+
+async def aauthenticate(request=None, **credentials):
+    """
+    django.contrib.auth.authenticate para vistas asíncronas. PooledModelBackend usa su versión asíncrona y el
+    resto de backends se ejecutan con sync_to_async.
+    """
+    for backend, backend_path in _get_backends(return_tuples=True):
+        try:
+            inspect.signature(backend.authenticate).bind(request, **credentials)
+        except TypeError:
+            # Este backend no acepta estas credenciales
+            continue
+        try:
+            if isinstance(backend, PooledModelBackend):
+                user = await backend.aauthenticate(request, **credentials)
+            else:
+                user = await sync_to_async(backend.authenticate)(request, **credentials)
+        except PermissionDenied:
+            break
+        if user is None:
+            continue
+        user.backend = backend_path
+        return user
+
+    await sync_to_async(user_login_failed.send)(
+        sender=__name__, credentials=_clean_credentials(credentials), request=request)
+    return None
+
+
+@receiver(post_save, sender=User, dispatch_uid='jwt_user_cache_save')
+@receiver(post_delete, sender=User, dispatch_uid='jwt_user_cache_delete')
+def invalidate_cached_user(sender, instance, **kwargs):
+    user_cache.invalidate_user(instance.pk)
@@ -0,0 +1,204 @@
+"""
+Agregados sobre todas las BBDD de los tenants a la vez (informes de los administradores).
+
+Cada agregado (`AGGREGATES`) es una función que recibe el alias de una BBDD y los parámetros de la petición y devuelve
+un número o un diccionario {clave: número}. `run_aggregate` la ejecuta en todas las BBDD en paralelo con un
+ThreadPoolExecutor, así el tiempo total es el de la BBDD más lenta y no la suma:
+
+- Cada BBDD tiene como mucho settings.CROSS_TENANT['TIMEOUT'] segundos desde que empieza su consulta (con más BBDD
+  que hilos, el tiempo en cola no cuenta). Si no ha terminado se devuelve su error y no cuenta en el total. En
+  PostgreSQL y MySQL se fija además el timeout de la consulta en el servidor, para que no se quede ejecutando. En
+  SQLite no hay timeout en el servidor: la consulta se interrumpe (sqlite3.Connection.interrupt) para que deje
+  libres el hilo y su hueco del límite de conexiones.
+- Las consultas de cada BBDD ocupan un hueco de su límite de conexiones (db_pool.pooled), igual que una petición.
+- Los totales se suman: los números directamente y los diccionarios clave a clave.
+"""
+import math
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.conf import settings
+from django.db import close_old_connections, connections
+from django.db.models import Count
+
+from utilidad.logging import error
+
+from .databases import release_stale_connections
+from .db_pool import pooled
+from .models import Alarma, Paciente
+from .routers import tenant_aliases, use_tenant
+
+
+# ============================ Agregados ============================ #
+def _alarmas(alias, params):
+    queryset = Alarma.objects.using(alias)
+    if params.get('desde'):
+        queryset = queryset.filter(fecha_registro__gte=params['desde'])
+    if params.get('hasta'):
+        queryset = queryset.filter(fecha_registro__lte=params['hasta'])
+    return {row['estado_alarma']: row['total'] for row in
+            queryset.order_by().values('estado_alarma').annotate(total=Count('id'))}
+
+
+def _alarmas_abiertas(alias, params):
+    return Alarma.objects.using(alias).filter(estado_alarma=Alarma.ESTADO_ENUM.Abierta).count()
+
+
+def _pacientes_por_modalidad(alias, params):
+    rows = (Paciente.objects.using(alias).order_by()
+            .values('id_tipo_modalidad_paciente__nombre').annotate(total=Count('id')))
+    return {row['id_tipo_modalidad_paciente__nombre'] or 'Sin modalidad': row['total'] for row in rows}
+
+
+AGGREGATES = {
+    'alarmas': _alarmas,
+    'alarmas_abiertas': _alarmas_abiertas,
+    'pacientes_por_modalidad': _pacientes_por_modalidad,
+}
+
+
+# ============================ Ejecución ============================ #
+_executor = None
+# Cada cuántos segundos se comprueba si ha empezado alguna BBDD que estaba en cola
+_POLL = 0.1
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=settings.CROSS_TENANT['MAX_WORKERS'],
+                                       thread_name_prefix='CrossTenant')
+    return _executor
+
+
+class _Progress:
+    """
+    Cuándo ha empezado la consulta de cada BBDD y, en SQLite, la conexión que la ejecuta (para interrumpirla).
+    """
+
+    def __init__(self):
+        self.started = {}
+        self.sqlite = {}
+
+
+def _run_on_tenant(function, alias, params, timeout, progress):
+    # Los hilos del pool se reutilizan: igual que al empezar y terminar una petición, se cierran las conexiones
+    # caducadas (CONN_MAX_AGE) o abiertas con una configuración antigua
+    close_old_connections()
+    release_stale_connections()
+    start = time.perf_counter()
+    progress.started[alias] = start
+    try:
+        with pooled(alias), use_tenant(alias):
+            connection = connections[alias]
+            _set_statement_timeout(connection, timeout)
+            if connection.vendor == 'sqlite':
+                connection.ensure_connection()
+                progress.sqlite[alias] = connection.connection
+            try:
+                return function(alias, params), time.perf_counter() - start
+            finally:
+                progress.sqlite.pop(alias, None)
+                _set_statement_timeout(connection, None)
+    finally:
+        close_old_connections()
+
+
+def _set_statement_timeout(connection, timeout):
+    vendor = connection.vendor
+    if vendor not in ('postgresql', 'mysql'):
+        return
+    with connection.cursor() as cursor:
+        if vendor == 'postgresql':
+            cursor.execute("SET statement_timeout = %s", [int(timeout * 1000) if timeout else 0])
+        else:
+            cursor.execute("SET SESSION MAX_EXECUTION_TIME = %s", [int(timeout * 1000) if timeout else 0])
+
+
+def _merge(total, value):
+    if isinstance(value, dict):
+        total = dict(total or {})
+        for key, count in value.items():
+            total[key] = total.get(key, 0) + count
+        return total
+    return (total or 0) + value
+
+
+def _wait(futures, progress, timeout, limit):
+    """
+    Espera hasta que cada BBDD termine o agote sus `timeout` segundos desde que empezó. Las que siguen en cola se
+    esperan como mucho hasta `limit` (lo que tardarían todas por tandas de tantas BBDD como hilos).
+    Devuelve los alias que han agotado su tiempo.
+    """
+    expired = set()
+    pending = dict(futures)
+    while pending:
+        current = time.perf_counter()
+        for alias, future in list(pending.items()):
+            started = progress.started.get(alias)
+            if future.done():
+                del pending[alias]
+            elif started is not None and started + timeout <= current:
+                _interrupt(progress, alias)
+                expired.add(alias)
+                del pending[alias]
+        if not pending or current >= limit:
+            return expired
+        # Una BBDD que estaba en cola puede empezar en cualquier momento: se vuelve a mirar cada _POLL segundos
+        deadlines = [progress.started[alias] + timeout for alias in pending if alias in progress.started]
+        wait(pending.values(), timeout=min(deadlines + [limit, current + _POLL]) - current,
+             return_when=FIRST_COMPLETED)
+    return expired
+
+
+def _interrupt(progress, alias):
+    # SQLite no tiene timeout de consulta en el servidor: se interrumpe desde aquí (se puede llamar desde otro hilo)
+    raw_connection = progress.sqlite.get(alias)
+    if raw_connection is not None:
+        raw_connection.interrupt()
+
+
+def run_aggregate(name, params=None, aliases=None):
+    """
+    Ejecuta el agregado `name` en las BBDD `aliases` (por defecto todas) y devuelve el total y el resultado,
+    la duración o el error de cada una. Lanza KeyError si el agregado no existe.
+    """
+    function = AGGREGATES[name]
+    params = params or {}
+    aliases = tenant_aliases() if aliases is None else aliases
+    timeout = settings.CROSS_TENANT['TIMEOUT']
+
+    start = time.perf_counter()
+    executor = _get_executor()
+    progress = _Progress()
+    futures = {alias: executor.submit(_run_on_tenant, function, alias, params, timeout, progress)
+               for alias in aliases}
+    workers = settings.CROSS_TENANT['MAX_WORKERS']
+    expired = _wait(futures, progress, timeout, start + timeout * math.ceil(len(aliases) / workers))
+
+    total = None
+    tenants = []
+    for alias, future in futures.items():
+        result = {'database': alias}
+        if alias in expired or (not future.done() and alias in progress.started):
+            _interrupt(progress, alias)
+            result['error'] = 'Tiempo de espera agotado (%ss)' % timeout
+        elif not future.done():
+            future.cancel()
+            result['error'] = 'No ha empezado a tiempo, las demás BBDD ocupaban los %s hilos' % workers
+        elif future.exception() is not None:
+            error("[TeleasistenciaApp] Agregado %s en %s: %s", name, alias, future.exception())
+            result['error'] = str(future.exception())
+        else:
+            value, duration = future.result()
+            total = _merge(total, value)
+            result['resultado'] = value
+            result['duracion_ms'] = round(duration * 1000, 2)
+        tenants.append(result)
+
+    return {
+        'agregado': name,
+        'total': total if total is not None else 0,
+        'tenants': tenants,
+        'duracion_ms': round((time.perf_counter() - start) * 1000, 2),
+    }
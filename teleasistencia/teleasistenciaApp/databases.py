@@ -0,0 +1,287 @@
+"""
+Registro en caliente de las bases de datos de los tenants (modelo Database).
+
+Las filas de Database se añaden a `connections.databases` (que es el mismo diccionario que settings.DATABASES)
+sin reiniciar el servidor ni reescribir el .env:
+
+- Al guardar o borrar un Database (signals.py) el proceso que lo hace sincroniza sus conexiones y cambia el
+  fichero de versión (settings.TENANT_DATABASES_VERSION_FILE).
+- El resto de procesos comprueban ese fichero al empezar cada petición (como mucho cada
+  settings.TENANT_DATABASES_SYNC_INTERVAL segundos) y, si ha cambiado, vuelven a leer la tabla Database.
+- Antes de activar una configuración nueva se comprueba que se puede conectar (`health_check`). Si falla se
+  mantiene la anterior (o el alias no se añade). Las comprobaciones se hacen sin el lock y con un tiempo máximo de
+  conexión (settings.TENANT_DATABASES_HEALTH_CHECK_TIMEOUT), así una BBDD que no responde no para a los demás hilos.
+- Las conexiones abiertas con una configuración antigua no se cortan: cada hilo cierra las suyas al empezar o
+  terminar su siguiente petición (`release_stale_connections`), nunca en mitad de una consulta.
+
+"default" y la BBDD de logs no se cambian en caliente, y los alias del .env que no tienen fila en Database
+se dejan como están.
+"""
+import os
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from django.db.utils import ConnectionHandler
+
+from utilidad.logging import error, green, yellow
+
+from .routers import logs_database
+
+_lock = threading.RLock()
+# Un solo hilo por proceso vuelve a leer la tabla en refresh(), el resto sigue con la configuración actual
+_refresh_lock = threading.Lock()
+# Configuración de las filas de Database ya aplicadas en este proceso: alias -> settings
+_applied = {}
+# Alias quitados, de los que algún hilo puede tener todavía una conexión abierta
+_removed = set()
+# Error del último intento de activar cada alias que no ha pasado el health check: alias -> mensaje
+_problems = {}
+# Se incrementa cada vez que cambia la configuración de algún alias
+_generation = 0
+# Versión del fichero de versión con la que se leyó la tabla por última vez (None: todavía no se ha leído)
+_seen_version = None
+_next_check = 0
+_thread = threading.local()
+
+
+def database_settings(database):
+    """
+    Configuración de DATABASES correspondiente a una fila de Database.
+    """
+    if "sqlite" in database.engine:
+        # Igual que en settings.py, las rutas de sqlite son relativas a BASE_DIR
+        return {
+            "ENGINE": database.engine,
+            "NAME": str(settings.BASE_DIR / database.name),
+            "CONN_MAX_AGE": settings.TENANT_CONNECTIONS['MAX_AGE'],
+        }
+    return {
+        "ENGINE": database.engine,
+        "NAME": database.name,
+        "USER": database.user or '',
+        "PASSWORD": database.password or '',
+        "HOST": database.host or '',
+        "PORT": str(database.port or ''),
+        "CONN_MAX_AGE": settings.TENANT_CONNECTIONS['MAX_AGE'],
+    }
+
+
+def health_check(settings_dict):
+    """
+    Abre una conexión de prueba con `settings_dict` (sin tocar `connections`) y ejecuta un SELECT 1.
+    Devuelve None si funciona o el mensaje de error.
+    """
+    if "sqlite" in settings_dict["ENGINE"] and not os.path.exists(settings_dict["NAME"]):
+        # sqlite crearía un fichero vacío en lugar de fallar
+        return "No existe el fichero %s" % settings_dict["NAME"]
+
+    probe = ConnectionHandler({DEFAULT_DB_ALIAS: _probe_settings(settings_dict)})
+    try:
+        connection = probe[DEFAULT_DB_ALIAS]
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        return None
+    except Exception as e:
+        return str(e)
+    finally:
+        probe.close_all()
+
+
+def _probe_settings(settings_dict):
+    # La conexión de prueba no espera más de TENANT_DATABASES_HEALTH_CHECK_TIMEOUT segundos a conectar
+    probe_settings = dict(settings_dict)
+    timeout = getattr(settings, 'TENANT_DATABASES_HEALTH_CHECK_TIMEOUT', None)
+    if timeout and ('postgresql' in settings_dict["ENGINE"] or 'mysql' in settings_dict["ENGINE"]):
+        probe_settings["OPTIONS"] = dict(settings_dict.get("OPTIONS") or {})
+        probe_settings["OPTIONS"].setdefault('connect_timeout', timeout)
+    return probe_settings
+
+
+def _protected(alias):
+    return alias == DEFAULT_DB_ALIAS or alias == logs_database()
+
+
+def _activate(alias, settings_dict, problem):
+    """
+    Añade o actualiza el alias si ha pasado el health check (`problem` es su resultado). Devuelve el mensaje de
+    error si no se activa.
+    """
+    global _generation
+    if problem:
+        error("[TeleasistenciaApp] No se activa la base de datos %s: %s", alias, problem)
+        with _lock:
+            _problems[alias] = problem
+        return problem
+    with _lock:
+        _problems.pop(alias, None)
+        connections.databases[alias] = dict(settings_dict)
+        _applied[alias] = settings_dict
+        _generation += 1
+    green("TeleasistenciaApp", "Base de datos %s activada", alias)
+    return None
+
+
+def _deactivate(alias):
+    global _generation
+    with _lock:
+        connections.databases.pop(alias, None)
+        _applied.pop(alias, None)
+        _problems.pop(alias, None)
+        _removed.add(alias)
+        _generation += 1
+    yellow("TeleasistenciaApp", "Base de datos %s desactivada", alias)
+
+
+def sync():
+    """
+    Aplica en este proceso la tabla Database: activa los alias nuevos o modificados y quita los borrados.
+    Devuelve {alias: error} de los que no se han podido activar.
+    """
+    from .models import Database
+    from .rest_django.utils import tenant_cache
+
+    desired = {}
+    for database in Database.objects.using(DEFAULT_DB_ALIAS).all():
+        if _protected(database.nameDescritive):
+            continue
+        desired[database.nameDescritive] = database_settings(database)
+
+    with _lock:
+        pending = {alias: settings_dict for alias, settings_dict in desired.items()
+                   if _applied.get(alias) != settings_dict and not _matches(alias, settings_dict)}
+    # Las conexiones de prueba, sin el lock
+    checked = {alias: health_check(settings_dict) for alias, settings_dict in pending.items()}
+
+    problems = {}
+    with _lock:
+        for alias, settings_dict in desired.items():
+            if alias in checked:
+                problem = _activate(alias, settings_dict, checked[alias])
+                if problem:
+                    problems[alias] = problem
+            else:
+                _applied[alias] = settings_dict
+        # Sólo se quitan los alias que venían de una fila de Database que ya no existe
+        for alias in [alias for alias in _applied if alias not in desired]:
+            _deactivate(alias)
+    tenant_cache.invalidate()
+    return problems
+
+
+def activation_problem(alias):
+    """
+    Error por el que `alias` no se ha activado en este proceso en la última sincronización (None si está activo).
+    """
+    return _problems.get(alias)
+
+
+def _matches(alias, settings_dict):
+    """
+    True si el alias ya está configurado así (p. ej. porque viene del .env), para no reconectarlo.
+    """
+    current = connections.databases.get(alias)
+    return current is not None and all(str(current.get(key) or '') == str(value or '')
+                                       for key, value in settings_dict.items())
+
+
+# ============================ Varios procesos ============================ #
+def _version_file():
+    return getattr(settings, 'TENANT_DATABASES_VERSION_FILE', None)
+
+
+def _read_version():
+    path = _version_file()
+    if not path:
+        return 0
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+def notify_changed():
+    """
+    Sincroniza este proceso y avisa al resto cambiando el fichero de versión.
+    """
+    global _seen_version
+    problems = sync()
+    path = _version_file()
+    if path:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp = '%s.%s.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(uuid.uuid4().hex)
+        os.replace(tmp, path)
+    with _lock:
+        _seen_version = _read_version()
+    return problems
+
+
+def refresh():
+    """
+    Vuelve a leer la tabla Database si otro proceso la ha cambiado (o si este proceso no la ha leído nunca).
+    Se llama al empezar cada petición, así que normalmente sólo cuesta comparar la hora.
+    """
+    global _seen_version, _next_check
+    current = time.monotonic()
+    if _seen_version is not None and current < _next_check:
+        return
+    _next_check = current + getattr(settings, 'TENANT_DATABASES_SYNC_INTERVAL', 2)
+
+    version = _read_version()
+    if version == _seen_version:
+        return
+    if not _refresh_lock.acquire(blocking=False):
+        # Otro hilo ya está sincronizando (con sus health checks): esta petición no lo espera
+        return
+    try:
+        if version == _seen_version:
+            return
+        try:
+            sync()
+        except DatabaseError as e:
+            # Por ejemplo, antes de aplicar las migraciones: se reintentará en la siguiente comprobación
+            error("[TeleasistenciaApp] No se pudo leer la tabla Database: %s", e)
+            return
+        with _lock:
+            _seen_version = version
+    finally:
+        _refresh_lock.release()
+
+
+def release_stale_connections():
+    """
+    Cierra las conexiones de este hilo abiertas con una configuración que ya no está activa.
+    """
+    if getattr(_thread, 'generation', None) == _generation:
+        return
+    _thread.generation = _generation
+    for alias in set(connections.databases) | _removed:
+        _release(alias)
+
+
+def _release(alias):
+    try:
+        connection = getattr(connections._connections, alias)
+    except AttributeError:
+        return
+    if connections.databases.get(alias) is connection.settings_dict:
+        return
+    # No se cierra si el hilo está dentro de una transacción, se volverá a comprobar en la siguiente petición
+    if connection.in_atomic_block:
+        _thread.generation = None
+        return
+    connection.close()
+    del connections[alias]
+
+
+def refresh_connections(**kwargs):
+    """
+    Aplica los cambios de otros procesos y libera las conexiones antiguas de este hilo. Es el receptor de
+    request_started/request_finished (ver apps.ready) y lo llaman también las tareas del scheduler.
+    """
+    refresh()
+    release_stale_connections()
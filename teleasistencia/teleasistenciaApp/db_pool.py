@@ -0,0 +1,191 @@
+"""
+Conexiones persistentes y acotadas a las BBDD de los tenants (settings.TENANT_CONNECTIONS).
+
+Django guarda una conexión por hilo y alias. Con 'MAX_AGE' (CONN_MAX_AGE) esa conexión se reutiliza entre
+peticiones en lugar de abrir una nueva (con su handshake) en cada una. Este módulo añade lo que Django 3.2 no trae:
+
+- Comprobación antes de reutilizar: al empezar una petición, las conexiones abiertas que llevan más de
+  'HEALTH_CHECK_AFTER' segundos sin usarse se comprueban (`is_usable`) y se cierran si el servidor las ha cortado.
+- Límite por BBDD: TenantDatabaseMiddleware no deja que haya más de 'MAX_CONNECTIONS' peticiones a la vez
+  trabajando con la misma BBDD (y por tanto conexiones en uso). Las demás esperan hasta 'WAIT_TIMEOUT' segundos
+  y, si no, se responden con 503.
+- Estadísticas por BBDD (`pool_stats`): conexiones en uso y abiertas sin usar, y esperas.
+"""
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections
+
+from utilidad.metricas import gauge, histogram
+
+BD_EN_USO = gauge('teleasistencia_bd_conexiones_en_uso', 'Peticiones trabajando con cada BBDD', ['database'])
+BD_ESPERA = histogram('teleasistencia_bd_espera_segundos', 'Espera por una conexión libre', ['database'],
+                      buckets=(0.001, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10))
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """
+    Límite de peticiones simultáneas con una BBDD y sus estadísticas.
+    """
+
+    def __init__(self, alias, max_connections):
+        self.alias = alias
+        self.max_connections = max_connections
+        self._semaphore = threading.BoundedSemaphore(max_connections)
+        self._lock = threading.Lock()
+        self.in_use = 0
+        self.acquired = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.timeouts = 0
+
+    def try_acquire(self):
+        """
+        Ocupa un hueco sin esperar. Devuelve False si no hay ninguno libre.
+        """
+        if not self._semaphore.acquire(blocking=False):
+            return False
+        self._acquired(0)
+        return True
+
+    def acquire(self, timeout):
+        if self.try_acquire():
+            return
+        start = time.perf_counter()
+        acquired = self._semaphore.acquire(timeout=timeout)
+        waited = time.perf_counter() - start
+        if not acquired:
+            with self._lock:
+                self.waits += 1
+                self.wait_time += waited
+                self.timeouts += 1
+            raise PoolTimeout(self.alias)
+        self._acquired(waited)
+
+    def _acquired(self, waited):
+        with self._lock:
+            self.in_use += 1
+            self.acquired += 1
+            if waited:
+                self.waits += 1
+                self.wait_time += waited
+                self.max_wait = max(self.max_wait, waited)
+        BD_EN_USO.labels(self.alias).inc()
+        BD_ESPERA.labels(self.alias).observe(waited)
+
+    def release(self):
+        with self._lock:
+            self.in_use -= 1
+        BD_EN_USO.labels(self.alias).dec()
+        self._semaphore.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'database': self.alias,
+                'max_conexiones': self.max_connections,
+                'en_uso': self.in_use,
+                'peticiones': self.acquired,
+                'esperas': self.waits,
+                'espera_media_ms': round(self.wait_time / self.waits * 1000, 2) if self.waits else 0,
+                'espera_maxima_ms': round(self.max_wait * 1000, 2),
+                'rechazadas': self.timeouts,
+            }
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias):
+    pool = _pools.get(alias)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(alias)
+            if pool is None:
+                pool = _pools[alias] = ConnectionPool(alias, settings.TENANT_CONNECTIONS['MAX_CONNECTIONS'])
+    return pool
+
+
+@contextmanager
+def pooled(alias):
+    """
+    Ocupa un hueco de la BBDD `alias` durante el bloque (esperando como mucho 'WAIT_TIMEOUT' segundos).
+    """
+    pool = get_pool(alias)
+    pool.acquire(settings.TENANT_CONNECTIONS['WAIT_TIMEOUT'])
+    try:
+        yield
+    finally:
+        pool.release()
+
+
+# ========================= Conexiones abiertas ========================= #
+# Conexiones (DatabaseWrapper de cualquier hilo) -> último momento en que se terminó de usar
+_last_used = weakref.WeakKeyDictionary()
+_last_used_lock = threading.Lock()
+
+
+def track_connection(sender, connection, **kwargs):
+    """
+    Receptor de connection_created.
+    """
+    with _last_used_lock:
+        _last_used[connection] = time.monotonic()
+
+
+def check_connections(**kwargs):
+    """
+    Receptor de request_started (después del close_old_connections de Django): cierra las conexiones de este hilo
+    que llevan tiempo sin usarse y ya no responden, para que la petición abra una nueva en lugar de fallar.
+    """
+    check_after = settings.TENANT_CONNECTIONS['HEALTH_CHECK_AFTER']
+    if check_after is None:
+        return
+    current = time.monotonic()
+    for connection in connections.all():
+        if connection.connection is None or connection.in_atomic_block:
+            continue
+        last_used = _last_used.get(connection, 0)
+        if current - last_used > check_after and not connection.is_usable():
+            connection.close()
+
+
+def connections_released(**kwargs):
+    """
+    Receptor de request_finished: apunta cuándo se usaron por última vez las conexiones que siguen abiertas.
+    """
+    current = time.monotonic()
+    with _last_used_lock:
+        for connection in connections.all():
+            if connection.connection is not None:
+                _last_used[connection] = current
+
+
+def pool_stats():
+    """
+    Estadísticas por BBDD: las de su ConnectionPool más las conexiones abiertas (de todos los hilos).
+    """
+    open_connections = {}
+    with _last_used_lock:
+        tracked = list(_last_used.keys())
+    for connection in tracked:
+        if connection.connection is not None:
+            open_connections[connection.alias] = open_connections.get(connection.alias, 0) + 1
+
+    result = []
+    for alias in connections.databases:
+        stats = get_pool(alias).stats()
+        stats['abiertas'] = open_connections.get(alias, 0)
+        stats['libres'] = max(0, stats['abiertas'] - stats['en_uso'])
+        stats['conn_max_age'] = connections.databases[alias].get('CONN_MAX_AGE')
+        result.append(stats)
+    return result
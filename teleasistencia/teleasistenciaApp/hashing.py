@@ -0,0 +1,137 @@
+"""
+Cálculo de hashes de contraseñas en un pool de procesos (settings.PASSWORD_HASHING).
+
+El hasher de Django (PBKDF2 con cientos de miles de iteraciones) tarda decenas de milisegundos por contraseña
+y ocupa la CPU. Para muchas contraseñas a la vez (importación de usuarios) se reparten entre varios procesos, y
+la comprobación de la contraseña en el login (PooledModelBackend) también se hace en el pool, así el cálculo no
+ocupa la CPU del proceso del servidor.
+
+`verify_password` espera el resultado bloqueando el hilo que la llama. La vista asíncrona de /api/token/
+(teleasistencia/views.py) usa `averify_password`, que lo espera con await: mientras se calcula el hash el bucle
+de eventos sigue atendiendo otras peticiones y los logins simultáneos de un cambio de turno usan todas las CPUs
+sin ocupar un hilo cada uno.
+
+Los procesos se arrancan con 'spawn' la primera vez que se usan y se reutilizan. Sólo necesitan los settings
+(no cargan las apps, así que no arrancan el scheduler ni abren conexiones). Si el pool no está disponible
+se calculan en el propio hilo.
+"""
+import asyncio
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.hashers import check_password, make_password
+
+from utilidad.logging import error
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _init_worker(settings_module):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', settings_module)
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ProcessPoolExecutor(
+                    max_workers=settings.PASSWORD_HASHING['PROCESOS'] or os.cpu_count(),
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_worker,
+                    initargs=(os.environ.get('DJANGO_SETTINGS_MODULE', 'teleasistencia.settings'),),
+                )
+    return _pool
+
+
+def _reset_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False)
+        _pool = None
+
+
+def hash_passwords(passwords):
+    """
+    Devuelve los hashes (make_password) de `passwords`, en el mismo orden.
+    """
+    passwords = list(passwords)
+    if len(passwords) < settings.PASSWORD_HASHING['MINIMO_PARALELO']:
+        return [make_password(password) for password in passwords]
+    try:
+        # Se mandan en bloques para no pagar la comunicación entre procesos por cada contraseña
+        workers = settings.PASSWORD_HASHING['PROCESOS'] or os.cpu_count()
+        chunksize = max(1, len(passwords) // (workers * 4))
+        return list(_get_pool().map(make_password, passwords, chunksize=chunksize))
+    except (BrokenProcessPool, OSError) as e:
+        error("[TeleasistenciaApp] Pool de hashing no disponible, se calcula en el hilo: %s", e)
+        _reset_pool()
+        return [make_password(password) for password in passwords]
+
+
+def _check(password, encoded):
+    """
+    check_password en el proceso del pool. El setter sólo se llama si la contraseña es correcta y el hash debe
+    actualizarse (hasher o iteraciones distintos de los actuales), lo que no se puede hacer desde aquí.
+    """
+    must_update = []
+    valid = check_password(password, encoded, setter=lambda raw_password: must_update.append(True))
+    return valid, bool(must_update)
+
+
+def _run_in_pool(function, *args):
+    if not settings.PASSWORD_HASHING['VERIFICAR_EN_POOL']:
+        return function(*args)
+    try:
+        return _get_pool().submit(function, *args).result()
+    except (BrokenProcessPool, OSError) as e:
+        error("[TeleasistenciaApp] Pool de hashing no disponible, se calcula en el hilo: %s", e)
+        _reset_pool()
+        return function(*args)
+
+
+def verify_password(password, encoded):
+    """
+    Comprueba `password` contra el hash `encoded`. Devuelve (correcta, hay_que_actualizar_el_hash).
+    """
+    return _run_in_pool(_check, password, encoded)
+
+
+def make_password_in_pool(password):
+    """
+    make_password en el pool (el login de un usuario que no existe también calcula un hash).
+    """
+    return _run_in_pool(make_password, password)
+
+
+async def _arun_in_pool(function, *args):
+    # Como _run_in_pool, pero sin bloquear el bucle de eventos: se espera el Future del pool con await
+    if not settings.PASSWORD_HASHING['VERIFICAR_EN_POOL']:
+        return await sync_to_async(function, thread_sensitive=False)(*args)
+    try:
+        return await asyncio.wrap_future(_get_pool().submit(function, *args))
+    except (BrokenProcessPool, OSError) as e:
+        error("[TeleasistenciaApp] Pool de hashing no disponible, se calcula en el hilo: %s", e)
+        _reset_pool()
+        return await sync_to_async(function, thread_sensitive=False)(*args)
+
+
+async def averify_password(password, encoded):
+    """
+    verify_password para código asíncrono.
+    """
+    return await _arun_in_pool(_check, password, encoded)
+
+
+async def amake_password_in_pool(password):
+    """
+    make_password_in_pool para código asíncrono.
+    """
+    return await _arun_in_pool(make_password, password)
@@ -0,0 +1,88 @@
+"""
+Política de qué peticiones de la API REST se guardan en Logs_AccionesUsuarios (settings.LOGS_ACCIONES_POLITICA).
+
+- Las peticiones que modifican datos (POST, PUT, PATCH, DELETE) se guardan siempre.
+- Las de lectura (GET, HEAD, OPTIONS) se guardan con la probabilidad de su prefijo en 'MUESTREO'
+  o con 'LECTURA_POR_DEFECTO' si no tiene ninguno.
+- Las rutas de 'IGNORAR' no se guardan nunca.
+
+Los prefijos se comparan por segmentos completos (`/api-rest/alarma` incluye `/api-rest/alarma/5` pero no
+`/api-rest/alarma_programada`) y gana el más largo. Un prefijo terminado en `$` sólo vale para esa ruta exacta
+(`/api-rest/alarma$` es el listado, no `/api-rest/alarma/5`). Se compilan en un trie de segmentos, así que decidir
+cuesta lo mismo que recorrer la ruta una vez, sin importar cuántos prefijos haya configurados.
+"""
+import random
+
+from django.conf import settings
+
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# Valor del trie para las rutas ignoradas (distinto de un muestreo 0, que sí guarda las escrituras)
+IGNORE = 'ignorar'
+
+
+class PrefixTrie:
+    """
+    Trie de segmentos de ruta: cada nodo es un diccionario {segmento: nodo} y puede tener un valor.
+    """
+    _VALUE = object()
+    # Valor que sólo se aplica si la ruta termina en ese nodo
+    _EXACT = object()
+
+    def __init__(self):
+        self._root = {}
+
+    def insert(self, prefix, value, exact=False):
+        node = self._root
+        for segment in _segments(prefix):
+            node = node.setdefault(segment, {})
+        node[self._EXACT if exact else self._VALUE] = value
+
+    def longest_match(self, path, default=None):
+        """
+        Devuelve el valor del prefijo más largo de `path` que esté en el trie (o el de la ruta exacta).
+        """
+        node = self._root
+        value = node.get(self._VALUE, default)
+        for segment in _segments(path):
+            node = node.get(segment)
+            if node is None:
+                return value
+            value = node.get(self._VALUE, value)
+        return node.get(self._EXACT, value)
+
+
+def _segments(path):
+    return [segment for segment in path.split('/') if segment]
+
+
+class LogPolicy:
+
+    def __init__(self, read_rate=1.0, sampling=None, ignore=()):
+        self.read_rate = read_rate
+        self._trie = PrefixTrie()
+        for prefix, rate in (sampling or {}).items():
+            self._trie.insert(prefix.rstrip('$'), float(rate), exact=prefix.endswith('$'))
+        # Ignorar tiene prioridad sobre un muestreo del mismo prefijo
+        for prefix in ignore:
+            self._trie.insert(prefix, IGNORE)
+
+    @classmethod
+    def from_settings(cls):
+        config = getattr(settings, 'LOGS_ACCIONES_POLITICA', {})
+        return cls(
+            read_rate=config.get('LECTURA_POR_DEFECTO', 1.0),
+            sampling=config.get('MUESTREO', {}),
+            ignore=config.get('IGNORAR', ()),
+        )
+
+    def should_log(self, method, path):
+        rate = self._trie.longest_match(path, self.read_rate)
+        if rate == IGNORE:
+            return False
+        if method not in READ_METHODS or rate >= 1:
+            return True
+        return rate > 0 and random.random() < rate
+
+
+log_policy = LogPolicy.from_settings()
@@ -0,0 +1,215 @@
+"""
+Escritura en segundo plano de los logs de auditoría.
+
+Los middlewares no deben pagar un INSERT por petición, así que dejan los registros en una cola acotada en memoria
+y un hilo escritor los persiste por lotes con `bulk_create` cada `LOGS_WRITER_BATCH_SIZE` registros o cada
+`LOGS_WRITER_FLUSH_INTERVAL_MS` milisegundos (lo que ocurra antes).
+
+Para usarlo:
+    from teleasistenciaApp.log_writer import log_writer
+    log_writer.enqueue(Logs_AccionesUsuarios, {...campos del modelo...})
+
+La profundidad de la cola y los registros escritos, fallidos y descartados de cada escritor se publican en
+/metrics (etiqueta `escritor`).
+"""
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from utilidad.logging import red, error
+from utilidad.metricas import counter, gauge
+
+ESCRITOR_COLA = gauge('teleasistencia_escritor_cola', 'Elementos pendientes en la cola de cada escritor', ['escritor'])
+ESCRITOR_ESCRITOS = counter('teleasistencia_escritor_escritos_total', 'Elementos guardados por cada escritor',
+                            ['escritor'])
+ESCRITOR_FALLIDOS = counter('teleasistencia_escritor_fallidos_total',
+                            'Elementos que no se han podido guardar por un error', ['escritor'])
+ESCRITOR_DESCARTADOS = counter('teleasistencia_escritor_descartados_total',
+                               'Elementos descartados por tener la cola llena', ['escritor'])
+
+
+class BatchWriter:
+    """
+    Hilo que consume una cola acotada de elementos y los vuelca por lotes.
+
+    Las subclases implementan `flush_batch(items)`. Si la cola está llena los elementos nuevos se descartan
+    (nunca se bloquea al productor) y se contabilizan en `dropped`.
+    """
+
+    def __init__(self, name, batch_size=100, flush_interval_ms=500, max_queue_size=10000):
+        self.name = name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.queue = queue.Queue(maxsize=max_queue_size)
+
+        # Contadores expuestos (también en /metrics)
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+        self._queue_depth = ESCRITOR_COLA.labels(name)
+        self._written_metric = ESCRITOR_ESCRITOS.labels(name)
+        self._failed_metric = ESCRITOR_FALLIDOS.labels(name)
+        self._dropped_metric = ESCRITOR_DESCARTADOS.labels(name)
+
+        self._thread = None
+        self._stop = threading.Event()
+        self._start_lock = threading.Lock()
+
+    # ========================= Productor ========================= #
+    def enqueue(self, item):
+        """
+        Añade un elemento a la cola sin bloquear. Devuelve False si se ha descartado por estar la cola llena.
+        """
+        self._ensure_started()
+        try:
+            self.queue.put_nowait(item)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            self._dropped_metric.inc()
+            return False
+
+    # ========================= Consumidor ========================= #
+    def flush_batch(self, items):
+        raise NotImplementedError
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+                # Al detener el servidor vaciamos la cola antes de salir
+                from teleasistencia import shutdown_signal
+                shutdown_signal.connect(self.stop, sender='system', weak=False)
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._collect_batch()
+            if batch:
+                self._flush(batch)
+            # Como mucho cada intervalo de volcado, así el gauge no cuesta nada al productor
+            self._queue_depth.set(self.queue.qsize())
+        # Al parar, volcar lo que quede pendiente
+        self.flush()
+
+    def _collect_batch(self):
+        """
+        Espera hasta tener `batch_size` elementos o hasta que venza el intervalo de volcado.
+        """
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0 or self._stop.is_set():
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _flush(self, batch):
+        try:
+            # El hilo escritor tiene sus propias conexiones, las renovamos como haría una petición
+            close_old_connections()
+            self.flush_batch(batch)
+            self.written += len(batch)
+            self._written_metric.inc(len(batch))
+        except Exception as e:
+            self.failed += len(batch)
+            self._failed_metric.inc(len(batch))
+            error("[%s] No se han podido guardar %s registros: %s", self.name, len(batch), e)
+
+    def flush(self):
+        """
+        Vuelca inmediatamente todo lo que haya en la cola.
+        """
+        batch = []
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+            if len(batch) >= self.batch_size:
+                self._flush(batch)
+                batch = []
+        if batch:
+            self._flush(batch)
+        self._queue_depth.set(self.queue.qsize())
+
+    def stop(self, **kwargs):
+        if self._thread is not None and self._thread.is_alive():
+            self._stop.set()
+            self._thread.join()
+            red(self.name, "Escritor detenido")
+
+    def stats(self):
+        """
+        Contadores del escritor (para monitorización).
+        """
+        return {
+            "queue_depth": self.queue.qsize(),
+            "queue_max_size": self.queue.maxsize,
+            "dropped": self.dropped,
+            "written": self.written,
+            "failed": self.failed,
+        }
+
+
+class LogWriter(BatchWriter):
+    """
+    Escritor de logs: cada elemento es una tupla `(modelo, campos)` y se guardan con un `bulk_create` por modelo.
+    En lugar del diccionario de campos se puede encolar directamente una instancia sin guardar del modelo.
+    """
+
+    def enqueue(self, model, fields):
+        return super().enqueue((model, fields))
+
+    def flush_batch(self, items):
+        by_model = {}
+        for model, fields in items:
+            obj = fields if isinstance(fields, model) else model(**fields)
+            by_model.setdefault(model, []).append(obj)
+        for model, objs in by_model.items():
+            model.objects.bulk_create(objs, batch_size=self.batch_size)
+
+
+log_writer = LogWriter(
+    "LogWriter",
+    batch_size=getattr(settings, "LOGS_WRITER_BATCH_SIZE", 100),
+    flush_interval_ms=getattr(settings, "LOGS_WRITER_FLUSH_INTERVAL_MS", 500),
+    max_queue_size=getattr(settings, "LOGS_WRITER_QUEUE_SIZE", 10000),
+)
+
+
+class LastLoginWriter(BatchWriter):
+    """
+    Escritura diferida de User.last_login tras el login (TokenObtainPairSerializerWithLastLogin).
+    Cada elemento es `(id de usuario, fecha)`. De cada lote sólo se guarda la última fecha de cada usuario,
+    con un único UPDATE (bulk_update de last_login).
+    """
+
+    def enqueue(self, user_id, last_login):
+        return super().enqueue((user_id, last_login))
+
+    def flush_batch(self, items):
+        from django.contrib.auth.models import User
+        latest = {}
+        for user_id, last_login in items:
+            if user_id not in latest or latest[user_id] < last_login:
+                latest[user_id] = last_login
+        User.objects.bulk_update([User(pk=pk, last_login=last_login) for pk, last_login in latest.items()],
+                                 ['last_login'], batch_size=self.batch_size)
+
+
+last_login_writer = LastLoginWriter(
+    "LastLoginWriter",
+    batch_size=getattr(settings, "LOGS_WRITER_BATCH_SIZE", 100),
+    flush_interval_ms=getattr(settings, "LOGS_WRITER_FLUSH_INTERVAL_MS", 500),
+    max_queue_size=getattr(settings, "LOGS_WRITER_QUEUE_SIZE", 10000),
+)
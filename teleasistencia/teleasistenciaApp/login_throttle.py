@@ -0,0 +1,180 @@
+"""
+Limitación de intentos de login (`/api/token`) por IP y por nombre de usuario.
+
+Los límites se comprueban antes de comprobar la contraseña, de forma que un ataque de fuerza bruta o de
+"credential stuffing" se rechaza sin ejecutar el hasher (que es lo que consume la CPU).
+
+- Por usuario se apunta cada intento en una ventana deslizante (y se olvidan tras un login correcto).
+- Por IP sólo se apuntan los intentos fallidos (`login_failed`): los teleoperadores de un centro salen por la misma
+  IP y entran todos a la vez en el cambio de turno, sus logins correctos no cuentan.
+
+Configuración en settings.LOGIN_THROTTLE:
+    'IP':       (intentos fallidos, segundos) por dirección IP
+    'USERNAME': (intentos, segundos) por nombre de usuario
+    'CACHE':    alias de settings.CACHES para compartir los contadores entre procesos.
+                Con None se usan contadores en memoria del propio proceso.
+"""
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+
+# Cada cuántos intentos se purgan de memoria las claves que ya no tienen intentos en la ventana
+_SWEEP_EVERY = 1000
+
+
+class SlidingWindow:
+    """
+    Contadores de ventana deslizante en memoria: para cada clave se guardan los instantes de los intentos
+    dentro de la ventana.
+    """
+
+    def __init__(self):
+        self._hits = {}
+        self._lock = threading.Lock()
+        self._calls = 0
+        self._max_window = 0
+
+    def hit(self, key, limit, window):
+        """
+        Apunta un intento para `key`. Devuelve 0 si está dentro del límite, o los segundos que faltan
+        para que se libere un hueco si lo supera (el intento rechazado no se apunta).
+        """
+        current = time.monotonic()
+        with self._lock:
+            self._calls += 1
+            self._max_window = max(self._max_window, window)
+            if self._calls % _SWEEP_EVERY == 0:
+                self._sweep(current)
+
+            hits = self._hits.setdefault(key, deque())
+            wait = self._wait(hits, current, limit, window)
+            if not wait:
+                hits.append(current)
+            return wait
+
+    def peek(self, key, limit, window):
+        """
+        Como `hit` pero sin apuntar el intento.
+        """
+        current = time.monotonic()
+        with self._lock:
+            hits = self._hits.get(key)
+            return self._wait(hits, current, limit, window) if hits else 0
+
+    @staticmethod
+    def _wait(hits, current, limit, window):
+        while hits and hits[0] <= current - window:
+            hits.popleft()
+        if len(hits) >= limit:
+            return hits[0] + window - current
+        return 0
+
+    def reset(self, key, window):
+        with self._lock:
+            self._hits.pop(key, None)
+
+    def _sweep(self, current):
+        # Se usa la ventana más larga, las claves de IP y de usuario pueden tener ventanas distintas
+        for key in [k for k, hits in self._hits.items() if not hits or hits[-1] <= current - self._max_window]:
+            del self._hits[key]
+
+
+class CacheSlidingWindow:
+    """
+    Ventana deslizante aproximada sobre la caché de Django (compartida entre procesos/servidores).
+
+    Se guardan dos contadores de ventana fija (actual y anterior) y se pondera el anterior por la parte
+    de la ventana que aún se solapa, así cada intento cuesta sólo un par de operaciones en la caché.
+    """
+
+    def __init__(self, cache_alias):
+        self.cache_alias = cache_alias
+
+    @property
+    def cache(self):
+        from django.core.cache import caches
+        return caches[self.cache_alias]
+
+    def _wait(self, key, limit, window):
+        # (segundos de espera o 0, clave del contador de la ventana actual)
+        current = time.time()
+        bucket = int(current // window)
+        elapsed = (current % window) / window
+
+        current_key = "login_throttle:%s:%s" % (key, bucket)
+        counts = self.cache.get_many([current_key, "login_throttle:%s:%s" % (key, bucket - 1)])
+        previous = counts.get("login_throttle:%s:%s" % (key, bucket - 1), 0)
+        estimate = previous * (1 - elapsed) + counts.get(current_key, 0)
+        if estimate >= limit:
+            return (1 - elapsed) * window, current_key
+        return 0, current_key
+
+    def peek(self, key, limit, window):
+        return self._wait(key, limit, window)[0]
+
+    def hit(self, key, limit, window):
+        wait, current_key = self._wait(key, limit, window)
+        if wait:
+            return wait
+
+        cache = self.cache
+        # add + incr para que el incremento sea atómico en backends como memcached o redis
+        if not cache.add(current_key, 1, timeout=window * 2):
+            try:
+                cache.incr(current_key)
+            except ValueError:
+                cache.set(current_key, 1, timeout=window * 2)
+        return 0
+
+    def reset(self, key, window):
+        bucket = int(time.time() // window)
+        self.cache.delete_many(["login_throttle:%s:%s" % (key, bucket), "login_throttle:%s:%s" % (key, bucket - 1)])
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def _get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                cache_alias = settings.LOGIN_THROTTLE.get('CACHE')
+                _backend = CacheSlidingWindow(cache_alias) if cache_alias else SlidingWindow()
+    return _backend
+
+
+def check_login(ip, username):
+    """
+    Apunta un intento de login del usuario y devuelve los segundos de espera si la IP (por sus intentos fallidos)
+    o el usuario han superado su límite (0 si se puede continuar).
+    """
+    backend = _get_backend()
+    wait = 0
+    if ip:
+        limit, window = settings.LOGIN_THROTTLE['IP']
+        wait = backend.peek("ip:%s" % ip, limit, window)
+    if not wait and username:
+        limit, window = settings.LOGIN_THROTTLE['USERNAME']
+        wait = backend.hit("user:%s" % username.lower(), limit, window)
+    return wait
+
+
+def login_succeeded(username):
+    """
+    Tras un login correcto se olvidan los intentos del usuario, para no bloquear a quien se equivocó alguna vez.
+    """
+    if username:
+        _get_backend().reset("user:%s" % username.lower(), settings.LOGIN_THROTTLE['USERNAME'][1])
+
+
+def login_failed(ip):
+    """
+    Apunta un intento fallido de la IP (usuario o contraseña incorrectos).
+    """
+    if ip:
+        limit, window = settings.LOGIN_THROTTLE['IP']
+        _get_backend().hit("ip:%s" % ip, limit, window)
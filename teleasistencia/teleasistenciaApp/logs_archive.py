@@ -0,0 +1,199 @@
+"""
+Retención de los logs de auditoría.
+
+- Resume cada día completo de Logs_AccionesUsuarios en Logs_ResumenDiario (peticiones por usuario/ruta/método/estado).
+- Los logs más antiguos que settings.LOGS_RETENCION_DIAS se mueven, por meses, a ficheros JSONL comprimidos
+  (`<LOGS_ARCHIVO_DIR>/<tabla>_<AAAA-MM>.jsonl.gz`) y se borran de la BBDD. El fichero se reescribe en uno temporal
+  que se renombra antes de borrar los logs, y los logs que ya estén en el fichero (de una ejecución interrumpida
+  entre el renombrado y el borrado) no se vuelven a añadir.
+
+Se ejecuta a diario desde el scheduler (schedulerApp) o a mano con `python manage.py archivar_logs`.
+"""
+import gzip
+import json
+import os
+import re
+import shutil
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Count, Min
+from django.utils import timezone
+
+from .models import Logs_AccionesUsuarios, Logs_ConexionesUsuarios, Logs_ResumenDiario
+from .routers import logs_database
+from utilidad.logging import green
+
+# Segmentos numéricos de la ruta (ids) que se agrupan en los resúmenes: /api-rest/alarma/12 -> /api-rest/alarma/{id}
+_ID_SEGMENT = re.compile(r'/\d+(?=/|$)')
+
+
+def normalize_route(path):
+    """
+    Sustituye los identificadores numéricos de una ruta por `{id}` para poder agrupar las peticiones.
+    """
+    return _ID_SEGMENT.sub('/{id}', path)
+
+
+def _day_bounds(day):
+    start = timezone.make_aware(datetime.combine(day, time.min))
+    return start, start + timedelta(days=1)
+
+
+def _month_start(day):
+    return day.replace(day=1)
+
+
+def _next_month(day):
+    return (day.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+
+# =========================== Resumen diario =========================== #
+def rollup_day(day):
+    """
+    (Re)calcula el resumen de un día. Devuelve el número de filas de resumen creadas.
+    """
+    start, end = _day_bounds(day)
+    db = logs_database()
+    filas = Logs_AccionesUsuarios.objects.using(db) \
+        .filter(timestamp__gte=start, timestamp__lt=end) \
+        .values('user_id', 'ruta', 'metodo_http', 'estado_http') \
+        .annotate(total=Count('id'))
+
+    # Agrupar las rutas con ids en memoria, son pocas filas comparadas con el número de logs
+    totales = {}
+    for fila in filas:
+        clave = (fila['user_id'], normalize_route(fila['ruta'])[:200], fila['metodo_http'], fila['estado_http'])
+        totales[clave] = totales.get(clave, 0) + fila['total']
+
+    with transaction.atomic(using=db):
+        Logs_ResumenDiario.objects.using(db).filter(fecha=day).delete()
+        Logs_ResumenDiario.objects.using(db).bulk_create([
+            Logs_ResumenDiario(fecha=day, user_id=user_id, ruta=ruta, metodo_http=metodo, estado_http=estado, total=total)
+            for (user_id, ruta, metodo, estado), total in totales.items()
+        ])
+    return len(totales)
+
+
+def rollup_pending(today=None):
+    """
+    Resume todos los días completos (anteriores a hoy) que todavía no tengan resumen.
+    """
+    today = today or timezone.localdate()
+    db = logs_database()
+
+    ultimo = Logs_ResumenDiario.objects.using(db).order_by('-fecha').values_list('fecha', flat=True).first()
+    if ultimo is not None:
+        day = ultimo + timedelta(days=1)
+    else:
+        primero = Logs_AccionesUsuarios.objects.using(db).aggregate(primero=Min('timestamp'))['primero']
+        if primero is None:
+            return 0
+        day = timezone.localtime(primero).date()
+
+    dias = 0
+    while day < today:
+        # Saltar directamente al siguiente día con logs
+        start, _ = _day_bounds(day)
+        siguiente = Logs_AccionesUsuarios.objects.using(db).filter(timestamp__gte=start) \
+            .aggregate(siguiente=Min('timestamp'))['siguiente']
+        if siguiente is None:
+            break
+        siguiente = timezone.localtime(siguiente).date()
+        if siguiente > day:
+            day = siguiente
+            continue
+
+        rollup_day(day)
+        day += timedelta(days=1)
+        dias += 1
+    return dias
+
+
+# ============================== Archivado ============================== #
+def _archived_ids(fichero):
+    """
+    ids de los logs que ya están en el fichero de un mes.
+    """
+    if not os.path.exists(fichero):
+        return set()
+    with gzip.open(fichero, 'rt', encoding='utf-8') as f:
+        return {json.loads(linea)['id'] for linea in f if linea.strip()}
+
+
+def _append_archive(fichero, filas):
+    """
+    Añade las filas al fichero de un mes sin dejarlo a medias: se copia en un temporal con un miembro gzip más y se
+    renombra. Devuelve el número de filas añadidas.
+    """
+    ya_archivados = _archived_ids(fichero)
+    temporal = fichero + '.tmp'
+    total = 0
+    with open(temporal, 'wb') as destino:
+        if os.path.exists(fichero):
+            with open(fichero, 'rb') as origen:
+                shutil.copyfileobj(origen, destino)
+        # Otro miembro gzip al final, se sigue leyendo como un único fichero
+        with gzip.open(destino, 'wt', encoding='utf-8') as f:
+            for fila in filas:
+                if fila['id'] in ya_archivados:
+                    continue
+                f.write(json.dumps(fila, cls=DjangoJSONEncoder) + '\n')
+                total += 1
+        destino.flush()
+        os.fsync(destino.fileno())
+    os.replace(temporal, fichero)
+    return total
+
+
+def archive_expired(model, today=None, retention_days=None, archive_dir=None):
+    """
+    Mueve los logs de `model` anteriores al periodo de retención a ficheros JSONL comprimidos, uno por mes.
+    Devuelve el número de logs archivados.
+    """
+    today = today or timezone.localdate()
+    retention_days = retention_days if retention_days is not None else settings.LOGS_RETENCION_DIAS
+    archive_dir = archive_dir or settings.LOGS_ARCHIVO_DIR
+    db = logs_database()
+
+    cutoff, _ = _day_bounds(today - timedelta(days=retention_days))
+    queryset = model.objects.using(db).filter(timestamp__lt=cutoff)
+    primero = queryset.aggregate(primero=Min('timestamp'))['primero']
+    if primero is None:
+        return 0
+
+    os.makedirs(archive_dir, exist_ok=True)
+    archivados = 0
+    month = _month_start(timezone.localtime(primero).date())
+    while True:
+        start, _ = _day_bounds(month)
+        if start >= cutoff:
+            break
+        end = min(_day_bounds(_next_month(month))[0], cutoff)
+
+        particion = queryset.filter(timestamp__gte=start, timestamp__lt=end).order_by('pk')
+        if not particion.exists():
+            month = _next_month(month)
+            continue
+
+        fichero = os.path.join(archive_dir, "%s_%s.jsonl.gz" % (model._meta.db_table, month.strftime('%Y-%m')))
+        with transaction.atomic(using=db):
+            total = _append_archive(fichero, particion.values().iterator())
+            particion.delete()
+        archivados += total
+        month = _next_month(month)
+
+    return archivados
+
+
+def run_retention():
+    """
+    Tarea diaria: resume los días pendientes y archiva los logs caducados.
+    """
+    dias = rollup_pending()
+    acciones = archive_expired(Logs_AccionesUsuarios)
+    conexiones = archive_expired(Logs_ConexionesUsuarios)
+    green("LogsArchive", f"Días resumidos: {dias}, logs archivados: {acciones} acciones, {conexiones} conexiones")
+    return dias, acciones, conexiones
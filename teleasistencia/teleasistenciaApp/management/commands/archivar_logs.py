@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from teleasistenciaApp.logs_archive import rollup_pending, archive_expired
+from teleasistenciaApp.models import Logs_AccionesUsuarios, Logs_ConexionesUsuarios
+
+
+class Command(BaseCommand):
+    help = "Resume los logs por días y archiva en ficheros JSONL comprimidos los que superan el periodo de retención"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dias', type=int, default=None,
+                            help="Días de retención (por defecto settings.LOGS_RETENCION_DIAS)")
+
+    def handle(self, *args, **options):
+        dias = rollup_pending()
+        self.stdout.write(f"Días resumidos: {dias}")
+
+        for model in (Logs_AccionesUsuarios, Logs_ConexionesUsuarios):
+            total = archive_expired(model, retention_days=options['dias'])
+            self.stdout.write(f"{model.__name__}: {total} logs archivados")
@@ -0,0 +1,98 @@
+import asyncio
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.test import RequestFactory, override_settings
+from rest_framework_simplejwt.views import TokenObtainPairView
+
+from teleasistencia.views import TokenObtainPairSerializerWithLastLogin, token_obtain_pair
+from teleasistenciaApp.hashing import hash_passwords
+from teleasistenciaApp.log_writer import last_login_writer
+from teleasistenciaApp.request_metrics import _percentile
+
+PASSWORD = 'Benchmark-Login-1'
+
+# "antes": vista síncrona con la contraseña comprobada en el hilo y last_login guardado en la petición.
+# "sincrona": la misma vista con el pool de hashing y last_login diferido; el hilo sigue esperando al pool.
+# "asincrona": la vista asíncrona de /api/token/, que espera al pool con await
+MODES = {
+    'antes': dict(VISTA='sincrona', VERIFICAR_EN_POOL=False, LAST_LOGIN_WRITE_BEHIND=False),
+    'sincrona': dict(VISTA='sincrona', VERIFICAR_EN_POOL=True, LAST_LOGIN_WRITE_BEHIND=True),
+    'asincrona': dict(VISTA='asincrona', VERIFICAR_EN_POOL=True, LAST_LOGIN_WRITE_BEHIND=True),
+}
+
+sync_view = TokenObtainPairView.as_view(serializer_class=TokenObtainPairSerializerWithLastLogin)
+
+
+class Command(BaseCommand):
+    help = "Mide los logins por segundo de /api/token/ con la vista síncrona y la asíncrona, con logins simultáneos"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--usuarios', type=int, default=20, help="Usuarios de prueba que hacen login")
+        parser.add_argument('--logins', type=int, default=100, help="Logins por modo")
+        parser.add_argument('--concurrencia', type=int, default=8, help="Logins simultáneos")
+
+    def handle(self, *args, **options):
+        # Los usuarios de prueba se crean con una sola pasada de hashing y se borran al terminar
+        usernames = ['benchmark_login_%s' % i for i in range(options['usuarios'])]
+        User.objects.filter(username__in=usernames).delete()
+        password = hash_passwords([PASSWORD])[0]
+        User.objects.bulk_create([User(username=username, password=password) for username in usernames])
+
+        try:
+            # Todos los logins salen de la misma IP, como los de un centro en el cambio de turno: el límite por IP
+            # (sólo de intentos fallidos) es el configurado. Sin límite por usuario, cada uno hace muchos logins
+            throttle = dict(settings.LOGIN_THROTTLE, USERNAME=(10 ** 9, 60), CACHE=None)
+            with override_settings(LOGIN_THROTTLE=throttle):
+                # Un login previo arranca el pool de procesos para que no cuente en la medición
+                asyncio.run(self._login('asincrona', usernames[0]))
+                for mode, config in MODES.items():
+                    result = self._run(mode, config, usernames, options['logins'], options['concurrencia'])
+                    self.stdout.write(
+                        "%(modo)-9s %(logins)s logins en %(segundos).2fs: %(por_segundo).1f logins/s, "
+                        "p50 %(p50).0f ms, p95 %(p95).0f ms" % result)
+        finally:
+            last_login_writer.flush()
+            User.objects.filter(username__in=usernames).delete()
+
+    def _run(self, mode, config, usernames, logins, concurrency):
+        hashing = dict(settings.PASSWORD_HASHING, VERIFICAR_EN_POOL=config['VERIFICAR_EN_POOL'])
+        with override_settings(PASSWORD_HASHING=hashing, LAST_LOGIN_WRITE_BEHIND=config['LAST_LOGIN_WRITE_BEHIND']):
+            start = time.perf_counter()
+            durations = sorted(asyncio.run(self._load(config['VISTA'], usernames, logins, concurrency)))
+            total = time.perf_counter() - start
+        return {
+            'modo': mode,
+            'logins': logins,
+            'segundos': total,
+            'por_segundo': logins / total,
+            'p50': _percentile(durations, 50),
+            'p95': _percentile(durations, 95),
+        }
+
+    async def _load(self, view, usernames, logins, concurrency):
+        # Como mucho `concurrency` logins en curso a la vez, igual que otros tantos clientes contra el servidor ASGI
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def login(i):
+            async with semaphore:
+                return await self._login(view, usernames[i % len(usernames)])
+
+        return await asyncio.gather(*(login(i) for i in range(logins)))
+
+    @staticmethod
+    async def _login(view, username):
+        request = RequestFactory().post('/api/token/', {'username': username, 'password': PASSWORD},
+                                        content_type='application/json')
+        start = time.perf_counter()
+        if view == 'asincrona':
+            response = await token_obtain_pair(request)
+        else:
+            # Así ejecuta el servidor ASGI una vista síncrona: en el hilo compartido de sync_to_async
+            response = await sync_to_async(sync_view, thread_sensitive=True)(request)
+        if response.status_code != 200:
+            raise CommandError("Login de %s rechazado (%s)" % (username, response.status_code))
+        return (time.perf_counter() - start) * 1000
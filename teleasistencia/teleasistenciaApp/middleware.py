@@ -1,70 +1,197 @@
-import jwt
-from jwt.exceptions import InvalidTokenError
+import asyncio
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.contrib.auth.models import User
+from django.http import JsonResponse
+from django.utils.functional import SimpleLazyObject, empty
+from django.utils.timezone import now
 
 import json
 from urllib.parse import parse_qs
 
-from .models import Logs_AccionesUsuarios, Logs_ConexionesUsuarios
+from .models import Logs_AccionesUsuarios, Logs_ConexionesUsuarios, Database_User
+from .log_writer import log_writer
+from .authentication import CachedJWTAuthentication, user_cache
+from .rest_django.utils import getTenantByUser, tenant_cache
+from rest_framework.exceptions import AuthenticationFailed
+from .request_metrics import OTHER_ROUTE, start_request, finish_request, request_route, route_stats
+from .log_policy import log_policy
+from .routers import use_tenant
+from .db_pool import PoolTimeout, get_pool
 from utilidad.logging import info, error, yellow
+from utilidad.metricas import counter, histogram
+
+# Rutas cuyo body hay que guardar antes de procesar la petición (para sacar el username del login)
+LOGIN_BODY_PATHS = ('/api/token',)
+
+# Longitud máxima de la ruta guardada en Logs_AccionesUsuarios
+RUTA_MAX_LENGTH = Logs_AccionesUsuarios._meta.get_field('ruta').max_length
+
+_jwt_authentication = CachedJWTAuthentication()
+
+# Métricas de /metrics. Las etiquetas sólo toman valores de la URLconf y de estos métodos, así el número de series
+# no depende de las URLs ni de los métodos que envíen los clientes
+HTTP_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS', 'POST', 'PUT', 'PATCH', 'DELETE'))
+HTTP_PETICIONES = counter('teleasistencia_http_peticiones_total', 'Peticiones HTTP atendidas',
+                          ['ruta', 'metodo', 'estado'])
+HTTP_DURACION = histogram('teleasistencia_http_duracion_segundos', 'Duración de las peticiones HTTP',
+                          ['ruta', 'metodo'])
+
 
 class LoggingMiddleware:
     """
     Middleware encargado de loggear
+
+    Funciona tanto en modo síncrono (WSGI) como asíncrono (ASGI), así bajo ASGI no obliga a Django
+    a pasar la cadena de middlewares a un hilo en cada petición.
     """
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
+        # Si el siguiente eslabón es asíncrono, nos marcamos como corrutina (igual que MiddlewareMixin)
+        if asyncio.iscoroutinefunction(self.get_response):
+            self._is_coroutine = asyncio.coroutines._is_coroutine
 
     def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+
         # Guardar el body porque no puede ser accedido después de procesar la petición
-        req_body = request.body
-        # Procesar la petición y loggear (si es necesario)
+        req_body = _read_login_body(request)
+        # Procesar la petición midiendo tiempos y consultas, y loggear (si es necesario)
+        token = start_request()
         response = self.get_response(request)
-        log_request(request, req_body, response)
+        metrics = finish_request(token, response)
+        observe_request(request, response, metrics)
+        log_request(request, req_body, response, metrics)
 
         # En caso de no estar autorizado, el SecurityMiddleware habrá dado una respuesta adecuada
         return response
 
+    async def __acall__(self, request):
+        req_body = _read_login_body(request)
+        token = start_request()
+        response = await self.get_response(request)
+        metrics = finish_request(token, response)
+        observe_request(request, response, metrics)
+
+        # Los logs se encolan sin tocar la BBDD, sólo hace falta cambiar a un hilo si hay que buscar al usuario
+        if _needs_database(request):
+            await sync_to_async(log_request, thread_sensitive=True)(request, req_body, response, metrics)
+        else:
+            log_request(request, req_body, response, metrics)
+
+        return response
+
+
+def _read_login_body(request):
+    """
+    Devuelve el body de la petición sólo si es de login y no supera LOGS_LOGIN_BODY_MAX_SIZE.
+
+    Para el resto de rutas no se toca request.body, de forma que las subidas de ficheros (imágenes de usuario)
+    pasen por los upload handlers de Django sin cargarse enteras en memoria.
+    """
+    if not request.path.startswith(LOGIN_BODY_PATHS):
+        return None
+
+    try:
+        content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return None
+    if content_length > settings.LOGS_LOGIN_BODY_MAX_SIZE:
+        return None
+
+    return request.body
+
 
-def log_request(request, req_body, response):
+def _needs_database(request):
+    """
+    Indica si loggear la petición requiere consultar la BBDD (usuario de la sesión sin cargar o token sin resolver).
+    """
+    user = request.__dict__.get('user')
+    if user is None:
+        return False
+    if request.path.startswith('/api-rest') and not _action_log_wanted(request):
+        return False
+    if isinstance(user, SimpleLazyObject) and user._wrapped is empty:
+        return True
+    return not user.is_anonymous and user.pk is None
+
+
+def _action_log_wanted(request):
+    """
+    Decide (una sola vez por petición, el muestreo es aleatorio) si la acción se guarda según
+    settings.LOGS_ACCIONES_POLITICA.
+    """
+    wanted = getattr(request, '_log_accion', None)
+    if wanted is None:
+        wanted = request._log_accion = log_policy.should_log(request.method, request.path)
+    return wanted
+
+
+def observe_request(request, response, metrics):
+    # Sólo se etiquetan por ruta la API y el login, el resto (estáticos, media, admin) se agrupa en "otros"
+    ruta = request_route(request) if request.path.startswith(('/api-rest', '/api/')) else OTHER_ROUTE
+    metodo = request.method if request.method in HTTP_METHODS else OTHER_ROUTE
+    HTTP_PETICIONES.labels(ruta, metodo, response.status_code).inc()
+    HTTP_DURACION.labels(ruta, metodo).observe(metrics['duracion_ms'] / 1000)
+
+    # Las estadísticas por ruta incluyen también las peticiones que la política de logs no guarda
+    if request.path.startswith('/api-rest'):
+        route_stats.observe(request.method, request_route(request), metrics['duracion_ms'],
+                            metrics['num_consultas'], metrics['bytes_respuesta'])
+
+
+def log_request(request, req_body, response, metrics=None):
     # ##############  Ignorados ############## #
-    if request.path.startswith(('api-rest/password_reset/', 'api-rest/reset/')):
+    if request.path.startswith(('/api-rest/password_reset/', '/api-rest/reset/')):
         pass
     # ################ Logins ################ #
     elif request.path.startswith(('/api/token', '/admin/login', '/api-auth')):
         _log_loging_request(request, req_body, response)
     # ############### Acciones ############### #
-    else:
+    elif request.path.startswith('/api-rest'):
+        if not _action_log_wanted(request):
+            return
         _extract_user(request)
-        _log_action_request(request, response)
+        _log_action_request(request, response, metrics or {})
 
 
-def _log_action_request(request, response):
+def _log_action_request(request, response, metrics):
     path = request.path
     # ############### Acciones ############### #
     # Acciones realizadas en la Api-Rest
     if path.startswith('/api-rest') and request.user.pk is not None:
-        log = Logs_AccionesUsuarios(
+        log = dict(
+            timestamp=now(),
             direccion_ip=request.META.get('REMOTE_ADDR'),
-            user=request.user,
-            ruta=request.path,
+            user_id=request.user.pk,
+            ruta=request.path[:RUTA_MAX_LENGTH],
             query=request.META.get('QUERY_STRING', ''),
             metodo_http=request.method,
             estado_http=response.status_code,
+            **metrics
         )
 
-        log.save()  # Guardar el log en la BBDD
-        yellow("LoggingMiddleware", str(log))
+        # El INSERT lo hace el hilo escritor por lotes, fuera del ciclo de la petición
+        if log_writer.enqueue(Logs_AccionesUsuarios, log):
+            # El texto sólo se construye si la etiqueta LoggingMiddleware está activa (settings.UTILIDAD_LOGGING)
+            yellow("LoggingMiddleware", "[LOG_Accion] '%s' @ [%s] || %s %s%s%s => %s (%.1f ms, %s consultas)",
+                   request.user.username, log['direccion_ip'], log['metodo_http'], log['ruta'],
+                   '' if len(log['query']) <= 0 else '?', log['query'], log['estado_http'],
+                   metrics.get('duracion_ms', 0), metrics.get('num_consultas', 0))
+        else:
+            error("LoggingMiddleware: cola de logs llena, se descarta el log de %s", path)
 
 
 def _log_loging_request(request, req_body, response):
     path = request.path
-    req_body = req_body.decode().strip()
 
     # Crear el log
     log = Logs_ConexionesUsuarios(
+        timestamp=now(),
         direccion_ip=request.META.get('REMOTE_ADDR'),
     )
 
@@ -73,51 +200,193 @@ def _log_loging_request(request, req_body, response):
     if path.startswith('/api/token'):
         log.tipo_login = Logs_ConexionesUsuarios.TIPO_LOGIN_ENUM.TOKEN_API
         log.login_correcto = (response.status_code == 200)
+        log.bloqueado = (response.status_code == 429)
+        log.username = _extract_username(req_body) or ''
 
-        # Postman y Angular envia los datos como JSON, android como URLencoded
-        # Intentar parsear a los distintos tipos de dato
-        try:
-            req_body = json.loads(req_body)
-            log.username = req_body.get('username')
-        except ValueError:
-            req_body = parse_qs(req_body)
-            log.username = req_body.get('username', [None])[0]
-
-        log.save()  # Guardar el log en la BBDD
-        yellow("LoggingMiddleware", str(log))
+        _save_log(log)
 
         # Logins por panel de administración (las acciones se quedan registradas en otro lado)
     elif path.startswith('/admin/login') and request.method == "POST":
-        log.username = request.POST.get('username')
+        log.username = request.POST.get('username', '')
         log.tipo_login = Logs_ConexionesUsuarios.TIPO_LOGIN_ENUM.PANEL_ADMIN
         log.login_correcto = (response.status_code == 302)
 
-        log.save()  # Guardar el log en la BBDD
-        yellow("LoggingMiddleware", str(log))
+        _save_log(log)
 
     # Otros tipos de login
     # elif path.startswith('/api-auth'):
     #     pass
 
 
+def _extract_username(req_body):
+    """
+    Saca el username del body de una petición de login. Devuelve None si no se guardó el body (demasiado grande).
+    """
+    if req_body is None:
+        return None
+    req_body = req_body.decode(errors='replace').strip()
+
+    # Postman y Angular envia los datos como JSON, android como URLencoded
+    # Intentar parsear a los distintos tipos de dato
+    try:
+        req_body = json.loads(req_body)
+        return req_body.get('username')
+    except (ValueError, AttributeError):
+        req_body = parse_qs(req_body)
+        return req_body.get('username', [None])[0]
+
+
+def _save_log(log):
+    # El INSERT lo hace el hilo escritor, fuera del ciclo de la petición
+    if log_writer.enqueue(type(log), log):
+        yellow("LoggingMiddleware", "%s", log)
+    else:
+        error("LoggingMiddleware: cola de logs llena, se descarta %s", log)
+
+
 def _extract_user(request):
     """
-    Intenta extraer, a partir del campo "user_id" del token de autorización, el usuario
-    de la BBDD y lo guardamos internamente en la petición para propositos de logging.
+    Intenta extraer, a partir del token de autorización, el usuario y lo guardamos internamente en la petición
+    para propositos de logging. Si DRF ya autenticó la petición, request.user ya es el usuario y no se hace nada.
 
+    Usa la misma caché que la autenticación de DRF, así que normalmente no hace ninguna consulta.
     Devuelve True o False dependiendo de si el token era válido o no.
     """
     try:
         if not request.user.is_anonymous and request.user.pk is None:
-            # Si falla esta linea, es que el middleware de autenticación ya se ejecutó y no es necesario
-            jwt_token = request.META.get('HTTP_AUTHORIZATION', '').split(' ')[1]
-            payload = jwt.decode(jwt_token, settings.SECRET_KEY, algorithms=['HS256'])
-            user_id = payload.get('user_id')
+            result = _jwt_authentication.authenticate(request)
+            if result is None:
+                return False
 
             # Guardar el usuario si lo hemos conseguido extraer
-            request.user = User.objects.get(id=user_id)
+            request.user = result[0]
             return True
         else:
             return False
-    except (InvalidTokenError, IndexError):
+    except AuthenticationFailed:
+        return False
+
+
+class TenantDatabaseMiddleware:
+    """
+    Resuelve una sola vez por petición la base de datos (tenant) del usuario de la API REST y la guarda en
+    `request.database`, que es lo que devuelve rest_django.utils.getDatabaseByRequest. Además la fija como
+    tenant en curso durante la vista, para que TenantRouter dirija a ella las consultas de `Model.objects`,
+    y limita las peticiones simultáneas con cada BBDD (db_pool.py).
+
+    El usuario del token sale de la caché de CachedJWTAuthentication y la base de datos de `tenant_cache`,
+    así que normalmente no hace ninguna consulta. Si falla (token no válido, usuario sin base de datos)
+    no se asigna y la vista responde como hasta ahora.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(self.get_response):
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+
+        if request.path.startswith('/api-rest'):
+            _attach_database(request, allow_db=True)
+        database = getattr(request, 'database', None)
+        if database is None:
+            return self.get_response(request)
+
+        # Como mucho TENANT_CONNECTIONS['MAX_CONNECTIONS'] peticiones a la vez con cada BBDD (db_pool.py)
+        pool = get_pool(database)
+        try:
+            pool.acquire(settings.TENANT_CONNECTIONS['WAIT_TIMEOUT'])
+        except PoolTimeout:
+            return _pool_timeout_response(database)
+        try:
+            # Las consultas de la vista van a la BBDD del tenant (routers.TenantRouter)
+            with use_tenant(database):
+                return self.get_response(request)
+        finally:
+            pool.release()
+
+    async def __acall__(self, request):
+        if request.path.startswith('/api-rest'):
+            # Sólo se cambia a un hilo si hay que consultar la BBDD (fallo de caché)
+            if not _attach_database(request, allow_db=False):
+                await sync_to_async(_attach_database, thread_sensitive=True)(request, allow_db=True)
+        database = getattr(request, 'database', None)
+        if database is None:
+            return await self.get_response(request)
+
+        pool = get_pool(database)
+        if not pool.try_acquire():
+            # La espera se hace en otro hilo para no bloquear el bucle de eventos
+            try:
+                await sync_to_async(pool.acquire, thread_sensitive=False)(settings.TENANT_CONNECTIONS['WAIT_TIMEOUT'])
+            except PoolTimeout:
+                return _pool_timeout_response(database)
+        try:
+            # sync_to_async copia el contexto, así la vista ve el tenant aunque se ejecute en otro hilo
+            with use_tenant(database):
+                return await self.get_response(request)
+        finally:
+            pool.release()
+
+
+def _pool_timeout_response(database):
+    error("TenantDatabaseMiddleware: sin conexiones libres para la base de datos %s", database)
+    response = JsonResponse({'detail': 'Servicio saturado, inténtelo de nuevo en unos segundos.'}, status=503)
+    response['Retry-After'] = str(max(1, int(settings.TENANT_CONNECTIONS['WAIT_TIMEOUT'])))
+    return response
+
+
+def _attach_database(request, allow_db):
+    """
+    Guarda en request.database la base de datos del usuario. Devuelve False si hacía falta consultar la BBDD
+    y `allow_db` es False, True en el resto de casos (aunque no se haya podido resolver).
+    """
+    user = _request_user(request, allow_db)
+    if user is None:
+        return True
+    if user is _NEEDS_DB:
         return False
+
+    tenant = tenant_cache.get(user.pk)
+    if tenant is None:
+        if not allow_db:
+            return False
+        try:
+            tenant = getTenantByUser(user)
+        except Database_User.DoesNotExist:
+            return True
+    request.database = tenant.alias
+    return True
+
+
+_NEEDS_DB = object()
+
+
+def _request_user(request, allow_db):
+    if request.META.get('HTTP_AUTHORIZATION'):
+        header = _jwt_authentication.get_header(request)
+        try:
+            raw_token = _jwt_authentication.get_raw_token(header)
+            if raw_token is None:
+                return None
+            cached = user_cache.get(raw_token)
+            if cached is not None:
+                return cached[0]
+            if not allow_db:
+                return _NEEDS_DB
+            result = _jwt_authentication.authenticate(request)
+            return result[0] if result is not None else None
+        except AuthenticationFailed:
+            return None
+
+    # Sesión de Django (API navegable)
+    user = request.__dict__.get('user')
+    if user is None:
+        return None
+    if isinstance(user, SimpleLazyObject) and user._wrapped is empty and not allow_db:
+        return _NEEDS_DB
+    return user if user.is_authenticated else None
@@ -0,0 +1,36 @@
+# Generated by Django 3.2.3 on 2026-10-18 16:32
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('teleasistenciaApp', '0024_auto_20230516_0948'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='logs_accionesusuarios',
+            name='user',
+            field=models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.CreateModel(
+            name='Logs_ResumenDiario',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fecha', models.DateField()),
+                ('ruta', models.CharField(max_length=200)),
+                ('metodo_http', models.CharField(max_length=6)),
+                ('estado_http', models.CharField(max_length=10)),
+                ('total', models.IntegerField(default=0)),
+                ('user', models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('fecha', 'user', 'ruta', 'metodo_http', 'estado_http')},
+            },
+        ),
+    ]
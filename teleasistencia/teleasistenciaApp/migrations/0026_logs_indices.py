@@ -0,0 +1,38 @@
+# Generated by Django 3.2.3 on 2026-10-18 16:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('teleasistenciaApp', '0025_logs_resumendiario'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='logs_accionesusuarios',
+            name='ruta',
+            field=models.CharField(default='', max_length=255),
+        ),
+        migrations.AddIndex(
+            model_name='logs_accionesusuarios',
+            index=models.Index(fields=['user', 'timestamp'], name='logs_acc_user_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='logs_accionesusuarios',
+            index=models.Index(fields=['ruta', 'timestamp'], name='logs_acc_ruta_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='logs_accionesusuarios',
+            index=models.Index(fields=['timestamp'], name='logs_acc_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='logs_conexionesusuarios',
+            index=models.Index(fields=['username', 'timestamp'], name='logs_con_username_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='logs_conexionesusuarios',
+            index=models.Index(fields=['timestamp'], name='logs_con_ts_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.3 on 2026-10-18 16:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('teleasistenciaApp', '0026_logs_indices'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='logs_conexionesusuarios',
+            name='bloqueado',
+            field=models.BooleanField(default=False),
+        ),
+    ]
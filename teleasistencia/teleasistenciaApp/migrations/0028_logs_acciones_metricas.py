@@ -0,0 +1,33 @@
+# Generated by Django 3.2.3 on 2026-10-18 16:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('teleasistenciaApp', '0027_logs_conexiones_bloqueado'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='logs_accionesusuarios',
+            name='bytes_respuesta',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='logs_accionesusuarios',
+            name='duracion_consultas_ms',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='logs_accionesusuarios',
+            name='duracion_ms',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='logs_accionesusuarios',
+            name='num_consultas',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.2.3 on 2026-10-18 16:53
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('teleasistenciaApp', '0028_logs_acciones_metricas'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Aprovisionamiento_Base_Datos',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('estado', models.CharField(choices=[('Pendiente', 'Pendiente'), ('En curso', 'En curso'), ('Completado', 'Completado'), ('Error', 'Error')], default='Pendiente', max_length=20)),
+                ('paso', models.CharField(blank=True, max_length=100)),
+                ('progreso', models.PositiveSmallIntegerField(default=0)),
+                ('mensaje', models.CharField(blank=True, max_length=2000)),
+                ('fecha_inicio', models.DateTimeField(default=django.utils.timezone.now)),
+                ('fecha_fin', models.DateTimeField(blank=True, null=True)),
+                ('database', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='teleasistenciaApp.database')),
+            ],
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Índices de auth_user para la búsqueda por prefijo del directorio de usuarios (Directorio_Usuarios_ViewSet).
+# User es un modelo de django.contrib.auth, así que los índices se crean con el schema_editor (AddIndex sólo
+# sirve para los modelos de esta app).
+# La búsqueda no distingue mayúsculas (istartswith). En PostgreSQL es UPPER(campo::text) LIKE UPPER('texto%'): los
+# índices son de UPPER(campo) con text_pattern_ops, que sirven para LIKE con cualquier collation. En MySQL y SQLite
+# el LIKE ya no distingue mayúsculas y usa el índice del campo (username tiene el de su restricción UNIQUE).
+
+from django.contrib.postgres.indexes import OpClass
+from django.db import migrations, models
+from django.db.models.functions import Upper
+
+INDICES = (
+    models.Index(fields=['first_name'], name='auth_user_first_name_idx'),
+    models.Index(fields=['last_name'], name='auth_user_last_name_idx'),
+)
+
+INDICES_POSTGRESQL = tuple(
+    models.Index(OpClass(Upper(campo), name='text_pattern_ops'), name='auth_user_%s_upper_idx' % campo)
+    for campo in ('username', 'first_name', 'last_name')
+)
+
+
+def _indices(schema_editor):
+    return INDICES_POSTGRESQL if schema_editor.connection.vendor == 'postgresql' else INDICES
+
+
+def crear_indices(apps, schema_editor):
+    User = apps.get_model('auth', 'User')
+    for index in _indices(schema_editor):
+        schema_editor.add_index(User, index)
+
+
+def borrar_indices(apps, schema_editor):
+    User = apps.get_model('auth', 'User')
+    for index in _indices(schema_editor):
+        schema_editor.remove_index(User, index)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('teleasistenciaApp', '0029_aprovisionamiento_base_datos'),
+    ]
+
+    operations = [
+        migrations.RunPython(crear_indices, borrar_indices),
+    ]
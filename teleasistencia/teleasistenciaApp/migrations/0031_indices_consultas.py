@@ -0,0 +1,41 @@
+# Generated by Django 3.2.3 on 2026-10-18 17:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('teleasistenciaApp', '0030_auth_user_nombre_indices'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='agenda',
+            index=models.Index(fields=['fecha_resolucion', 'fecha_prevista'], name='agenda_resolucion_prev_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='agenda',
+            index=models.Index(fields=['fecha_prevista'], name='agenda_prevista_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='alarma',
+            index=models.Index(fields=['estado_alarma', 'fecha_registro'], name='alarma_estado_fecha_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='alarma',
+            index=models.Index(fields=['fecha_registro'], name='alarma_fecha_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='alarma_programada',
+            index=models.Index(fields=['fecha_registro'], name='alarma_prog_fecha_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='persona',
+            index=models.Index(fields=['dni'], name='persona_dni_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='terminal',
+            index=models.Index(fields=['numero_terminal'], name='terminal_numero_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.2.3 on 2026-10-18 18:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('teleasistenciaApp', '0031_indices_consultas'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='agenda',
+            index=models.Index(fields=['fecha_registro', 'id'], name='agenda_fecha_registro_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='persona_contacto_en_alarma',
+            index=models.Index(fields=['fecha_registro', 'id'], name='persona_alarma_fecha_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recursos_comunitarios_en_alarma',
+            index=models.Index(fields=['fecha_registro', 'id'], name='recurso_alarma_fecha_idx'),
+        ),
+    ]
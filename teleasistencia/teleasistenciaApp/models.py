@@ -10,6 +10,7 @@ from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 
 from utilidad.logging import info, error, blue
+from utilidad.metricas import counter, histogram
 
 # Para tratamiento de imagenes
 from io import BytesIO
@@ -28,17 +29,33 @@ class Logs_AccionesUsuarios(models.Model):
 
     timestamp = models.DateTimeField(null=False, default=now)
     direccion_ip = models.CharField(null=False, max_length=40)
-    user = models.ForeignKey(User, null=True, on_delete=models.SET_NULL)
+    # Sin restricción en BBDD: los logs pueden guardarse en una BBDD distinta (settings.LOGS_DATABASE)
+    # y se conservan aunque el usuario se borre
+    user = models.ForeignKey(User, null=True, on_delete=models.DO_NOTHING, db_constraint=False)
 
-    ruta = models.TextField(null=False, default="")
+    # Acotada para poder indexarla (MySQL no indexa columnas TEXT sin longitud de prefijo)
+    ruta = models.CharField(null=False, default="", max_length=255)
     query = models.TextField(null=False, default="")
     metodo_http = models.CharField(null=False, choices=METODOS_HTTP_ENUM, max_length=6)
     estado_http = models.CharField(null=False, max_length=10)
+    # Instrumentación de la petición (teleasistenciaApp/request_metrics.py)
+    duracion_ms = models.FloatField(null=True, blank=True)
+    num_consultas = models.IntegerField(null=True, blank=True)
+    duracion_consultas_ms = models.FloatField(null=True, blank=True)
+    bytes_respuesta = models.IntegerField(null=True, blank=True)
     # TODO: metadatos adicionales -> ubicacion, navegador, etc
 
+    class Meta:
+        # Índices para las consultas de la API de logs (filtrado por usuario/ruta y ordenación por fecha)
+        indexes = [
+            models.Index(fields=['user', 'timestamp'], name='logs_acc_user_ts_idx'),
+            models.Index(fields=['ruta', 'timestamp'], name='logs_acc_ruta_ts_idx'),
+            models.Index(fields=['timestamp'], name='logs_acc_ts_idx'),
+        ]
+
     def __str__(self):
         return "[LOG_Accion][%s] '%s' @ [%s] [%s] || %s %s%s => %s" % (
-            self.id, self.user.username, self.direccion_ip, self.timestamp,
+            self.id, _username_log(self), self.direccion_ip, self.timestamp,
             self.metodo_http, self.ruta, ('' if len(self.query) <= 0 else '?') + self.query, self.estado_http
         )
 
@@ -53,16 +70,61 @@ class Logs_ConexionesUsuarios(models.Model):
 
     username = models.CharField(null=False, max_length=150)
     login_correcto = models.BooleanField(null=False, default=False)
+    # Intento rechazado por superar el límite de intentos (teleasistenciaApp/login_throttle.py)
+    bloqueado = models.BooleanField(null=False, default=False)
     tipo_login = models.CharField(null=False, choices=TIPO_LOGIN_ENUM, max_length=15)
     # TODO: metadatos adicionales -> ubicacion, navegador, etc
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['username', 'timestamp'], name='logs_con_username_ts_idx'),
+            models.Index(fields=['timestamp'], name='logs_con_ts_idx'),
+        ]
+
     def __str__(self):
-        return "[LOG_Sesion][%s] '%s' @ [%s] [%s] || [%s] Login Correcto: %s" % (
+        return "[LOG_Sesion][%s] '%s' @ [%s] [%s] || [%s] Login Correcto: %s%s" % (
             self.id, self.username, self.direccion_ip, self.timestamp,
-            self.tipo_login, self.login_correcto
+            self.tipo_login, self.login_correcto, ' (bloqueado)' if self.bloqueado else ''
+        )
+
+
+class Logs_ResumenDiario(models.Model):
+    """
+    Resumen diario de Logs_AccionesUsuarios: número de peticiones por usuario, ruta, método y estado.
+
+    Se rellena con el trabajo de retención de logs (teleasistenciaApp/logs_archive.py), de forma que las estadísticas
+    siguen disponibles aunque los logs detallados se hayan archivado.
+    """
+    fecha = models.DateField(null=False)
+    user = models.ForeignKey(User, null=True, on_delete=models.DO_NOTHING, db_constraint=False)
+    ruta = models.CharField(null=False, max_length=200)
+    metodo_http = models.CharField(null=False, max_length=6)
+    estado_http = models.CharField(null=False, max_length=10)
+    total = models.IntegerField(null=False, default=0)
+
+    class Meta:
+        unique_together = ('fecha', 'user', 'ruta', 'metodo_http', 'estado_http')
+
+    def __str__(self):
+        return "[LOG_Resumen][%s] '%s' || %s %s => %s: %s" % (
+            self.fecha, _username_log(self), self.metodo_http, self.ruta, self.estado_http, self.total
         )
 
 
+def _username_log(log):
+    # El usuario puede no existir (borrado) y los logs se conservan igualmente
+    try:
+        return log.user.username if log.user_id is not None else None
+    except User.DoesNotExist:
+        return "#%s" % log.user_id
+
+
+# Métricas de /metrics
+ALARMAS_CREADAS = counter('teleasistencia_alarmas_creadas_total', 'Alarmas creadas')
+ALARMAS_NOTIFICADAS = counter('teleasistencia_alarmas_notificadas_total', 'Notificaciones de alarmas enviadas a los teleoperadores', ['accion'])
+MINIFICACION_DURACION = histogram('teleasistencia_minificacion_imagen_segundos', 'Tiempo de minificación de las imágenes de usuario')
+
+
 # Creamos la clase imagen con los atributos usuario e imagen
 class Imagen_User(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
@@ -77,7 +139,8 @@ class Imagen_User(models.Model):
 
         # Intentamos minificar la imagen
         try:
-            self._minificar()
+            with MINIFICACION_DURACION.time():
+                self._minificar()
         except Exception as e:
             error(f"Fallo al intentar minificar imagen: {e}")
 
@@ -127,6 +190,19 @@ class Database_User(models.Model):
    def __str__(self):
         return self.database.nameDescritive+": "+self.user.username+" - "+self.database.name
 
+# Alta de una base de datos nueva en segundo plano (teleasistenciaApp/provisioning.py)
+class Aprovisionamiento_Base_Datos(models.Model):
+    database = models.ForeignKey(Database, on_delete=models.CASCADE)
+    ESTADO_ENUM = Choices("Pendiente", "En curso", "Completado", "Error")
+    estado = models.CharField(choices=ESTADO_ENUM, default=ESTADO_ENUM.Pendiente, max_length=20)
+    paso = models.CharField(max_length=100, blank=True)
+    progreso = models.PositiveSmallIntegerField(default=0)  # Porcentaje
+    mensaje = models.CharField(max_length=2000, blank=True)
+    fecha_inicio = models.DateTimeField(null=False, default=now)
+    fecha_fin = models.DateTimeField(null=True, blank=True)
+    def __str__(self):
+        return self.database.nameDescritive+": "+self.estado+" - "+str(self.progreso)+"%"
+
 class Tipo_Agenda(models.Model):
     nombre = models.CharField(max_length=200)
     codigo = models.CharField(max_length=100)
@@ -196,6 +272,12 @@ class Persona(models.Model):
     def __str__(self):
         return self.nombre+" "+self.apellidos+" "+self.dni
 
+    class Meta:
+        # Búsqueda de la persona por DNI (/api-rest/paciente?dni=, /api-rest/terminal?dni=)
+        indexes = [
+            models.Index(fields=['dni'], name='persona_dni_idx'),
+        ]
+
 class Tipo_Modalidad_Paciente(models.Model):
     nombre = models.CharField(max_length=200, null=False)
     def __str__(self):
@@ -256,6 +338,13 @@ class Terminal(models.Model):
     modelo_terminal = models.CharField(max_length=400, blank=True)
     id_tipo_situacion = models.ForeignKey(Tipo_Situacion, null=True, on_delete=models.SET_NULL)
     fecha_tipo_situacion = models.DateField(null=True, default=now)
+
+    class Meta:
+        # Búsqueda del terminal por su número
+        indexes = [
+            models.Index(fields=['numero_terminal'], name='terminal_numero_idx'),
+        ]
+
     def __str__(self):
         if self.id_titular:
             return self.numero_terminal+" - "+self.id_titular.id_persona.nombre
@@ -278,6 +367,16 @@ class Agenda(models.Model):
     fecha_prevista = models.DateTimeField(null=False)
     fecha_resolucion = models.DateTimeField(null=True, blank=True)
     observaciones = models.CharField(max_length=4000, blank=True)
+
+    class Meta:
+        # Agendas pendientes (sin fecha_resolucion) por fecha prevista y agendas de un día o rango de fechas
+        indexes = [
+            models.Index(fields=['fecha_resolucion', 'fecha_prevista'], name='agenda_resolucion_prev_idx'),
+            models.Index(fields=['fecha_prevista'], name='agenda_prevista_idx'),
+            # Paginación por cursor de la API (cursor_ordering)
+            models.Index(fields=['fecha_registro', 'id'], name='agenda_fecha_registro_idx'),
+        ]
+
     def __str__(self):
         if self.id_tipo_agenda:
             return self.id_paciente.id_persona.nombre+" "+self.id_paciente.id_persona.apellidos+" "+self.id_paciente.id_persona.dni+" - "+self.id_tipo_agenda.nombre
@@ -311,6 +410,14 @@ class Alarma(models.Model):
     id_terminal = models.ForeignKey(Terminal, null=True, on_delete=models.SET_NULL, blank=True)  # OJO: Puede ser null si no lo avisó un terminal
     observaciones = models.CharField(max_length=10000, blank=True)
     resumen = models.CharField(max_length=10000, blank=True)
+
+    class Meta:
+        # Alarmas abiertas/cerradas por fecha, alarmas de un día (?fecha_registro=) y paginación por fecha
+        indexes = [
+            models.Index(fields=['estado_alarma', 'fecha_registro'], name='alarma_estado_fecha_idx'),
+            models.Index(fields=['fecha_registro'], name='alarma_fecha_idx'),
+        ]
+
     def __str__(self):
         if self.id_tipo_alarma:
             return self.id_tipo_alarma.nombre + " - " + self.estado_alarma + " - " + str(self.fecha_registro)
@@ -326,6 +433,7 @@ class Alarma(models.Model):
 
         # Si es nuevo, notificar
         if is_new:
+            ALARMAS_CREADAS.inc()
             # Notificar a los clientes
             self.notify('new_alarm')
 
@@ -338,6 +446,7 @@ class Alarma(models.Model):
             'teleoperadores',
             {"type": "notify.clients", "action": accion, "alarma": alarma_serializer.data},
         )
+        ALARMAS_NOTIFICADAS.labels(accion).inc()
 
      
 class Alarma_Programada(models.Model):
@@ -349,6 +458,13 @@ class Alarma_Programada(models.Model):
     
     id_paciente_ucr = models.ForeignKey(Paciente, null=True, on_delete=models.SET_NULL, blank=True)  # OJO: Puede ser null si no lo avisó un paciente
     id_terminal = models.ForeignKey(Terminal, null=True, on_delete=models.SET_NULL, blank=True)      # OJO: Puede ser null si no lo avisó un terminal
+
+    class Meta:
+        # El scheduler busca cada minuto las que ya han vencido (fecha_registro <= ahora)
+        indexes = [
+            models.Index(fields=['fecha_registro'], name='alarma_prog_fecha_idx'),
+        ]
+
     def __str__(self):
         return "[Programada] %s - %s" % (self.id_tipo_alarma.nombre, str(self.fecha_registro))
 
@@ -369,12 +485,19 @@ class Alarma_Programada(models.Model):
             self.delete()
             blue("TeleasistenciaApp", f"Alarma Disparada: {self}")
         except Exception as e:
-            error("TeleasistenciaApp", f"Hubo un error al disparar la alarma: {e}")
+            error("[TeleasistenciaApp] Hubo un error al disparar la alarma: %s", e)
 
 class Persona_Contacto_En_Alarma(models.Model):
     id_alarma = models.ForeignKey(Alarma, null=True, on_delete=models.SET_NULL)
     id_persona_contacto = models.ForeignKey(Relacion_Paciente_Persona, null=True, on_delete=models.SET_NULL)
     fecha_registro = models.DateTimeField(null=False, default=now)
+
+    class Meta:
+        # Paginación por cursor de la API (cursor_ordering)
+        indexes = [
+            models.Index(fields=['fecha_registro', 'id'], name='persona_alarma_fecha_idx'),
+        ]
+
     def __str__(self):
         return self.id_alarma.id_tipo_alarma.nombre+" - "+self.id_alarma.estado_alarma+" - "+str(self.id_alarma.fecha_registro)+" "+self.id_persona_contacto.nombre+" - "+str(self.fecha_registro)
 
@@ -382,6 +505,13 @@ class Recursos_Comunitarios_En_Alarma(models.Model):
     id_alarma = models.ForeignKey(Alarma, null=True, on_delete=models.SET_NULL)
     id_recurso_comunitario = models.ForeignKey(Recurso_Comunitario, null=True, on_delete=models.SET_NULL)
     fecha_registro = models.DateTimeField(null=False, default=now)
+
+    class Meta:
+        # Paginación por cursor de la API (cursor_ordering)
+        indexes = [
+            models.Index(fields=['fecha_registro', 'id'], name='recurso_alarma_fecha_idx'),
+        ]
+
     def __str__(self):
         if self.id_alarma and self.id_alarma.id_tipo_alarma:
             return self.id_alarma.id_tipo_alarma.nombre+" - "+self.id_alarma.estado_alarma+" - "+str(self.id_alarma.fecha_registro)+" - "+str(self.fecha_registro)
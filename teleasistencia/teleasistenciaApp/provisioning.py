@@ -0,0 +1,219 @@
+"""
+Alta de la base de datos de un centro nuevo en segundo plano.
+
+`start_provisioning(database)` crea un Aprovisionamiento_Base_Datos y lo ejecuta en un hilo aparte (uno cada vez),
+así la petición responde al momento y el progreso se consulta en /api-rest/aprovisionamiento_base_datos. Pasos:
+
+1. Crear la BBDD: el fichero en sqlite o la base de datos en PostgreSQL/MySQL (si no existe ya).
+2. Registrarla en todos los procesos (databases.notify_changed), después de comprobar que responde.
+3. Aplicar las migraciones, con el progreso de cada una.
+4. Copiar los catálogos (tipos de alarma, de vivienda...) de la BBDD principal.
+5. Copiar los usuarios administradores.
+
+Todos los pasos se pueden repetir, así que un alta que ha fallado se vuelve a lanzar sin borrar nada. Un alta que
+se quedó a medias porque se reinició el proceso (sigue 'Pendiente' o 'En curso' pasado
+settings.APROVISIONAMIENTO_TIMEOUT) se marca como 'Error' (`expire_stale_jobs`) para poder lanzarla otra vez.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.color import no_style
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.migrations.executor import MigrationExecutor
+from django.db.utils import ConnectionHandler
+from django.utils.timezone import now
+
+from utilidad.logging import error, green
+
+from . import databases
+from .models import (
+    Aprovisionamiento_Base_Datos, Clasificacion_Alarma, Tipo_Alarma, Tipo_Agenda, Clasificacion_Recurso_Comunitario,
+    Tipo_Recurso_Comunitario, Tipo_Modalidad_Paciente, Tipo_Vivienda, Tipo_Situacion,
+)
+
+# Catálogos que se copian de la BBDD principal, en orden de dependencias (claves ajenas)
+CATALOG_MODELS = (
+    Clasificacion_Alarma, Tipo_Alarma, Tipo_Agenda, Clasificacion_Recurso_Comunitario, Tipo_Recurso_Comunitario,
+    Tipo_Modalidad_Paciente, Tipo_Vivienda, Tipo_Situacion,
+)
+
+# Porcentaje de progreso con el que empieza cada paso
+_PASOS = (
+    ('Crear base de datos', 0),
+    ('Registrar conexión', 5),
+    ('Migraciones', 10),
+    ('Catálogos', 80),
+    ('Usuarios administradores', 95),
+)
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='Aprovisionamiento')
+# ids de los trabajos en cola o en curso en este proceso (no se dan por perdidos aunque tarden)
+_active = set()
+_active_lock = threading.Lock()
+
+
+def start_provisioning(database):
+    """
+    Crea el trabajo de alta de `database` y lo pone en cola. Devuelve el Aprovisionamiento_Base_Datos.
+    """
+    job = Aprovisionamiento_Base_Datos.objects.create(database=database)
+    with _active_lock:
+        _active.add(job.pk)
+    _executor.submit(run_provisioning, job.pk)
+    return job
+
+
+def expire_stale_jobs(database=None):
+    """
+    Marca como 'Error' las altas sin terminar que empezaron hace más de settings.APROVISIONAMIENTO_TIMEOUT segundos
+    y no están en este proceso (el proceso que las ejecutaba se reinició). Devuelve cuántas se han marcado.
+    """
+    queryset = Aprovisionamiento_Base_Datos.objects.filter(
+        estado__in=['Pendiente', 'En curso'],
+        fecha_inicio__lt=now() - timedelta(seconds=settings.APROVISIONAMIENTO_TIMEOUT))
+    if database is not None:
+        queryset = queryset.filter(database=database)
+    with _active_lock:
+        queryset = queryset.exclude(pk__in=list(_active))
+    return queryset.update(estado='Error', fecha_fin=now(),
+                           mensaje="El alta no terminó (se reinició el servidor), se puede volver a lanzar")
+
+
+def run_provisioning(job_id):
+    try:
+        _run(job_id)
+    finally:
+        with _active_lock:
+            _active.discard(job_id)
+
+
+def _run(job_id):
+    job = Aprovisionamiento_Base_Datos.objects.select_related('database').get(pk=job_id)
+    try:
+        alias = job.database.nameDescritive
+        settings_dict = databases.database_settings(job.database)
+
+        _step(job, 0)
+        create_database(settings_dict)
+
+        _step(job, 1)
+        problems = databases.notify_changed()
+        if alias not in connections.databases:
+            raise RuntimeError(problems.get(alias, "La base de datos %s no se ha registrado" % alias))
+
+        _step(job, 2)
+        _migrate(job, alias)
+
+        _step(job, 3)
+        copy_rows(alias, [(model, model.objects.using(DEFAULT_DB_ALIAS).all()) for model in CATALOG_MODELS])
+
+        _step(job, 4)
+        copy_rows(alias, [(User, User.objects.using(DEFAULT_DB_ALIAS).filter(groups__name='administrador'))])
+
+        job.estado = 'Completado'
+        job.progreso = 100
+        job.mensaje = ''
+        green("TeleasistenciaApp", "Base de datos %s dada de alta", alias)
+    except Exception as e:
+        error("[TeleasistenciaApp] Error en el alta de la base de datos %s: %s", job.database, e)
+        job.estado = 'Error'
+        job.mensaje = str(e)[:2000]
+    finally:
+        job.fecha_fin = now()
+        job.save(update_fields=['estado', 'paso', 'progreso', 'mensaje', 'fecha_fin'])
+        # Este hilo no pasa por el ciclo de una petición: se cierran aquí sus conexiones
+        connections.close_all()
+
+
+def _step(job, index, progreso=None, mensaje=''):
+    job.paso, inicio = _PASOS[index]
+    job.estado = 'En curso'
+    job.progreso = inicio if progreso is None else progreso
+    job.mensaje = mensaje
+    job.save(update_fields=['estado', 'paso', 'progreso', 'mensaje'])
+
+
+# ============================ Pasos ============================ #
+def create_database(settings_dict):
+    """
+    Crea el fichero sqlite o la base de datos de PostgreSQL/MySQL si no existe todavía.
+    """
+    engine = settings_dict['ENGINE']
+    name = settings_dict['NAME']
+    if 'sqlite' in engine:
+        os.makedirs(os.path.dirname(name) or '.', exist_ok=True)
+        # Un fichero vacío es una BBDD sqlite válida
+        open(name, 'a').close()
+        return
+
+    if 'postgresql' in engine:
+        server = dict(settings_dict, NAME='postgres')
+        exists_sql = "SELECT 1 FROM pg_database WHERE datname = %s"
+    elif 'mysql' in engine:
+        server = dict(settings_dict, NAME='')
+        exists_sql = "SELECT 1 FROM information_schema.schemata WHERE schema_name = %s"
+    else:
+        # Otros motores: se espera que la BBDD ya exista
+        return
+
+    handler = ConnectionHandler({DEFAULT_DB_ALIAS: server})
+    try:
+        connection = handler[DEFAULT_DB_ALIAS]
+        with connection.cursor() as cursor:
+            cursor.execute(exists_sql, [name])
+            if cursor.fetchone() is None:
+                cursor.execute("CREATE DATABASE %s" % connection.ops.quote_name(name))
+    finally:
+        handler.close_all()
+
+
+class _MigrationProgress:
+    """
+    Salida de `migrate` que actualiza el progreso del trabajo con cada migración aplicada.
+    """
+
+    def __init__(self, job, total):
+        self.job = job
+        self.total = max(total, 1)
+        self.applied = 0
+
+    def write(self, text):
+        if 'Applying ' in text:
+            self.applied += 1
+            inicio, fin = _PASOS[2][1], _PASOS[3][1]
+            progreso = inicio + (fin - inicio) * (self.applied - 1) // self.total
+            _step(self.job, 2, progreso, text.strip())
+
+    def flush(self):
+        pass
+
+
+def _migrate(job, alias):
+    executor = MigrationExecutor(connections[alias])
+    total = len(executor.migration_plan(executor.loader.graph.leaf_nodes()))
+    call_command('migrate', database=alias, interactive=False, verbosity=1,
+                 stdout=_MigrationProgress(job, total))
+
+
+def copy_rows(alias, rows_by_model):
+    """
+    Copia las filas [(modelo, queryset o lista de instancias)] con sus mismas claves a la BBDD `alias`,
+    sin tocar las que ya existan.
+    """
+    copied = []
+    for model, rows in rows_by_model:
+        model.objects.using(alias).bulk_create(list(rows), batch_size=500, ignore_conflicts=True)
+        copied.append(model)
+
+    # Al insertar claves explícitas hay que poner al día las secuencias (PostgreSQL, Oracle)
+    connection = connections[alias]
+    statements = connection.ops.sequence_reset_sql(no_style(), copied)
+    if statements:
+        with connection.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
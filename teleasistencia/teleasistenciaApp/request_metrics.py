@@ -0,0 +1,174 @@
+"""
+Instrumentación de las peticiones: tiempo total, número y tiempo de las consultas a BBDD y tamaño de la respuesta.
+
+- El LoggingMiddleware abre una medición por petición (`start_request` / `finish_request`) y guarda los valores
+  en Logs_AccionesUsuarios.
+- Las consultas se cuentan con un `execute_wrapper` que se instala en cada conexión al crearse
+  (señal connection_created). La medición activa viaja en una ContextVar, así también se cuentan las consultas
+  que se ejecutan en el hilo de `sync_to_async` bajo ASGI.
+- Cada proceso guarda además una muestra acotada de duraciones por ruta (`route_stats`) para calcular
+  percentiles sin consultar la BBDD. La ruta es la de la URLconf que atendió la petición (`request_route`), no
+  la URL pedida, así el número de rutas no depende de lo que pidan los clientes.
+"""
+import functools
+import random
+import re
+import threading
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+
+# Ruta de las peticiones que no resuelve la URLconf (404) y de las rutas por encima del límite
+OTHER_ROUTE = 'otros'
+
+_current = ContextVar('request_metrics', default=None)
+
+
+class RequestMetrics:
+    __slots__ = ('start', 'queries', 'query_time')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.query_time = 0.0
+
+
+# ========================= Consultas a BBDD ========================= #
+def query_counter(execute, sql, params, many, context):
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.queries += 1
+        metrics.query_time += time.perf_counter() - start
+
+
+def install_query_counter(sender, connection, **kwargs):
+    """
+    Receptor de `connection_created`: la misma conexión puede reconectarse, así que sólo se añade una vez.
+    """
+    if query_counter not in connection.execute_wrappers:
+        connection.execute_wrappers.append(query_counter)
+
+
+# ========================= Peticiones ========================= #
+def start_request():
+    return _current.set(RequestMetrics())
+
+
+def finish_request(token, response):
+    """
+    Cierra la medición de la petición y devuelve un diccionario con los campos de Logs_AccionesUsuarios.
+    """
+    metrics = _current.get()
+    _current.reset(token)
+
+    # Las respuestas en streaming (ficheros) no se leen para no consumirlas
+    size = None if response.streaming else len(response.content)
+    return dict(
+        duracion_ms=(time.perf_counter() - metrics.start) * 1000,
+        num_consultas=metrics.queries,
+        duracion_consultas_ms=metrics.query_time * 1000,
+        bytes_respuesta=size,
+    )
+
+
+# ========================= Estadísticas por ruta ========================= #
+_ROUTE_GROUP = re.compile(r'\(\?P<(\w+)>[^)]*\)|<(?:\w+:)?(\w+)>')
+
+
+def request_route(request):
+    """
+    Ruta de la URLconf que ha atendido la petición ('/api-rest/alarma/{pk}') u OTHER_ROUTE si no se ha resuelto.
+    """
+    match = getattr(request, 'resolver_match', None)
+    if match is None or not match.route:
+        return OTHER_ROUTE
+    return _clean_route(match.route)
+
+
+@functools.lru_cache(maxsize=None)
+def _clean_route(route):
+    # Las rutas salen de la URLconf, así que la caché no crece más que el número de URLs definidas
+    route = _ROUTE_GROUP.sub(lambda m: '{%s}' % (m.group(1) or m.group(2)), route)
+    return '/' + route.replace('^', '').replace('$', '')
+
+
+class RouteStats:
+    """
+    Muestra por ruta (método + ruta de la URLconf) de las últimas peticiones, con muestreo de reservorio para que
+    la memoria no crezca con el número de peticiones. Como mucho se guardan `max_routes` rutas, las siguientes
+    se acumulan en OTHER_ROUTE.
+    """
+
+    def __init__(self, reservoir_size, max_routes=500):
+        self.reservoir_size = reservoir_size
+        self.max_routes = max_routes
+        self._routes = {}
+        self._lock = threading.Lock()
+
+    def observe(self, method, route, duracion_ms, num_consultas, bytes_respuesta):
+        key = (method, route)
+        with self._lock:
+            stats = self._routes.get(key)
+            if stats is None:
+                if len(self._routes) >= self.max_routes:
+                    key = (method, OTHER_ROUTE)
+                    stats = self._routes.get(key)
+                if stats is None:
+                    stats = self._routes[key] = {'count': 0, 'samples': [], 'queries': 0, 'bytes': 0}
+            stats['count'] += 1
+            stats['queries'] += num_consultas
+            stats['bytes'] += bytes_respuesta or 0
+
+            samples = stats['samples']
+            if len(samples) < self.reservoir_size:
+                samples.append(duracion_ms)
+            else:
+                i = random.randrange(stats['count'])
+                if i < self.reservoir_size:
+                    samples[i] = duracion_ms
+
+    def summary(self):
+        """
+        Devuelve, por ruta, el número de peticiones, los percentiles 50/95/99 de duración (ms) y las medias
+        de consultas y bytes por petición. Ordenado de más lenta a más rápida (p95).
+        """
+        with self._lock:
+            routes = [(key, dict(stats, samples=sorted(stats['samples']))) for key, stats in self._routes.items()]
+
+        result = []
+        for (method, route), stats in routes:
+            samples = stats['samples']
+            result.append({
+                'ruta': route,
+                'metodo_http': method,
+                'peticiones': stats['count'],
+                'p50_ms': round(_percentile(samples, 50), 2),
+                'p95_ms': round(_percentile(samples, 95), 2),
+                'p99_ms': round(_percentile(samples, 99), 2),
+                'consultas_media': round(stats['queries'] / stats['count'], 2),
+                'bytes_media': round(stats['bytes'] / stats['count']),
+            })
+        result.sort(key=lambda r: r['p95_ms'], reverse=True)
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._routes.clear()
+
+
+def _percentile(sorted_samples, percent):
+    if not sorted_samples:
+        return 0
+    index = min(len(sorted_samples) - 1, int(round(percent / 100 * (len(sorted_samples) - 1))))
+    return sorted_samples[index]
+
+
+route_stats = RouteStats(getattr(settings, 'REQUEST_METRICS_RESERVOIR_SIZE', 1024),
+                         getattr(settings, 'REQUEST_METRICS_MAX_ROUTES', 500))
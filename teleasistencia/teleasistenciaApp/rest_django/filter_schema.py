@@ -0,0 +1,247 @@
+"""
+Filtros GET de las vistas v1, declarados y validados.
+
+Cada ViewSet puede declarar `filter_schema = FilterSchema(Modelo, {...}, ordering=(...))`; si no lo hace se usa
+`default_schema(modelo)`, con los campos indexados del modelo. Los parámetros tienen la forma de siempre,
+`campo` o `campo__lookup` (p. ej. ?id_terminal=3, ?id=1,2,3 con `in`, ?fecha_registro__gte=2024-01-01):
+
+- Sólo se admiten los campos y lookups del esquema: cualquier otro parámetro devuelve un 400 con los filtros
+  permitidos. Los parámetros de PARAMETROS_RESERVADOS (paginación, campos de la respuesta...) no son filtros.
+- Sólo se pueden declarar campos con índice (clave primaria, ForeignKey, unique, db_index o primer campo de un
+  índice de Meta): un filtro sin índice es un recorrido de la tabla entera. Se comprueba al declarar el esquema.
+- Los valores se convierten con el campo del modelo (to_python): un valor incorrecto es un 400, no un 500.
+- Lookups: exact, in, gt, gte, lt, lte, range (dos valores separados por coma), isnull y date (en DateTimeField
+  se traduce a un rango del día, que sí usa el índice).
+- ?ordering=-campo,campo ordena por los campos de `ordering` del esquema (también indexados).
+
+Lo que se compila (campo, lookup y conversión de cada parámetro) se guarda por forma de la petición, es decir,
+por el conjunto de nombres de parámetros, así cada combinación se analiza una vez.
+"""
+import datetime
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import models
+from django.db.models import Q
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+
+from .utils import PARAMETROS_RESERVADOS, normalizar_booleano
+
+ORDERING_PARAM = 'ordering'
+
+# Formas de petición distintas que se guardan compiladas por esquema
+MAX_COMPILED_SHAPES = 256
+
+_SCALAR_LOOKUPS = ('exact', 'in')
+_RANGE_LOOKUPS = ('exact', 'in', 'gt', 'gte', 'lt', 'lte', 'range')
+
+
+class Filter:
+    """
+    Filtro de un esquema: `lookups` admitidos (el primero es el de `?campo=` sin lookup) y, si el parámetro
+    no se llama como el campo, el camino del ORM en `path` (p. ej. 'id_persona__dni').
+    """
+
+    def __init__(self, lookups=('exact', 'in'), path=None):
+        self.lookups = tuple(lookups)
+        self.path = path
+
+
+def indexed_fields(model):
+    """
+    Nombres de los campos de `model` que tienen un índice que empieza por ellos.
+    """
+    names = set()
+    for field in model._meta.concrete_fields:
+        if field.primary_key or field.unique or field.db_index:
+            names.add(field.name)
+    for index in model._meta.indexes:
+        names.add(index.fields[0].lstrip('-'))
+    for fields in tuple(model._meta.index_together) + tuple(model._meta.unique_together):
+        names.add(fields[0])
+    return names
+
+
+def _resolve(model, path):
+    """
+    Devuelve (modelo, campo) del último paso de `path`. Los pasos intermedios son relaciones (JOIN por clave).
+    """
+    names = path.split('__')
+    for name in names[:-1]:
+        model = model._meta.get_field(name).related_model
+        if model is None:
+            raise FieldDoesNotExist("%s no es una relación" % name)
+    return model, model._meta.get_field(names[-1])
+
+
+class FilterSchema:
+
+    def __init__(self, model, filters, ordering=('id',)):
+        self.model = model
+        self.filters = {}
+        for param, spec in filters.items():
+            spec = spec if isinstance(spec, Filter) else Filter(spec)
+            path = spec.path or param
+            try:
+                field_model, field = _resolve(model, path)
+            except FieldDoesNotExist as e:
+                raise ImproperlyConfigured("Filtro %s de %s: %s" % (param, model.__name__, e))
+            if field.name not in indexed_fields(field_model):
+                raise ImproperlyConfigured("Filtro %s de %s: %s.%s no tiene índice"
+                                           % (param, model.__name__, field_model.__name__, field.name))
+            self.filters[param] = (path, field, spec.lookups)
+
+        self.ordering = tuple(ordering)
+        for name in self.ordering:
+            if name not in indexed_fields(model):
+                raise ImproperlyConfigured("Orden %s de %s: el campo no tiene índice" % (name, model.__name__))
+        self._compiled = {}
+
+    # ========================= Filtros ========================= #
+    def query(self, params):
+        """
+        Q con los filtros de `params` (QueryDict) o None si no hay ninguno. Lanza ValidationError (400).
+        """
+        keys = tuple(sorted(key for key in params if key not in PARAMETROS_RESERVADOS))
+        if not keys:
+            return None
+        compiled = self._compiled.get(keys)
+        if compiled is None:
+            compiled = self._compile(keys)
+            if len(self._compiled) >= MAX_COMPILED_SHAPES:
+                self._compiled.clear()
+            self._compiled[keys] = compiled
+        if isinstance(compiled, dict):
+            raise ValidationError(compiled)
+
+        query = Q()
+        errors = {}
+        for key, build in compiled:
+            try:
+                query &= build(params[key])
+            except (DjangoValidationError, ValueError, TypeError) as e:
+                errors[key] = getattr(e, 'messages', None) or [str(e)]
+        if errors:
+            raise ValidationError(errors)
+        return query
+
+    def _compile(self, keys):
+        # Lista de (parámetro, función valor -> Q), o el diccionario de errores si la forma no es válida
+        compiled, errors = [], {}
+        for key in keys:
+            param, _, lookup = key.partition('__')
+            if param not in self.filters:
+                param, lookup = key, ''
+            spec = self.filters.get(param)
+            if spec is None:
+                errors[key] = "Filtro no permitido. Filtros: %s" % ', '.join(sorted(self.filters))
+                continue
+            path, field, lookups = spec
+            lookup = lookup or lookups[0]
+            if lookup not in lookups:
+                errors[key] = "Lookup no permitido en %s. Lookups: %s" % (param, ', '.join(lookups))
+                continue
+            compiled.append((key, _builder(path, field, lookup)))
+        return errors or compiled
+
+    # ========================= Orden ========================= #
+    def order_by(self, params):
+        """
+        Campos de ?ordering= (validados) o None si no se ha pedido.
+        """
+        value = params.get(ORDERING_PARAM)
+        if not value:
+            return None
+        ordering = [name.strip() for name in value.split(',') if name.strip()]
+        invalid = [name for name in ordering if name.lstrip('-') not in self.ordering]
+        if invalid:
+            raise ValidationError({ORDERING_PARAM: "No se puede ordenar por %s. Campos: %s"
+                                                   % (', '.join(invalid), ', '.join(self.ordering))})
+        return ordering
+
+
+# ========================= Conversión de valores ========================= #
+def _converter(field):
+    target = field.target_field if field.is_relation else field
+
+    def convert(value):
+        value = target.to_python(value)
+        if isinstance(target, models.DateTimeField) and settings.USE_TZ and timezone.is_naive(value):
+            value = timezone.make_aware(value)
+        return value
+    return convert
+
+
+def _builder(path, field, lookup):
+    convert = _converter(field)
+    if lookup == 'in':
+        return lambda value: Q(**{path + '__in': [convert(v) for v in value.split(',') if v != '']})
+    if lookup == 'range':
+        def build_range(value):
+            values = value.split(',')
+            if len(values) != 2:
+                raise ValueError("Se esperan dos valores separados por coma")
+            return Q(**{path + '__range': (convert(values[0]), convert(values[1]))})
+        return build_range
+    if lookup == 'isnull':
+        return lambda value: Q(**{path + '__isnull': normalizar_booleano(value)})
+    if lookup == 'date' and isinstance(field, models.DateTimeField):
+        def build_date(value):
+            # El día completo como rango, para que use el índice del campo (__date aplica una función a la columna)
+            day = models.DateField().to_python(value)
+            start = datetime.datetime.combine(day, datetime.time.min)
+            if settings.USE_TZ:
+                start = timezone.make_aware(start)
+            return Q(**{path + '__gte': start, path + '__lt': start + datetime.timedelta(days=1)})
+        return build_date
+    return lambda value: Q(**{'%s__%s' % (path, lookup): convert(value)})
+
+
+# ========================= Esquemas ========================= #
+_default_schemas = {}
+
+
+def default_schema(model):
+    """
+    Esquema con todos los campos indexados de `model` y los lookups que tienen sentido para su tipo.
+    """
+    schema = _default_schemas.get(model)
+    if schema is None:
+        filters = {}
+        indexed = indexed_fields(model)
+        for field in model._meta.concrete_fields:
+            if field.name not in indexed:
+                continue
+            if isinstance(field, (models.DateField, models.TimeField, models.IntegerField, models.FloatField,
+                                  models.DecimalField)) and not field.is_relation:
+                lookups = _RANGE_LOOKUPS + (('date',) if isinstance(field, models.DateTimeField) else ())
+            else:
+                lookups = _SCALAR_LOOKUPS
+            if field.null:
+                lookups += ('isnull',)
+            filters[field.name] = lookups
+        schema = _default_schemas[model] = FilterSchema(model, filters, ordering=sorted(indexed))
+    return schema
+
+
+def schema_for(view_or_model):
+    """
+    Esquema de una vista (su `filter_schema` o el de su modelo) o de un modelo.
+    """
+    if isinstance(view_or_model, type) and issubclass(view_or_model, models.Model):
+        return default_schema(view_or_model)
+    schema = getattr(view_or_model, 'filter_schema', None)
+    return schema if schema is not None else default_schema(view_or_model.queryset.model)
+
+
+def filter_query(request, view_or_model):
+    """
+    Q con los filtros GET de la petición según el esquema de la vista o el modelo (None si no hay filtros).
+    """
+    return schema_for(view_or_model).query(request.GET)
+
+
+def requested_ordering(request, view_or_model):
+    return schema_for(view_or_model).order_by(request.GET)
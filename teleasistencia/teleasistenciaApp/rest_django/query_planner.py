@@ -0,0 +1,162 @@
+"""
+select_related / prefetch_related automáticos a partir del serializador.
+
+Los serializadores con `depth` o con serializadores anidados recorren las relaciones de cada fila; sin preparar el
+queryset eso es una consulta por fila y por relación (N+1). `serializer_lookups` recorre el árbol de campos del
+serializador y devuelve qué relaciones hay que traer:
+
+- Las relaciones de un solo objeto (ForeignKey, OneToOne y OneToOne inversa) mientras no haya ninguna de varios
+  objetos por el camino van en select_related: un JOIN en la misma consulta.
+- Las de varios objetos (ManyToMany, ForeignKey inversa, campos many=True) y todo lo que cuelga de ellas van en
+  prefetch_related: una consulta más por relación, sea cual sea el número de filas.
+- Las relaciones que sólo se muestran como clave primaria no necesitan consulta si la clave está en la propia
+  fila; las de varios objetos y las OneToOne inversas sí.
+
+Los serializadores pueden añadir lo que no se ve en sus campos (p. ej. un SerializerMethodField) en
+`Meta.select_related` y `Meta.prefetch_related`.
+
+`QueryPlannerMixin` lo aplica en las vistas a todo lo que se serializa con `get_serializer` para leer:
+querysets (antes de evaluarlos), páginas e instancias sueltas (con prefetch_related_objects). Con ?fields= o
+?expand= (sparse_fields.py) el serializador se recorta antes de recorrerlo, así que las relaciones que no se
+han pedido no se traen.
+"""
+from django.db.models import Model, QuerySet, prefetch_related_objects
+from django.db.models.query import ModelIterable
+from rest_framework.relations import ManyRelatedField
+from rest_framework.serializers import BaseSerializer, ListSerializer
+
+from . import sparse_fields
+
+# Las variantes (?fields=, ?expand=) las eligen los clientes: se limita el tamaño de la caché
+MAX_CACHED_LOOKUPS = 512
+
+_lookups_cache = {}
+
+
+def _relations_by_attr(model):
+    # Relaciones del modelo por el nombre del atributo de la instancia (el accessor en las inversas)
+    relations = {}
+    for field in model._meta.get_fields():
+        if not field.is_relation or field.related_model is None:
+            continue
+        name = field.get_accessor_name() if field.auto_created and not field.concrete else field.name
+        relations[name] = (field.related_model, not (field.many_to_many or field.one_to_many), field.concrete)
+    return relations
+
+
+def _walk(serializer, model, prefix, in_prefetch, select, prefetch):
+    for field in serializer.fields.values():
+        if field.write_only:
+            continue
+        if isinstance(field, ListSerializer):
+            child, many = field.child, True
+        elif isinstance(field, ManyRelatedField):
+            child, many = field.child_relation, True
+        else:
+            child, many = field, False
+        nested = isinstance(child, BaseSerializer)
+
+        if field.source == '*':
+            if nested:
+                _walk(child, model, prefix, in_prefetch, select, prefetch)
+            continue
+        # Camino de relaciones de `source` ("a.b" -> a__b). Si algún paso no es una relación no se prepara nada
+        related_model, single, concrete, path = model, True, True, []
+        for attr in field.source_attrs:
+            relation = _relations_by_attr(related_model).get(attr)
+            if relation is None:
+                break
+            related_model, single_step, concrete = relation
+            single = single and single_step
+            path.append(attr)
+        else:
+            if not nested and not many and concrete:
+                # Clave primaria o hiperenlace de una ForeignKey: la columna está en la fila del paso anterior
+                path = path[:-1]
+                if not path:
+                    continue
+            lookup = prefix + '__'.join(path)
+            multiple = in_prefetch or many or not single
+            (prefetch if multiple else select).add(lookup)
+            if nested:
+                _walk(child, related_model, lookup + '__', multiple, select, prefetch)
+
+
+def serializer_lookups(serializer_class, fields=None, expand=None):
+    """
+    Devuelve (select_related, prefetch_related) para los objetos que muestra `serializer_class`, recortado con
+    `fields` y `expand` (árboles de sparse_fields.parse).
+    """
+    key = (serializer_class, sparse_fields.variant(fields, expand))
+    lookups = _lookups_cache.get(key)
+    if lookups is None:
+        meta = getattr(serializer_class, 'Meta', None)
+        select = set(getattr(meta, 'select_related', ()))
+        prefetch = set(getattr(meta, 'prefetch_related', ()))
+        serializer = serializer_class()
+        sparse_fields.restrict(serializer, fields, expand)
+        _walk(serializer, meta.model, '', False, select, prefetch)
+        if len(_lookups_cache) >= MAX_CACHED_LOOKUPS:
+            _lookups_cache.clear()
+        lookups = _lookups_cache[key] = (sorted(select), sorted(prefetch))
+    return lookups
+
+
+def optimize_queryset(queryset, serializer_class, fields=None, expand=None):
+    """
+    Añade a `queryset` las relaciones que necesita `serializer_class`. Si no es un queryset de instancias del
+    modelo del serializador se devuelve tal cual.
+    """
+    model = getattr(getattr(serializer_class, 'Meta', None), 'model', None)
+    if (model is None or not issubclass(queryset.model, model)
+            or queryset._iterable_class is not ModelIterable):
+        return queryset
+    select, prefetch = serializer_lookups(serializer_class, fields, expand)
+    if select:
+        queryset = queryset.select_related(*select)
+    if prefetch:
+        queryset = queryset.prefetch_related(*prefetch)
+    return queryset
+
+
+def prefetch_instances(instances, serializer_class, fields=None, expand=None):
+    """
+    Trae las relaciones de instancias ya cargadas (una página o un objeto): una consulta por relación.
+    """
+    model = getattr(getattr(serializer_class, 'Meta', None), 'model', None)
+    instances = [instance for instance in instances if model is not None and isinstance(instance, model)]
+    if instances:
+        select, prefetch = serializer_lookups(serializer_class, fields, expand)
+        prefetch_related_objects(instances, *select, *prefetch)
+
+
+class QueryPlannerMixin:
+    """
+    Mixin de ViewSet: lo que se serializa para leer (sin `data`) llega con sus relaciones ya preparadas y con
+    los campos de ?fields= y ?expand=.
+    """
+
+    def paginate_queryset(self, queryset):
+        if isinstance(queryset, QuerySet):
+            fields, expand = sparse_fields.requested(self.request)
+            queryset = optimize_queryset(queryset, self.get_serializer_class(), fields, expand)
+        return super().paginate_queryset(queryset)
+
+    def get_serializer(self, *args, **kwargs):
+        if not args or 'data' in kwargs:
+            return super().get_serializer(*args, **kwargs)
+
+        instance = args[0]
+        serializer_class = self.get_serializer_class()
+        fields, expand = sparse_fields.requested(self.request)
+        if isinstance(instance, QuerySet):
+            if instance._result_cache is None:
+                args = (optimize_queryset(instance, serializer_class, fields, expand),) + args[1:]
+        elif isinstance(instance, Model):
+            prefetch_instances([instance], serializer_class, fields, expand)
+        elif isinstance(instance, list):
+            prefetch_instances(instance, serializer_class, fields, expand)
+
+        serializer = super().get_serializer(*args, **kwargs)
+        sparse_fields.restrict(serializer, fields, expand)
+        return serializer
@@ -4,7 +4,7 @@ from rest_framework import serializers
 #Modelos propios:
 from rest_framework.utils.representation import serializer_repr
 
-from .utils import getDatabaseByUser
+from .utils import getDatabaseByUser, getDatabaseByRequest
 from ..models import *
 
 class ImagenUserSerializer(serializers.ModelSerializer):
@@ -19,11 +19,13 @@ class UserSerializer(serializers.ModelSerializer):
        model = User
        fields = ['id', 'url', 'database_id', 'is_active', 'last_login', 'username', 'first_name', 'last_name', 'email', 'date_joined', 'groups', 'imagen']
        depth = 1
+       # Lo que usa get_database_id (ver rest_django/query_planner.py)
+       select_related = ('database_user',)
 
    def get_database_id(self, obj):
        try:
-           db_user = obj.database_user  # Assuming the related name is "database_user"
-           return db_user.database.pk
+           # database_id evita consultar Database (con select_related('database_user') no hay ninguna consulta)
+           return obj.database_user.database_id
        except Database_User.DoesNotExist:
            return None
 
@@ -55,7 +57,7 @@ class Tipo_Recurso_Comunitario_Serializer(serializers.ModelSerializer):
 
     def create(self, validated_data):
         # Selecciona la base de datos y crear los valores introducidos
-        return self.Meta.model.objects.db_manager(getDatabaseByUser(self.context["request"].user)).create(**validated_data)
+        return self.Meta.model.objects.db_manager(getDatabaseByRequest(self.context["request"])).create(**validated_data)
     '''
     def update(self, instance, validated_data):
         self.Meta.model.objects.db_manager(getDatabaseByUser(self)).filter(id=instance.id).update(**validated_data)
@@ -239,3 +241,26 @@ class Gestion_Base_Datos_Serializer(serializers.ModelSerializer):
         model = Gestion_Base_Datos
         fields = '__all__'
         depth = 1
+
+
+class Aprovisionamiento_Base_Datos_Serializer(serializers.ModelSerializer):
+    database = DatabaseSerializer(read_only=True)
+
+    class Meta:
+        model = Aprovisionamiento_Base_Datos
+        fields = '__all__'
+
+
+class Logs_Acciones_Usuarios_Serializer(serializers.ModelSerializer):
+    username = serializers.CharField(source='user.username', read_only=True, default=None)
+
+    class Meta:
+        model = Logs_AccionesUsuarios
+        fields = ['id', 'timestamp', 'direccion_ip', 'user', 'username', 'ruta', 'query', 'metodo_http', 'estado_http',
+                  'duracion_ms', 'num_consultas', 'duracion_consultas_ms', 'bytes_respuesta']
+
+
+class Logs_Conexiones_Usuarios_Serializer(serializers.ModelSerializer):
+    class Meta:
+        model = Logs_ConexionesUsuarios
+        fields = '__all__'
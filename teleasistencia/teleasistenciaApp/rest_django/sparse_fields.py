@@ -0,0 +1,80 @@
+"""
+Campos y relaciones a medida en las respuestas de la API v1 (parámetros GET ?fields= y ?expand=).
+
+- fields=id,nombre,id_persona.nombre: sólo esos campos. Con un punto se eligen los campos de una relación anidada.
+- expand=id_persona,id_terminal.id_titular: sólo esas relaciones se devuelven como objeto; las demás se quedan en
+  su clave primaria. Una relación expandida sin más puntos (id_persona) se muestra con todo lo que cuelga de ella
+  hasta el `depth` del serializador; con un camino (id_terminal.id_titular) dentro de id_terminal sólo se expande
+  id_titular. Sin expand se mantiene el `depth` de siempre.
+
+Sin ninguno de los dos la respuesta es la de siempre. `restrict` recorta un serializador ya creado (lo hace
+QueryPlannerMixin), así el queryset sólo trae las relaciones que quedan (query_planner.py).
+"""
+from rest_framework.relations import ManyRelatedField, PrimaryKeyRelatedField
+from rest_framework.serializers import BaseSerializer, ListSerializer
+
+
+def parse(value):
+    """
+    "a,b.c,b.d" -> {'a': {}, 'b': {'c': {}, 'd': {}}}. None si no se ha pasado el parámetro.
+    """
+    if value is None:
+        return None
+    tree = {}
+    for path in value.split(','):
+        node = tree
+        for name in path.strip().split('.'):
+            if name:
+                node = node.setdefault(name, {})
+    return tree
+
+
+def requested(request):
+    """
+    (fields, expand) pedidos en la petición, como árboles de parse().
+    """
+    params = request.query_params if request is not None else {}
+    return parse(params.get('fields')), parse(params.get('expand'))
+
+
+def variant(fields, expand):
+    """
+    Cadena canónica de (fields, expand) para cachear lo que depende de ellos.
+    """
+    def canonical(tree):
+        if tree is None:
+            return '-'
+        return ','.join('%s(%s)' % (name, canonical(tree[name])) if tree[name] else name for name in sorted(tree))
+    return '%s|%s' % (canonical(fields), canonical(expand))
+
+
+def restrict(serializer, fields, expand):
+    """
+    Quita de `serializer` los campos que no están en `fields` y deja como clave primaria las relaciones anidadas
+    que no están en `expand` (None: sin restricción). Dentro de una relación expandida sin subcamino no se
+    restringe nada más.
+    """
+    if isinstance(serializer, ListSerializer):
+        serializer = serializer.child
+    for name, field in list(serializer.fields.items()):
+        if fields is not None and name not in fields:
+            del serializer.fields[name]
+            continue
+
+        nested = field.child if isinstance(field, ListSerializer) else field
+        if not isinstance(nested, BaseSerializer):
+            continue
+        sub_fields = (fields.get(name) or None) if fields is not None else None
+        # Pedir campos de una relación (fields=a.b) también la expande
+        if expand is not None and name not in expand and not sub_fields and field.source != '*':
+            serializer.fields[name] = _primary_key_field(field)
+            continue
+        restrict(nested, sub_fields, (expand.get(name) or None) if expand is not None else None)
+
+
+def _primary_key_field(field):
+    # DRF no admite source igual al nombre del campo
+    kwargs = {'source': field.source} if field.source != field.field_name else {}
+    if isinstance(field, ListSerializer):
+        return ManyRelatedField(child_relation=PrimaryKeyRelatedField(read_only=True), read_only=True, **kwargs)
+    return PrimaryKeyRelatedField(read_only=True, **kwargs)
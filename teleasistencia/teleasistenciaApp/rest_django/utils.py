@@ -1,32 +1,17 @@
-from django.db.models import Q
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
 
 from rest_framework.response import Response
 
-# En el caso de que queramos que la búsqueda pueda coincidir con TODOS de los valores
 from ..models import Database_User
 
 
-def getQueryAnd(params):
-    query = None
-    for key in params:
-        val = params[key]
-        if query is None:
-            query = Q(**{key: val})
-        else:
-            query = query & Q(**{key: val})
-
-    return query
-
-# En el caso de que queramos que la búsqueda pueda coincidir con ALGUNO de los valores
-def getQueryOr(params):
-    query = None
-    for key in params:
-        val = params[key]
-        if query is None:
-            query = Q(**{key: val})
-        else:
-            query = query | Q(**{key: val})
-    return query
+# Parámetros GET que no son filtros del modelo (paginación, campos de la respuesta, formato...): los filtros de
+# las vistas (filter_schema.py) no los usan
+PARAMETROS_RESERVADOS = ('cursor', 'page_size', 'page', 'fields', 'expand', 'ordering', 'format')
 
 
 # Ejemplo de cómo se haría un PATCH genérico para cualquier petición de API-REST de tipo PATHC
@@ -52,11 +37,69 @@ def normalizar_booleano(value):
         return None  # or handle the invalid value in a way that makes sense for your application
 
 
+# Base de datos (tenant) de un usuario: id del modelo Database y alias de la conexión
+TenantDatabase = namedtuple('TenantDatabase', ['database_id', 'alias'])
+
+
+class TenantCache:
+    """
+    Caché del proceso: id de usuario -> TenantDatabase, durante settings.TENANT_CACHE_TTL segundos.
+    Se invalida con las señales de Database_User y Database (teleasistenciaApp/signals.py); el TTL limita
+    el tiempo que otro proceso puede tardar en ver un cambio.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is None or entry[1] <= time.monotonic():
+            return None
+        return entry[0]
+
+    def set(self, user_id, tenant):
+        with self._lock:
+            self._entries[user_id] = (tenant, time.monotonic() + self.ttl)
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+
+tenant_cache = TenantCache(getattr(settings, 'TENANT_CACHE_TTL', 300))
+
+
+def getTenantByUser(usuario):
+    """
+    Devuelve el TenantDatabase del usuario. Lanza Database_User.DoesNotExist si no tiene base de datos asignada.
+    """
+    tenant = tenant_cache.get(usuario.pk)
+    if tenant is None:
+        database_user = Database_User.objects.select_related('database').get(user=usuario)
+        tenant = TenantDatabase(database_user.database_id, database_user.database.nameDescritive)
+        tenant_cache.set(usuario.pk, tenant)
+    return tenant
+
+
 # Permite obtener el nombre de la base de datos a la que corresponde el usuario
-# En caso de no haber base de datos se devuevle "default"
+# Si el usuario no tiene base de datos asignada se lanza Database_User.DoesNotExist
 def  getDatabaseByUser(usuario):
-    database_user =Database_User.objects.get(user=usuario)
-    if (database_user):
-        return database_user.database.nameDescritive
-    else:
-        return "default"
+    return getTenantByUser(usuario).alias
+
+
+def getDatabaseByRequest(request):
+    """
+    Nombre de la base de datos del usuario de la petición. Se resuelve una sola vez por petición
+    (normalmente ya lo ha hecho TenantDatabaseMiddleware) y se guarda en `request.database`.
+    """
+    # Con las peticiones de DRF se guarda en la HttpRequest original, que es la que ve el middleware
+    http_request = getattr(request, '_request', request)
+    database = getattr(http_request, 'database', None)
+    if database is None:
+        database = http_request.database = getDatabaseByUser(request.user)
+    return database
@@ -20,15 +20,31 @@ from rest_framework import viewsets
 from rest_framework import status
 # Serializadores generales
 from rest_framework.response import Response
-
+from rest_framework.pagination import CursorPagination
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db.models import BooleanField, Count, Q
 from django.utils.connection import ConnectionDoesNotExist
-from .utils import getQueryAnd, partial_update_generico, normalizar_booleano
+from .query_planner import QueryPlannerMixin, optimize_queryset
+from .filter_schema import Filter, FilterSchema, filter_query, requested_ordering
+from .utils import partial_update_generico, normalizar_booleano, getDatabaseByRequest, getTenantByUser
 import json
 
 # Modelos propios
 from ..models import *
 # Serializadores propios
 from ..rest_django.serializers import *
+from ..request_metrics import route_stats
+from ..db_pool import pool_stats
+from ..roles import bump_version, has_group
+from ..cross_tenant import AGGREGATES, run_aggregate
+from ..routers import tenant_aliases
+from ..provisioning import expire_stale_jobs, start_provisioning
+from ..user_import import parse_rows, import_users
 from django.http import JsonResponse
 
 # Alarmas
@@ -42,8 +58,8 @@ from utilidad.logging import info, blue, red
 # entre solicitudes de Administrador, Profesor y Teleoperador
 class IsAdminMember(permissions.BasePermission):
     def has_permission(self, request, view):
-        # Si el usuario tiene el grupo tiene el permiso
-        return request.user.groups.filter(name="administrador").exists()
+        # Si el usuario tiene el grupo tiene el permiso (grupos del token si son de la versión actual, ver roles.py)
+        return has_group(request, "administrador")
 
 
 # Comprobamos si el usuario es profesor. Se utiliza para la discernir
@@ -51,7 +67,47 @@ class IsAdminMember(permissions.BasePermission):
 class IsTeacherMember(permissions.BasePermission):
     def has_permission(self, request, view):
         # Si el usuario tiene el grupo tiene el permiso
-        return request.user.groups.filter(name='profesor').exists()
+        return has_group(request, 'profesor')
+
+
+# Paginación por cursor opcional de las vistas v1: sólo se pagina si la petición trae ?cursor= o ?page_size=,
+# sin ellos la respuesta es la lista completa de siempre (las versiones antiguas de la app Android la esperan).
+# Cada vista puede indicar su orden en `cursor_ordering` (por defecto el id, del más nuevo al más antiguo)
+class Cursor_Opcional_Pagination(CursorPagination):
+    ordering = ('-id',)
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.cursor_query_param not in request.query_params and \
+                self.page_size_query_param not in request.query_params:
+            return None
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_ordering(self, request, queryset, view):
+        # Con ?ordering= (filter_schema.py) se pagina en ese orden, desempatando por id
+        ordering = requested_ordering(request, view)
+        if ordering:
+            return tuple(ordering) + (('-id',) if 'id' not in ordering and '-id' not in ordering else ())
+        return getattr(view, 'cursor_ordering', self.ordering)
+
+
+class Paginacion_Opcional_View():
+    """
+    Añade Cursor_Opcional_Pagination a la vista. Los `list` propios devuelven `self.list_response(queryset)`,
+    que pagina si se ha pedido y si no serializa el queryset entero (en el orden de ?ordering= si lo hay).
+    """
+    pagination_class = Cursor_Opcional_Pagination
+
+    def list_response(self, queryset):
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(self.get_serializer(page, many=True).data)
+        ordering = requested_ordering(self.request, self)
+        if ordering:
+            queryset = queryset.order_by(*ordering)
+        return Response(self.get_serializer(queryset, many=True).data)
 
 
 # Vista por defecto utilizada para multibase de datos
@@ -60,23 +116,22 @@ class Generic_View():
     # Obtenemos el listado de personas filtrado por los parametros GET
     def list(self, request, *args, **kwargs):
         # Hacemos una búsqueda por los valores introducidos por parámetros
-        query = getQueryAnd(request.GET)
+        query = filter_query(request, self)
         if query:
             # Con using seleccionamos la base de datos del usuario
-            queryset = self.queryset.using(getDatabaseByUser(request.user)).filter(query)
+            queryset = self.queryset.using(getDatabaseByRequest(request)).filter(query)
         # En el caso de que no hay parámetros y queramos devolver todos los valores
         else:
-            queryset = self.queryset.using(getDatabaseByUser(request.user))
+            queryset = self.queryset.using(getDatabaseByRequest(request))
 
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+        return self.list_response(queryset)
 
     #TODO: La creación sehace en serializers.py quizá esta parte habría que meterla aquí.
 
     # Actualiza el objeto
     def update(self, request, *args, **kwargs):
         # Obtenemos la base de datos del usuario
-        nameDatabase = getDatabaseByUser(request.user)
+        nameDatabase = getDatabaseByRequest(request)
         # Con using seleccionamos la base de datos del usuario y con kwargs obtenemos el identificador que se desea modificar
         self.serializer_class.Meta.model.objects.using(nameDatabase).filter(pk=kwargs["pk"]).update(**request.data)
         # Recuperamos los datos de todo el objeto actualizado y serializado (con su profundidad)
@@ -85,9 +140,10 @@ class Generic_View():
     # Borrado del objeto
     def destroy(self, request, *args, **kwargs):
         # Con using seleccionamos la base de datos del usuario y con kwargs obtenemos el identificador que se desea modificar
-        objeto = self.serializer_class.Meta.model.objects.using(getDatabaseByUser(request.user)).get(pk=kwargs["pk"])
+        nameDatabase = getDatabaseByRequest(request)
+        objeto = self.serializer_class.Meta.model.objects.using(nameDatabase).get(pk=kwargs["pk"])
         if objeto is not None:
-            objeto.delete(using=getDatabaseByUser(request.user))
+            objeto.delete(using=nameDatabase)
         return Response()
 
 class Permision_View_All_Edit_Teacher_Views():
@@ -100,15 +156,14 @@ class Permision_View_All_Edit_Teacher_Views():
         return [permission() for permission in permission_classes]
 
 # Creamos la vista Profile que  modificara los datos y retornara la informacion del usuario activo en la aplicación
-class ProfileViewSet(viewsets.ModelViewSet):
+class ProfileViewSet(QueryPlannerMixin, Paginacion_Opcional_View, viewsets.ModelViewSet):
     queryset = User.objects.all().order_by('-date_joined')
     serializer_class = UserSerializer
 
     def list(self, request, *args, **kwargs):
         # Obtenemos el usuario filtrando por el usuario de la request
         queryset = User.objects.filter(username=request.user)
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+        return self.list_response(queryset)
 
     def update(self, request, *args, **kwargs):
         try:
@@ -167,7 +222,17 @@ class ProfileViewSet(viewsets.ModelViewSet):
             return Response("Error: No existe ninguna base de datos con ese id", 405)
 
 
-class UserViewSet(viewsets.ModelViewSet):
+def usuarios_del_tenant(tenant):
+    """
+    Usuarios de la BBDD del tenant (TenantDatabase) con todo lo que muestra UserSerializer: Database_User e imagen
+    en la misma consulta (JOIN) y los grupos y sus permisos (depth=1) en otras dos, sea cual sea el número de usuarios.
+    """
+    return (User.objects.filter(database_user__database_id=tenant.database_id)
+            .select_related('database_user', 'imagen_user')
+            .prefetch_related('groups__permissions'))
+
+
+class UserViewSet(QueryPlannerMixin, Paginacion_Opcional_View, viewsets.ModelViewSet):
     """
     API endpoint that allows users to be viewed or edited.
     """
@@ -179,18 +244,14 @@ class UserViewSet(viewsets.ModelViewSet):
     # Obtenemos el listado de personas filtrado por los parametros GET
     def list(self, request, *args, **kwargs):
         # Hacemos una búsqueda por los valores introducidos por parámetros
-        query = getQueryAnd(request.GET)
+        query = filter_query(request, self)
 
-        database_user = Database_User.objects.get(user=request.user)
-        database_user_selected = Database_User.objects.filter(database=database_user.database)
+        # Usuarios de la misma base de datos, con sus grupos, imagen y Database_User en tres consultas
+        queryset = usuarios_del_tenant(getTenantByUser(request.user))
         if query:
-            queryset = User.objects.filter(id__in = [database_u.user.id for database_u in database_user_selected]).filter(query)
-        # En el caso de que no hay parámetros y queramos devolver todos los valores
-        else:
-            queryset = User.objects.filter(id__in = [database_u.user.id for database_u in database_user_selected])
+            queryset = queryset.filter(query)
 
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+        return self.list_response(queryset)
 
     def create(self, request, *args, **kwargs):
         # Comprobamos que existe el groups
@@ -218,10 +279,10 @@ class UserViewSet(viewsets.ModelViewSet):
         user.save()
 
         # El usuario nuevo se crea asociado a la misma base de datos que el que lo crea
-        database_user = Database_User.objects.get(user=request.user)
+        tenant = getTenantByUser(request.user)
         database_user_new = Database_User(
             user=user,
-            database=database_user.database
+            database_id=tenant.database_id
         )
         database_user_new.save()
 
@@ -238,7 +299,7 @@ class UserViewSet(viewsets.ModelViewSet):
         user_serializer = self.get_serializer(user, many=False)
 
         # MULTIDATABASE: Para las multibase de datos creamos el usuario en la nueva base e datos
-        user.save(using=database_user.database.nameDescritive)
+        user.save(using=tenant.alias)
         return Response(user_serializer.data)
 
     def update(self, request, *args, **kwargs):
@@ -249,6 +310,8 @@ class UserViewSet(viewsets.ModelViewSet):
             id_groups = Group.objects.get(pk=request.data.get("groups"))
             user.groups.clear()
             user.groups.add(id_groups)
+            # Los tokens emitidos antes del cambio dejan de usarse para los permisos (roles.py)
+            bump_version(user.pk)
 
         if request.data.get("username") is not None:
             user.username = request.data.get("username")
@@ -287,12 +350,24 @@ class UserViewSet(viewsets.ModelViewSet):
         user_serializer = self.get_serializer(user, many=False)
         return Response(user_serializer.data)
 
+    @action(detail=False, methods=['post'])
+    def importar(self, request):
+        """
+        Alta de muchos usuarios a la vez (teleasistenciaApp/user_import.py): un CSV en "fichero" o una lista JSON
+        con username, password, first_name, last_name, email y groups. Devuelve el resultado de cada fila.
+        """
+        filas = parse_rows(request)
+        if not filas:
+            return Response("Error: No hay usuarios que importar", 405)
+        tenant = getTenantByUser(request.user)
+        resultado = import_users(filas, tenant, allow_admin=has_group(request, 'administrador'))
+        return Response(resultado)
+
     def destroy(self, request, *args, **kwargs):
         blue("TeleasistenciaApp", f"ViewsRest: {kwargs}")
         try:
             # Sacar la bbdd y hacer el borrado en la BBDD en la que nos encontramos
-            database = Database_User.objects.get(user=request.user).database
-            db_user = User.objects.using(database.nameDescritive).get(pk=kwargs["pk"])
+            db_user = User.objects.using(getDatabaseByRequest(request)).get(pk=kwargs["pk"])
             db_user.delete()
             # Borrar en la BBDD default, puede fallar si no estaba registrado en otra BBDD
             try:
@@ -308,12 +383,42 @@ class UserViewSet(viewsets.ModelViewSet):
             return Response("Error Interno", 500)
 
 
-class DatabaseViewSet(viewsets.ModelViewSet):
+# Paginación por cursor del directorio: ordenado por username (único e indexado), cada página es una consulta
+# por rango sobre el índice
+class Directorio_Usuarios_Pagination(CursorPagination):
+    ordering = ('username',)
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+
+class Directorio_Usuarios_ViewSet(QueryPlannerMixin, viewsets.ReadOnlyModelViewSet):
+    """
+    Directorio de los usuarios de la base de datos del usuario, paginado por cursor (?cursor=, ?page_size=).
+    Con ?buscar= se filtran los usuarios cuyo username, nombre o apellidos empiezan por el texto, sin distinguir
+    mayúsculas (istartswith). En PostgreSQL usa los índices de UPPER(campo) con text_pattern_ops de la migración
+    0030, que valen con cualquier collation; en MySQL y SQLite los índices de los campos. Cada página son siempre las mismas consultas: usuarios (con Database_User e imagen), grupos
+    y permisos de los grupos.
+    """
+    serializer_class = UserSerializer
+    pagination_class = Directorio_Usuarios_Pagination
+    permission_classes = [IsAdminMember | IsTeacherMember]
+
+    def get_queryset(self):
+        queryset = usuarios_del_tenant(getTenantByUser(self.request.user))
+        buscar = self.request.query_params.get('buscar', '').strip()
+        if buscar:
+            queryset = queryset.filter(Q(username__istartswith=buscar) | Q(first_name__istartswith=buscar) |
+                                       Q(last_name__istartswith=buscar))
+        return queryset
+
+
+class DatabaseViewSet(QueryPlannerMixin, Paginacion_Opcional_View, viewsets.ModelViewSet):
     queryset = Database.objects.all()
     serializer_class = DatabaseSerializer
     permission_classes = [IsAdminMember]
 
-class PermissionViewSet(viewsets.ModelViewSet):
+class PermissionViewSet(QueryPlannerMixin, Paginacion_Opcional_View, viewsets.ModelViewSet):
     """
     API endpoint that allows users to be viewed or edited.
     """
@@ -322,7 +427,7 @@ class PermissionViewSet(viewsets.ModelViewSet):
     permission_classes = [IsTeacherMember]
     # permission_classes = [permissions.IsAdminUser]
 
-class GroupViewSet(viewsets.ModelViewSet):
+class GroupViewSet(QueryPlannerMixin, Paginacion_Opcional_View, viewsets.ModelViewSet):
     """
     API endpoint that allows groups to be viewed or edited.
     """
@@ -334,16 +439,15 @@ class GroupViewSet(viewsets.ModelViewSet):
     # así no permitimos seleccionarlo en los usuarios del servicio
     def list(self, request, *args, **kwargs):
         # Hacemos una búsqueda por los valores introducidos por parámetros
-        is_group_admin = request.user.groups.filter(name='administrador')
+        is_group_admin = has_group(request, 'administrador')
 
         if not is_group_admin:
             queryset = Group.objects.exclude(name= 'administrador')
         else:
             queryset = Group.objects.all()
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+        return self.list_response(queryset)
 
-class Clasificacion_Recurso_Comunitario_ViewSet(Permision_View_All_Edit_Teacher_Views, viewsets.ModelViewSet):
+class Clasificacion_Recurso_Comunitario_ViewSet(Permision_View_All_Edit_Teacher_Views, QueryPlannerMixin, Paginacion_Opcional_View, viewsets.ModelViewSet):
     """
     API endpoint para las empresas
     """
@@ -351,7 +455,7 @@ class Clasificacion_Recurso_Comunitario_ViewSet(Permision_View_All_Edit_Teacher_
     serializer_class = Clasificacion_Recurso_Comunitario_Serializer
 
 
-class Tipo_Recurso_Comunitario_ViewSet(Permision_View_All_Edit_Teacher_Views, Generic_View, viewsets.ModelViewSet):
+class Tipo_Recurso_Comunitario_ViewSet(Permision_View_All_Edit_Teacher_Views, Generic_View, QueryPlannerMixin, Paginacion_Opcional_View, viewsets.ModelViewSet):
     """
     API endpoint para las empresas
     """
@@ -362,7 +466,7 @@ class Tipo_Recurso_Comunitario_ViewSet(Permision_View_All_Edit_Teacher_Views, Ge
 
 
 
-class Recurso_Comunitario_ViewSet(viewsets.ModelViewSet):
+class Recurso_Comunitario_ViewSet(QueryPlannerMixin, Paginacion_Opcional_View, viewsets.ModelViewSet):
     """
     API endpoint para las empresas
     """
@@ -374,15 +478,14 @@ class Recurso_Comunitario_ViewSet(viewsets.ModelViewSet):
     # Obtenemos el listado de personas filtrado por los parametros GET
     def list(self, request, *args, **kwargs):
         # Hacemos una búsqueda por los valores introducidos por parámetros
-        query = getQueryAnd(request.GET)
+        query = filter_query(request, self)
         if query:
             queryset = Recurso_Comunitario.objects.filter(query)
         # En el caso de que no hay parámetros y queramos devolver todos los valores
         else:
             queryset = self.get_queryset()
 
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+        return self.list_response(queryset)
 
     def create(self, request, *args, **kwargs):
         # Comprobamos que el tipo de centro sanitario existe
@@ -443,7 +546,7 @@ class Recurso_Comunitario_ViewSet(viewsets.ModelViewSet):
         recurso_comunitario_serializer = Recurso_Comunitario_Serializer(recurso_comunitario)
         return Response(recurso_comunitario_serializer.data)
 
-class Tipo_Alarma_ViewSet(viewsets.ModelViewSet):
+class Tipo_Alarma_ViewSet(QueryPlannerMixin, Paginacion_Opcional_View, viewsets.ModelViewSet):
     """
     API endpoint para las empresas
     """
@@ -463,15 +566,14 @@ class Tipo_Alarma_ViewSet(viewsets.ModelViewSet):
     # Obtenemos el listado de personas filtrado por los parametros GET
     def list(self, request, *args, **kwargs):
         # Hacemos una búsqueda por los valores introducidos por parámetros
-        query = getQueryAnd(request.GET)
+        query = filter_query(request, self)
         if query:
             queryset = self.serializer_class.Meta.model.objects.filter(query)
         # En el caso de que no hay parámetros y queramos devolver todos los valores
         else:
             queryset = self.get_queryset()
 
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+        return self.list_response(queryset)
 
     def create(self, request, *args, **kwargs):
         # Comprobamos que el tipo de centro sanitario existe
@@ -515,7 +617,7 @@ class Tipo_Alarma_ViewSet(viewsets.ModelViewSet):
 
 
 
-class Clasificacion_Alarma_ViewSet(viewsets.ModelViewSet):
+class Clasificacion_Alarma_ViewSet(QueryPlannerMixin, Paginacion_Opcional_View, viewsets.ModelViewSet):
     """
     API endpoint para las empresas
     """
@@ -532,7 +634,7 @@ class Clasificacion_Alarma_ViewSet(viewsets.ModelViewSet):
     # permission_classes = [permissions.IsAdminUser] # Si quieriéramos para todos los registrados: IsAuthenticated]
 
 
-class Direccion_ViewSet(viewsets.ModelViewSet):
+class Direccion_ViewSet(QueryPlannerMixin, Paginacion_Opcional_View, viewsets.ModelViewSet):
     """
     API endpoint para las empresas
     """
@@ -559,7 +661,7 @@ def Asignar_Persona_Direccion(data, direccion):
     return persona
 
 # TODO echar un vistazo a los metodos detallamente  y a la tabla postman (puede que no esten bien definidos)
-class Persona_ViewSet(viewsets.ModelViewSet):
+class Persona_ViewSet(QueryPlannerMixin, Paginacion_Opcional_View, viewsets.ModelViewSet):
     """
     API endpoint para las empresas
     """
@@ -571,15 +673,14 @@ class Persona_ViewSet(viewsets.ModelViewSet):
     # Obtenemos el listado de personas filtrado por los parametros GET
     def list(self, request, *args, **kwargs):
         # Hacemos una búsqueda por los valores introducidos por parámetros
-        query = getQueryAnd(request.GET)
+        query = filter_query(request, self)
         if query:
             queryset = Persona.objects.filter(query)
         # En el caso de que no hay parámetros y queramos devolver todos los valores
         else:
             queryset = self.get_queryset()
 
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+        return self.list_response(queryset)
 
     # Creamos una persona con por POST
     def create(self, request, *args, **kwargs):
@@ -636,12 +737,22 @@ class Persona_ViewSet(viewsets.ModelViewSet):
         return Response(persona_serializer.data)
 
 
-class Agenda_ViewSet(viewsets.ModelViewSet):
+class Agenda_ViewSet(QueryPlannerMixin, Paginacion_Opcional_View, viewsets.ModelViewSet):
     """
     API endpoint para las empresas
     """
     queryset = Agenda.objects.all()
     serializer_class = Agenda_Serializer
+    # Paginación opcional por fecha de registro (?cursor=, ?page_size=)
+    cursor_ordering = ('-fecha_registro', '-id')
+    # Filtros GET admitidos (ver rest_django/filter_schema.py)
+    filter_schema = FilterSchema(Agenda, {
+        'id': ('exact', 'in'),
+        'id_paciente': ('exact', 'in', 'isnull'),
+        'id_tipo_agenda': ('exact', 'in', 'isnull'),
+        'fecha_prevista': ('exact', 'date', 'gt', 'gte', 'lt', 'lte', 'range'),
+        'fecha_resolucion': ('exact', 'date', 'gt', 'gte', 'lt', 'lte', 'range', 'isnull'),
+    }, ordering=('id', 'fecha_prevista'))
     # permission_classes = [permissions.IsAdminUser] # Si quieriéramos para todos los registrados: IsAuthenticated]
 
     # Obtenemos el listado de la Agenda filtrado por los parametros GET
@@ -649,12 +760,11 @@ class Agenda_ViewSet(viewsets.ModelViewSet):
         queryset = self.filter_queryset(self.get_queryset())
 
     # Hacemos una búsqueda por los valores introducidos por parámetros
-        query = getQueryAnd(request.GET)
+        query = filter_query(request, self)
         if query:
             queryset = Agenda.objects.filter(query)
 
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+        return self.list_response(queryset)
 
     def create(self, request, *args, **kwargs):
         # Comprobamos que existe id_paciente
@@ -711,7 +821,7 @@ class Agenda_ViewSet(viewsets.ModelViewSet):
         return Response(agenda_serializer.data)
 
 
-class Tipo_Agenda_ViewSet(viewsets.ModelViewSet):
+class Tipo_Agenda_ViewSet(QueryPlannerMixin, Paginacion_Opcional_View, viewsets.ModelViewSet):
     """
     API endpoint para las empresas
     """
@@ -727,12 +837,19 @@ class Tipo_Agenda_ViewSet(viewsets.ModelViewSet):
         return [permission() for permission in permission_classes]
 
 
-class Historico_Agenda_Llamadas_ViewSet(viewsets.ModelViewSet):
+class Historico_Agenda_Llamadas_ViewSet(QueryPlannerMixin, Paginacion_Opcional_View, viewsets.ModelViewSet):
     """
     API endpoint para las empresas
     """
     queryset = Historico_Agenda_Llamadas.objects.all()
     serializer_class = Historico_Agenda_Llamadas_Serializer
+    # Filtros GET admitidos (ver rest_django/filter_schema.py). id_paciente es el paciente de la agenda
+    filter_schema = FilterSchema(Historico_Agenda_Llamadas, {
+        'id': ('exact', 'in'),
+        'id_agenda': ('exact', 'in', 'isnull'),
+        'id_teleoperador': ('exact', 'in', 'isnull'),
+        'id_paciente': Filter(('exact', 'in'), path='id_agenda__id_paciente'),
+    })
     # permission_classes = [permissions.IsAdminUser] # Si quisieramos para todos los registrados: IsAuthenticated]
 
     # Obtenemos el listado de el Hiscorico_Agenda_Llamadas filtrado por los parametros GET
@@ -740,12 +857,11 @@ class Historico_Agenda_Llamadas_ViewSet(viewsets.ModelViewSet):
         queryset = self.filter_queryset(self.get_queryset())
 
         # Hacemos una búsqueda por los valores introducidos por parámetros
-        query = getQueryAnd(request.GET)
+        query = filter_query(request, self)
         if query:
             queryset = Historico_Agenda_Llamadas.objects.filter(query)
 
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+        return self.list_response(queryset)
 
     def create(self, request, *args, **kwargs):
         # Comprobamos que existe la agenda
@@ -770,7 +886,7 @@ class Historico_Agenda_Llamadas_ViewSet(viewsets.ModelViewSet):
         return Response(historico_agenda_llamada_serializer.data)
 
 
-class Relacion_Terminal_Recurso_Comunitario_ViewSet(viewsets.ModelViewSet):
+class Relacion_Terminal_Recurso_Comunitario_ViewSet(QueryPlannerMixin, Paginacion_Opcional_View, viewsets.ModelViewSet):
     """
     API endpoint para las empresas
     """
@@ -783,12 +899,11 @@ class Relacion_Terminal_Recurso_Comunitario_ViewSet(viewsets.ModelViewSet):
         queryset = self.filter_queryset(self.get_queryset())
 
         # Hacemos una búsqueda por los valores introducidos por parámetros
-        query = getQueryAnd(request.GET)
+        query = filter_query(request, self)
         if query:
             queryset = Relacion_Terminal_Recurso_Comunitario.objects.filter(query)
 
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+        return self.list_response(queryset)
 
     def create(self, request, *args, **kwargs):
         # Comprobamos que exite el terminal
@@ -840,7 +955,7 @@ class Relacion_Terminal_Recurso_Comunitario_ViewSet(viewsets.ModelViewSet):
 
 
 
-class Terminal_ViewSet(viewsets.ModelViewSet):
+class Terminal_ViewSet(QueryPlannerMixin, Paginacion_Opcional_View, viewsets.ModelViewSet):
     """
     API endpoint para las empresas
     """
@@ -852,20 +967,22 @@ class Terminal_ViewSet(viewsets.ModelViewSet):
         queryset = self.filter_queryset(self.get_queryset())
 
         # Hacemos una búsqueda por los valores introducidos por parámetros
-        query = getQueryAnd(request.GET)
+        # Si no son filtros del terminal se buscan en la persona del titular (400 si tampoco lo son)
+        try:
+            query, query_persona = filter_query(request, self), None
+        except ValidationError:
+            query, query_persona = None, filter_query(request, Persona)
         if query:
+            queryset = Terminal.objects.filter(query)
+        elif query_persona:
             try:
-                queryset = Terminal.objects.filter(query)
+                id_persona = Persona.objects.get(query_persona)
+                id_paciente = Paciente.objects.get(id_persona=id_persona)
+                queryset = Terminal.objects.filter(id_titular=id_paciente)
             except:
-                try:
-                    id_persona = Persona.objects.get(query)
-                    id_paciente = Paciente.objects.get(id_persona=id_persona)
-                    queryset = Terminal.objects.filter(id_titular=id_paciente)
-                except:
-                    return Response("No hay terminal asociado")
+                return Response("No hay terminal asociado")
 
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+        return self.list_response(queryset)
 
     def create(self, request, *args, **kwargs):
         # Comprobamos que existe id_tipo_vivienda
@@ -943,7 +1060,7 @@ class Terminal_ViewSet(viewsets.ModelViewSet):
         terminal_serializer = Terminal_Serializer(terminal)
         return Response(terminal_serializer.data)
 
-class Tipo_Situacion_ViewSet(viewsets.ModelViewSet):
+class Tipo_Situacion_ViewSet(QueryPlannerMixin, Paginacion_Opcional_View, viewsets.ModelViewSet):
     """
     API endpoint para las empresas
     """
@@ -960,7 +1077,7 @@ class Tipo_Situacion_ViewSet(viewsets.ModelViewSet):
     # permission_classes = [permissions.IsAdminUser] # Si quisieramos para todos los registrados: IsAuthenticated]
 
 
-class Tipo_Vivienda_ViewSet(viewsets.ModelViewSet):
+class Tipo_Vivienda_ViewSet(QueryPlannerMixin, Paginacion_Opcional_View, viewsets.ModelViewSet):
     """
     API endpoint para las empresas
     """
@@ -977,7 +1094,7 @@ class Tipo_Vivienda_ViewSet(viewsets.ModelViewSet):
     # permission_classes = [permissions.IsAdminUser] # Si quisieramos para todos los registrados: IsAuthenticated]
 
 
-class Relacion_Paciente_Persona_ViewSet(viewsets.ModelViewSet):
+class Relacion_Paciente_Persona_ViewSet(QueryPlannerMixin, Paginacion_Opcional_View, viewsets.ModelViewSet):
     """
     API endpoint para las empresas
     """
@@ -990,15 +1107,14 @@ class Relacion_Paciente_Persona_ViewSet(viewsets.ModelViewSet):
         queryset = self.filter_queryset(self.get_queryset())
 
         # Hacemos una búsqueda por los valores introducidos por parámetros
-        query = getQueryAnd(request.GET)
+        query = filter_query(request, self)
         if query:
             queryset = Relacion_Paciente_Persona.objects.filter(query)
 
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+        return self.list_response(queryset)
 
 
-class Paciente_ViewSet(viewsets.ModelViewSet):
+class Paciente_ViewSet(QueryPlannerMixin, Paginacion_Opcional_View, viewsets.ModelViewSet):
     """
     API endpoint para las empresas
     """
@@ -1011,19 +1127,21 @@ class Paciente_ViewSet(viewsets.ModelViewSet):
         queryset = self.filter_queryset(self.get_queryset())
 
         # Hacemos una búsqueda por los valores introducidos por parámetros
-        query = getQueryAnd(request.GET)
+        # Si no son filtros del paciente se buscan en su persona (400 si tampoco lo son)
+        try:
+            query, query_persona = filter_query(request, self), None
+        except ValidationError:
+            query, query_persona = None, filter_query(request, Persona)
         if query:
+            queryset = Paciente.objects.filter(query)
+        elif query_persona:
             try:
-                queryset = Paciente.objects.filter(query)
+                id_persona = Persona.objects.get(query_persona)
+                queryset = Paciente.objects.filter(id_persona=id_persona)
             except:
-                try:
-                    id_persona = Persona.objects.get(query)
-                    queryset = Paciente.objects.filter(id_persona=id_persona)
-                except:
-                    return Response("No existe el paciente")
+                return Response("No existe el paciente")
 
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+        return self.list_response(queryset)
 
     # Creamos el paciente
     def create(self, request, *args, **kwargs):
@@ -1124,7 +1242,7 @@ class Paciente_ViewSet(viewsets.ModelViewSet):
         return Response("")
 
 
-class Tipo_Modalidad_Paciente_ViewSet(viewsets.ModelViewSet):
+class Tipo_Modalidad_Paciente_ViewSet(QueryPlannerMixin, Paginacion_Opcional_View, viewsets.ModelViewSet):
     """
     API endpoint para las empresas
     """
@@ -1141,12 +1259,14 @@ class Tipo_Modalidad_Paciente_ViewSet(viewsets.ModelViewSet):
     # permission_classes = [permissions.IsAdminUser] # Si quisieramos para todos los registrados: IsAuthenticated]
 
 
-class Recursos_Comunitarios_En_Alarma_ViewSet(viewsets.ModelViewSet):
+class Recursos_Comunitarios_En_Alarma_ViewSet(QueryPlannerMixin, Paginacion_Opcional_View, viewsets.ModelViewSet):
     """
     API endpoint para las empresas
     """
     queryset = Recursos_Comunitarios_En_Alarma.objects.all()
     serializer_class = Recursos_Comunitarios_En_Alarma_Serializer
+    # Paginación opcional por fecha de registro (?cursor=, ?page_size=)
+    cursor_ordering = ('-fecha_registro', '-id')
     # permission_classes = [permissions.IsAdminUser] # Si quisieramos para todos los registrados: IsAuthenticated]
 
     # Obtenemos el listado de recursos_comunitarios_en_alarma filtrado por los parametros GET
@@ -1154,12 +1274,11 @@ class Recursos_Comunitarios_En_Alarma_ViewSet(viewsets.ModelViewSet):
         queryset = self.filter_queryset(self.get_queryset())
 
         # Hacemos una búsqueda por los valores introducidos por parámetros
-        query = getQueryAnd(request.GET)
+        query = filter_query(request, self)
         if query:
             queryset = Recursos_Comunitarios_En_Alarma.objects.filter(query)
 
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+        return self.list_response(queryset)
 
     def create(self, request, *args, **kwargs):
         # Comprobamos que existe id_alarma
@@ -1211,7 +1330,7 @@ class Recursos_Comunitarios_En_Alarma_ViewSet(viewsets.ModelViewSet):
         return Response(recursos_comunitarios_en_alarma_serializer.data)
 
 
-class Alarma_ViewSet(viewsets.ModelViewSet):
+class Alarma_ViewSet(QueryPlannerMixin, Paginacion_Opcional_View, viewsets.ModelViewSet):
     """
     API endpoint para las alarmas
     """
@@ -1221,21 +1340,30 @@ class Alarma_ViewSet(viewsets.ModelViewSet):
 
     queryset = Alarma.objects.all()
     serializer_class = Alarma_Serializer
+    # Paginación opcional por fecha de registro (?cursor=, ?page_size=)
+    cursor_ordering = ('-fecha_registro', '-id')
+    # Filtros GET admitidos (ver rest_django/filter_schema.py)
+    filter_schema = FilterSchema(Alarma, {
+        'id': ('exact', 'in'),
+        'estado_alarma': ('exact', 'in'),
+        'fecha_registro': ('date', 'exact', 'gt', 'gte', 'lt', 'lte', 'range'),
+        'id_tipo_alarma': ('exact', 'in'),
+        'id_teleoperador': ('exact', 'in', 'isnull'),
+        'id_paciente_ucr': ('exact', 'in', 'isnull'),
+        'id_terminal': ('exact', 'in', 'isnull'),
+    }, ordering=('id', 'fecha_registro'))
     # permission_classes = [permissions.IsAdminUser] # Si quisieramos para todos los registrados: IsAuthenticated]
 
     def list(self, request, *args, **kwargs):
         queryset = self.filter_queryset(self.get_queryset())
 
-        # Hacemos una búsqueda por los valores introducidos por parámetros
-        query = getQueryAnd(request.GET)
+        # Hacemos una búsqueda por los valores introducidos por parámetros. Con fecha_registro (un día) se
+        # devuelven las alarmas de ese día, como un rango sobre el índice de la fecha
+        query = filter_query(request, self)
         if query:
-            if request.GET.getlist('fecha_registro'):
-                queryset = Alarma.objects.filter(fecha_registro__date=request.GET['fecha_registro'])
-            else:
-                queryset = Alarma.objects.filter(query)
+            queryset = Alarma.objects.filter(query)
 
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+        return self.list_response(queryset)
 
     # Definimos el metodo para crear la alarma
     def create(self, request, *args, **kwargs):
@@ -1312,7 +1440,7 @@ class Alarma_ViewSet(viewsets.ModelViewSet):
         alarma_serializer = Alarma_Serializer(alarma)
         return Response(alarma_serializer.data)
 
-class Alarma_Cancelar_ViewSet(viewsets.ModelViewSet):
+class Alarma_Cancelar_ViewSet(QueryPlannerMixin, Paginacion_Opcional_View, viewsets.ModelViewSet):
 
     queryset = Alarma.objects.all()
     serializer_class = Alarma_Serializer
@@ -1343,25 +1471,26 @@ class Alarma_Cancelar_ViewSet(viewsets.ModelViewSet):
         alarma_serializer = Alarma_Serializer(alarma)
         return Response(alarma_serializer.data)
 
-class Alarma_Programada_ViewSet(viewsets.ModelViewSet):
+class Alarma_Programada_ViewSet(QueryPlannerMixin, Paginacion_Opcional_View, viewsets.ModelViewSet):
     """
         API endpoint para las alarmas programadas
     """
 
     queryset = Alarma_Programada.objects.all()
     serializer_class = Alarma_Programada_Serializer
+    # Paginación opcional por fecha de registro (?cursor=, ?page_size=)
+    cursor_ordering = ('-fecha_registro', '-id')
     # permission_classes = [permissions.IsAdminUser] # Si quisieramos para todos los registrados: IsAuthenticated]
 
     def list(self, request, *args, **kwargs):
         queryset = self.filter_queryset(self.get_queryset())
 
         # Hacemos una búsqueda por los valores introducidos por parámetros
-        query = getQueryAnd(request.GET)
+        query = filter_query(request, self)
         if query:
             queryset = Alarma_Programada.objects.filter(query)
 
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+        return self.list_response(queryset)
 
     # Definimos el metodo para crear la alarma programad
     def create(self, request, *args, **kwargs):
@@ -1449,7 +1578,7 @@ class Alarma_Programada_ViewSet(viewsets.ModelViewSet):
         alarma_serializer = Alarma_Programada_Serializer(alarma_prog)
         return Response(alarma_serializer.data)
 
-class Dispositivos_Auxiliares_en_Terminal_ViewSet(viewsets.ModelViewSet):
+class Dispositivos_Auxiliares_en_Terminal_ViewSet(QueryPlannerMixin, Paginacion_Opcional_View, viewsets.ModelViewSet):
     """
     API endpoint para las empresas
     """
@@ -1461,12 +1590,11 @@ class Dispositivos_Auxiliares_en_Terminal_ViewSet(viewsets.ModelViewSet):
         queryset = self.filter_queryset(self.get_queryset())
 
         # Hacemos una búsqueda por los valores introducidos por parámetros
-        query = getQueryAnd(request.GET)
+        query = filter_query(request, self)
         if query:
             queryset = Dispositivos_Auxiliares_En_Terminal.objects.filter(query)
 
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+        return self.list_response(queryset)
 
     def create(self, request, *args, **kwargs):
         # Comprobamos que existe id_terminal
@@ -1514,24 +1642,25 @@ class Dispositivos_Auxiliares_en_Terminal_ViewSet(viewsets.ModelViewSet):
             (dispositivos_auxiliares_en_terminal)
         return Response(dispositivos_auxiliares_en_terminal_serializer.data)
 
-class Persona_Contacto_En_Alarma_ViewSet(viewsets.ModelViewSet):
+class Persona_Contacto_En_Alarma_ViewSet(QueryPlannerMixin, Paginacion_Opcional_View, viewsets.ModelViewSet):
     """
     API endpoint para las empresas
     """
     queryset = Persona_Contacto_En_Alarma.objects.all()
     serializer_class = Persona_Contacto_En_Alarma_Serializer
+    # Paginación opcional por fecha de registro (?cursor=, ?page_size=)
+    cursor_ordering = ('-fecha_registro', '-id')
     # permission_classes = [permissions.IsAdminUser] # Si quisieramos para todos los registrados: IsAuthenticated]
 
     def list(self, request, *args, **kwargs):
         queryset = self.filter_queryset(self.get_queryset())
 
         # Hacemos una búsqueda por los valores introducidos por parámetros
-        query = getQueryAnd(request.GET)
+        query = filter_query(request, self)
         if query:
             queryset = Persona_Contacto_En_Alarma.objects.filter(query)
 
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+        return self.list_response(queryset)
 
     def create(self, request, *args, **kwargs):
         # Comprobamos que existe la alarma
@@ -1580,7 +1709,7 @@ class Persona_Contacto_En_Alarma_ViewSet(viewsets.ModelViewSet):
         return Response(persona_contacto_en_alarma_serializer.data)
 
 
-class Gestion_Base_Datos_ViewSet(viewsets.ModelViewSet):
+class Gestion_Base_Datos_ViewSet(QueryPlannerMixin, Paginacion_Opcional_View, viewsets.ModelViewSet):
     """
     Gestion de la base de datos
     """
@@ -1662,7 +1791,7 @@ class Gestion_Base_Datos_ViewSet(viewsets.ModelViewSet):
         #Respuesta de error por defecto.
         return Response("La copia de la base de datos con id: "+parametro+" seleccionada no existe.", status=status.HTTP_400_BAD_REQUEST)
 
-class DesarrolladorTecnologiaViewSet(viewsets.ModelViewSet):
+class DesarrolladorTecnologiaViewSet(QueryPlannerMixin, Paginacion_Opcional_View, viewsets.ModelViewSet):
     """
     API endpoint para las empresas
     """
@@ -1680,7 +1809,7 @@ class DesarrolladorTecnologiaViewSet(viewsets.ModelViewSet):
 
 # Permite mostrar el seguimiento de los teleoperadores
 # Mostrando las alarmas y agendas resueltas
-class SeguimientoTeleoperador(viewsets.ModelViewSet):
+class SeguimientoTeleoperador(QueryPlannerMixin, Paginacion_Opcional_View, viewsets.ModelViewSet):
 
     queryset = User.objects.all()
     serializer_class = UserSerializer
@@ -1691,16 +1820,21 @@ class SeguimientoTeleoperador(viewsets.ModelViewSet):
         # Variable de respuesta
         json_response = []
         # Para este caso devolvemos todos los teleoperadores y el total de alarmas y agendas resueltas
-        user_search = User.objects.filter(groups__name="teleoperador")
+        user_search = list(User.objects.filter(groups__name="teleoperador"))
+        # Los totales de todos los teleoperadores en una consulta agrupada por modelo (los usuarios y las
+        # alarmas/agendas pueden estar en BBDD distintas, así que no se puede hacer con un JOIN)
+        ids = [usuario.id for usuario in user_search]
+        alarmas_total = dict(Alarma.objects.filter(id_teleoperador__in=ids).order_by()
+                             .values_list('id_teleoperador').annotate(total=Count('id')))
+        agendas_total = dict(Historico_Agenda_Llamadas.objects.filter(id_teleoperador__in=ids).order_by()
+                             .values_list('id_teleoperador').annotate(total=Count('id')))
         for usuario in user_search:
             usuario_json = {}
-            historico_agenda_llamadas = Historico_Agenda_Llamadas.objects.filter(id_teleoperador=usuario)
-            alarmas = Alarma.objects.filter(id_teleoperador=usuario)
             usuario_json["id"] = usuario.id
             usuario_json["first_name"] = usuario.first_name
             usuario_json["second_name"] = usuario.last_name
-            usuario_json["alarmas_total"] = alarmas.count()
-            usuario_json["agendas_total"] = historico_agenda_llamadas.count()
+            usuario_json["alarmas_total"] = alarmas_total.get(usuario.id, 0)
+            usuario_json["agendas_total"] = agendas_total.get(usuario.id, 0)
             json_response.append(usuario_json)
         return Response(json_response)
 
@@ -1714,8 +1848,9 @@ class SeguimientoTeleoperador(viewsets.ModelViewSet):
         user_search = User.objects.get(pk=kwargs['pk'])
         print(user_search)
         usuario_json = {}
-        historico_agenda_llamadas = Historico_Agenda_Llamadas.objects.filter(id_teleoperador=kwargs['pk'])
-        alarmas = Alarma.objects.filter(id_teleoperador=kwargs['pk'])
+        historico_agenda_llamadas = optimize_queryset(
+            Historico_Agenda_Llamadas.objects.filter(id_teleoperador=kwargs['pk']), Historico_Agenda_Llamadas_Serializer)
+        alarmas = optimize_queryset(Alarma.objects.filter(id_teleoperador=kwargs['pk']), Alarma_Serializer)
         usuario_json["id"] = user_search.id
         usuario_json["first_name"] = user_search.first_name
         usuario_json["second_name"] = user_search.last_name
@@ -1725,4 +1860,184 @@ class SeguimientoTeleoperador(viewsets.ModelViewSet):
         usuario_json["agendas"] = json.loads(json.dumps(Historico_Agenda_Llamadas_Serializer(historico_agenda_llamadas, many=True).data))
         usuario_json["alarmas"] = json.loads(json.dumps(Alarma_Serializer(alarmas, many=True).data))
         print (Historico_Agenda_Llamadas_Serializer(historico_agenda_llamadas, many=True).data)
-        return Response(usuario_json)
\ No newline at end of file
+        return Response(usuario_json)
+
+# Paginación por cursor (keyset) para los logs: no hace COUNT(*) ni OFFSET, así que cualquier página
+# cuesta lo mismo que la primera aunque la tabla tenga millones de registros
+class Logs_Pagination(CursorPagination):
+    ordering = ('-timestamp', '-id')
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+
+class Logs_Filtros_View():
+    """
+    Filtros comunes de las vistas de logs (parámetros GET):
+        desde / hasta: fecha (AAAA-MM-DD) o fecha y hora ISO 8601. `hasta` es exclusivo.
+        direccion_ip: IP exacta.
+    Cada vista añade en `filtros_exactos` los campos que admite como filtro por igualdad. Los valores se convierten
+    con el campo del modelo: un valor incorrecto (p. ej. ?user=abc) es un 400.
+    """
+    filtros_exactos = ()
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        params = self.request.query_params
+
+        desde = _parse_fecha_log(params, 'desde')
+        if desde is not None:
+            queryset = queryset.filter(timestamp__gte=desde)
+        hasta = _parse_fecha_log(params, 'hasta')
+        if hasta is not None:
+            queryset = queryset.filter(timestamp__lt=hasta)
+
+        for campo in ('direccion_ip',) + self.filtros_exactos:
+            valor = params.get(campo)
+            if valor:
+                queryset = queryset.filter(**{campo: _valor_filtro_log(queryset.model, campo, valor)})
+        return queryset
+
+
+def _valor_filtro_log(model, campo, valor):
+    field = model._meta.get_field(campo)
+    target = field.target_field if field.is_relation else field
+    # Los booleanos se aceptan también en minúsculas (?login_correcto=true), como en el resto de la API
+    if isinstance(target, BooleanField) and valor.lower() in ('true', 'false'):
+        return normalizar_booleano(valor)
+    try:
+        return target.to_python(valor)
+    except (DjangoValidationError, ValueError, TypeError):
+        raise ValidationError({campo: "Valor no válido: %s" % valor})
+
+
+def _parse_fecha_log(params, nombre):
+    valor = params.get(nombre)
+    if not valor:
+        return None
+    try:
+        fecha = parse_datetime(valor)
+        if fecha is None:
+            dia = parse_date(valor)
+            fecha = datetime.combine(dia, datetime.min.time()) if dia is not None else None
+    except ValueError:
+        fecha = None
+    if fecha is None:
+        raise ValidationError({nombre: "Fecha no válida, se espera AAAA-MM-DD o AAAA-MM-DDTHH:MM:SS"})
+    if timezone.is_naive(fecha):
+        fecha = timezone.make_aware(fecha)
+    return fecha
+
+
+class Logs_Acciones_Usuarios_ViewSet(Logs_Filtros_View, QueryPlannerMixin, viewsets.ReadOnlyModelViewSet):
+    """
+    Consulta de los logs de la API REST. Filtros: desde, hasta, user, ruta, metodo_http, estado_http, direccion_ip.
+    """
+    queryset = Logs_AccionesUsuarios.objects.all()
+    serializer_class = Logs_Acciones_Usuarios_Serializer
+    pagination_class = Logs_Pagination
+    permission_classes = [IsAdminMember | IsTeacherMember]
+    filtros_exactos = ('user', 'ruta', 'metodo_http', 'estado_http')
+
+    def get_queryset(self):
+        # El usuario está en la BBDD principal (los logs pueden estar en otra), se obtiene con una consulta por página
+        return super().get_queryset().prefetch_related('user')
+
+
+class Logs_Conexiones_Usuarios_ViewSet(Logs_Filtros_View, QueryPlannerMixin, viewsets.ReadOnlyModelViewSet):
+    """
+    Consulta de los logs de inicio de sesión. Filtros: desde, hasta, username, login_correcto, tipo_login, direccion_ip.
+    """
+    queryset = Logs_ConexionesUsuarios.objects.all()
+    serializer_class = Logs_Conexiones_Usuarios_Serializer
+    pagination_class = Logs_Pagination
+    permission_classes = [IsAdminMember | IsTeacherMember]
+    filtros_exactos = ('username', 'tipo_login', 'login_correcto')
+
+
+class Metricas_Rutas_ViewSet(viewsets.ViewSet):
+    """
+    Percentiles de duración (p50/p95/p99), consultas y bytes medios por ruta, de las peticiones atendidas
+    por este proceso desde su arranque (teleasistenciaApp/request_metrics.py).
+    Con ?ruta=/api-rest/alarma se filtran las rutas que empiecen así. Con POST a /reiniciar se ponen a cero.
+    """
+    permission_classes = [IsAdminMember | IsTeacherMember]
+
+    def list(self, request):
+        resumen = route_stats.summary()
+        ruta = request.query_params.get('ruta')
+        if ruta:
+            resumen = [r for r in resumen if r['ruta'].startswith(ruta)]
+        return Response(resumen)
+
+    @action(detail=False, methods=['post'])
+    def reiniciar(self, request):
+        route_stats.reset()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class Metricas_Conexiones_ViewSet(viewsets.ViewSet):
+    """
+    Estado de las conexiones de este proceso con cada BBDD (teleasistenciaApp/db_pool.py): peticiones en curso,
+    conexiones abiertas y libres, y esperas por falta de hueco. Sirve para ajustar settings.TENANT_CONNECTIONS.
+    """
+    permission_classes = [IsAdminMember | IsTeacherMember]
+
+    def list(self, request):
+        return Response(pool_stats())
+
+
+class Agregados_Tenants_ViewSet(viewsets.ViewSet):
+    """
+    Agregados de todas las BBDD de los tenants a la vez, para los informes de los administradores
+    (teleasistenciaApp/cross_tenant.py). GET lista los agregados disponibles y GET /<agregado> lo ejecuta.
+    Parámetros: desde, hasta (alarmas) y databases (alias separados por comas, por defecto todos).
+    """
+    permission_classes = [IsAdminMember]
+
+    def list(self, request):
+        return Response(sorted(AGGREGATES))
+
+    def retrieve(self, request, pk=None):
+        if pk not in AGGREGATES:
+            return Response("Error: No existe el agregado %s" % pk, status.HTTP_404_NOT_FOUND)
+
+        params = {
+            'desde': _parse_fecha_log(request.query_params, 'desde'),
+            'hasta': _parse_fecha_log(request.query_params, 'hasta'),
+        }
+        aliases = tenant_aliases()
+        if request.query_params.get('databases'):
+            seleccion = request.query_params['databases'].split(',')
+            desconocidas = [alias for alias in seleccion if alias not in aliases]
+            if desconocidas:
+                return Response("Error: No existen las bases de datos %s" % ', '.join(desconocidas),
+                                status.HTTP_400_BAD_REQUEST)
+            aliases = [alias for alias in aliases if alias in seleccion]
+        return Response(run_aggregate(pk, params, aliases))
+
+
+class Aprovisionamiento_Base_Datos_ViewSet(QueryPlannerMixin, viewsets.ReadOnlyModelViewSet):
+    """
+    Alta de la BBDD de un centro en segundo plano (teleasistenciaApp/provisioning.py).
+    POST con id_database lanza el alta y responde al momento (202), GET devuelve el estado y el progreso.
+    """
+    queryset = Aprovisionamiento_Base_Datos.objects.select_related('database').order_by('-fecha_inicio')
+    serializer_class = Aprovisionamiento_Base_Datos_Serializer
+    permission_classes = [IsAdminMember]
+
+    def create(self, request, *args, **kwargs):
+        try:
+            database = Database.objects.get(pk=request.data.get("id_database"))
+        except (Database.DoesNotExist, ValueError):
+            return Response("Error: No existe ninguna base de datos con ese id", 405)
+        if database.nameDescritive == 'default':
+            return Response("Error: La base de datos principal no se puede dar de alta", 405)
+        # Las altas que se quedaron a medias al reiniciar el servidor no impiden lanzarla otra vez
+        expire_stale_jobs(database)
+        if Aprovisionamiento_Base_Datos.objects.filter(database=database, estado__in=['Pendiente', 'En curso']).exists():
+            return Response("Error: Ya hay un alta en curso para esa base de datos", 409)
+
+        job = start_provisioning(database)
+        serializer = self.get_serializer(job)
+        return Response(serializer.data, status.HTTP_202_ACCEPTED)
@@ -0,0 +1,173 @@
+"""
+Grupos (roles) de los usuarios para los permisos de la API REST sin consultar la BBDD en cada petición.
+
+- Al hacer login (TokenObtainPairSerializerWithLastLogin) se guardan en el token los grupos del usuario
+  ('grupos') y la versión de sus grupos ('grupos_version'). Los grupos del token son los que se usan.
+- La versión es un entero por usuario guardado en la caché settings.USER_GROUPS_CACHE['CACHE'] (una consulta
+  a la caché por petición, sin BBDD). Se incrementa al cambiar los grupos del usuario: m2m_changed de User.groups
+  (admin, group.user_set...), UserViewSet.update y los cambios de nombre o borrado de un grupo.
+- `user_groups(request)` usa los grupos del token si su versión es la actual. Un token emitido antes de un cambio
+  no coincide y sólo entonces se consultan los grupos en la BBDD (que se guardan en el proceso con su versión,
+  igual que para las peticiones con sesión u OAuth2).
+- Si la versión no está en la caché (caducada tras 'TTL' segundos o descartada) se consulta la BBDD una vez y se
+  vuelve a guardar: la del token si sus grupos siguen siendo los actuales y si no una nueva.
+- Todo esto sólo con una caché compartida entre procesos (memcached, redis, BBDD...). Con una caché de cada proceso
+  (LocMemCache) los demás procesos no verían el cambio de versión y seguirían usando los grupos del token, así que
+  los grupos se leen de la BBDD en cada petición.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import Group, User
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from rest_framework_simplejwt.tokens import Token
+
+GROUPS_CLAIM = 'grupos'
+VERSION_CLAIM = 'grupos_version'
+VERSION_KEY = 'grupos_version:%s'
+
+# id de usuario -> (versión, grupos) leídos de la BBDD por este proceso
+_groups = {}
+_groups_lock = threading.Lock()
+
+
+# Backends de caché que no se comparten entre procesos
+_LOCAL_BACKENDS = ('LocMemCache', 'DummyCache')
+
+
+def _cache():
+    return caches[settings.USER_GROUPS_CACHE['CACHE']]
+
+
+def _shared_cache():
+    return type(_cache()).__name__ not in _LOCAL_BACKENDS
+
+
+def _new_version():
+    # Las versiones nuevas parten del reloj para no coincidir con las de los tokens emitidos antes de perderse la clave
+    return int(time.time() * 1000)
+
+
+def current_version(user_id):
+    """
+    Versión actual de los grupos del usuario (None si no está en la caché).
+    """
+    return _cache().get(VERSION_KEY % user_id)
+
+
+def bump_version(user_id):
+    """
+    Cambia la versión de los grupos del usuario: los tokens emitidos antes dejan de usarse para los permisos.
+    """
+    cache = _cache()
+    key = VERSION_KEY % user_id
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, _new_version(), settings.USER_GROUPS_CACHE['TTL'])
+
+
+def _bump_on_commit(user_ids, using):
+    # Al momento y otra vez al confirmar la transacción, por si otra petición leyó los grupos antes de confirmarse
+    def bump():
+        for user_id in user_ids:
+            bump_version(user_id)
+
+    bump()
+    transaction.on_commit(bump, using=using)
+
+
+def _lookup(user, token=None):
+    """
+    (grupos, versión) del usuario. Sólo consulta la BBDD si ni el token ni los grupos guardados en el proceso son
+    de la versión actual.
+    """
+    if not _shared_cache():
+        # Sin versión compartida no se puede saber si el token está al día
+        return frozenset(user.groups.values_list('name', flat=True)), None
+
+    cache = _cache()
+    key = VERSION_KEY % user.pk
+    version = cache.get(key)
+    if version is not None:
+        if token is not None and token.get(VERSION_CLAIM) == version:
+            return frozenset(token.get(GROUPS_CLAIM, ())), version
+        entry = _groups.get(user.pk)
+        if entry is not None and entry[0] == version:
+            return entry[1], version
+
+    groups = frozenset(user.groups.values_list('name', flat=True))
+    if version is None:
+        token_version = token.get(VERSION_CLAIM) if token is not None else None
+        if token_version is not None and frozenset(token.get(GROUPS_CLAIM, ())) == groups:
+            version = token_version
+        else:
+            version = _new_version()
+        if not cache.add(key, version, settings.USER_GROUPS_CACHE['TTL']):
+            # Otro proceso la ha guardado o cambiado antes
+            version = cache.get(key, version)
+    with _groups_lock:
+        _groups[user.pk] = (version, groups)
+    return groups, version
+
+
+def token_claims(user):
+    """
+    Claims con los grupos del usuario para añadir al token al hacer login.
+    """
+    groups, version = _lookup(user)
+    return {GROUPS_CLAIM: sorted(groups), VERSION_CLAIM: version}
+
+
+def user_groups(request):
+    """
+    Nombres de los grupos del usuario de la petición (se calcula una vez por petición).
+    """
+    groups = getattr(request, '_grupos', None)
+    if groups is not None:
+        return groups
+
+    user = request.user
+    if user is None or not user.is_authenticated:
+        groups = frozenset()
+    else:
+        token = getattr(request, 'auth', None)
+        groups, _ = _lookup(user, token if isinstance(token, Token) else None)
+    request._grupos = groups
+    return groups
+
+
+def has_group(request, name):
+    return name in user_groups(request)
+
+
+@receiver(m2m_changed, sender=User.groups.through, dispatch_uid='groups_version_m2m')
+def groups_changed(sender, instance, action, reverse, pk_set, using, **kwargs):
+    if not reverse:
+        if action.startswith('post_'):
+            _bump_on_commit([instance.pk], using)
+    elif action == 'pre_clear':
+        # group.user_set.clear(): no llega pk_set, los usuarios se leen antes de quitarlos
+        _bump_on_commit(list(instance.user_set.values_list('pk', flat=True)), using)
+    elif action.startswith('post_') and pk_set:
+        # group.user_set.add(...): pk_set son los usuarios
+        _bump_on_commit(list(pk_set), using)
+
+
+@receiver(post_save, sender=Group, dispatch_uid='groups_version_group_save')
+@receiver(pre_delete, sender=Group, dispatch_uid='groups_version_group_delete')
+def group_changed(sender, instance, using, **kwargs):
+    # Renombrar o borrar un grupo cambia los grupos de todos sus usuarios (uno recién creado no tiene)
+    if not kwargs.get('created'):
+        _bump_on_commit(list(instance.user_set.values_list('pk', flat=True)), using)
+
+
+@receiver(post_delete, sender=User, dispatch_uid='groups_version_user_delete')
+def user_deleted(sender, instance, **kwargs):
+    _cache().delete(VERSION_KEY % instance.pk)
+    with _groups_lock:
+        _groups.pop(instance.pk, None)
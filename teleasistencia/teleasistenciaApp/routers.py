@@ -0,0 +1,141 @@
+"""
+Routers de base de datos (settings.DATABASE_ROUTERS).
+
+Documentación: https://docs.djangoproject.com/en/3.2/topics/db/multi-db/#database-routers
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+
+# Modelos de logs, que pueden guardarse en una BBDD separada de los datos clínicos
+LOGS_MODELS = ('logs_accionesusuarios', 'logs_conexionesusuarios', 'logs_resumendiario')
+
+
+def logs_database():
+    """
+    Alias de la BBDD de logs (settings.LOGS_DATABASE). Si no está configurado en DATABASES se usa "default".
+    """
+    alias = getattr(settings, 'LOGS_DATABASE', 'default')
+    return alias if alias in connections.databases else 'default'
+
+
+def _is_logs_model(app_label, model_name):
+    return app_label == 'teleasistenciaApp' and model_name in LOGS_MODELS
+
+
+class LogsRouter:
+    """
+    Envía las lecturas y escrituras de los modelos de logs a settings.LOGS_DATABASE.
+
+    Con una BBDD de logs propia, las tablas crecen sin afectar a las copias de seguridad ni a las consultas
+    de la BBDD principal.
+    """
+
+    def db_for_read(self, model, **hints):
+        if _is_logs_model(model._meta.app_label, model._meta.model_name):
+            return logs_database()
+        # Las relaciones de un log (p.ej. log.user) se leen de la BBDD principal, no de la de logs
+        instance = hints.get('instance')
+        if instance is not None and _is_logs_model(instance._meta.app_label, instance._meta.model_name):
+            return 'default'
+        return None
+
+    def db_for_write(self, model, **hints):
+        return self.db_for_read(model, **hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Los logs referencian usuarios de otra BBDD (sin restricción de clave ajena)
+        if _is_logs_model(obj1._meta.app_label, obj1._meta.model_name) or \
+                _is_logs_model(obj2._meta.app_label, obj2._meta.model_name):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        logs_db = logs_database()
+        if model_name is not None and _is_logs_model(app_label, model_name):
+            return db == logs_db
+        # La BBDD de logs separada sólo contiene las tablas de logs
+        if logs_db != 'default' and db == logs_db:
+            return False
+        return None
+
+
+# ============================ Tenants ============================ #
+# Base de datos (alias de DATABASES) del tenant de la petición/tarea en curso. La fija TenantDatabaseMiddleware
+# en las peticiones, TenantConsumerMixin en los websockets y el scheduler para cada tenant.
+_current_tenant = ContextVar('tenant_database', default=None)
+
+# Apps y modelos comunes a todos los tenants, siempre en "default"
+SHARED_APPS = ('auth', 'contenttypes', 'sessions', 'admin', 'oauth2_provider', 'rest_framework_simplejwt')
+SHARED_MODELS = (
+    'database', 'database_user', 'imagen_user', 'gestion_base_datos',
+    'convocatoria_proyecto', 'desarrollador', 'tecnologia', 'desarrollador_tecnologia',
+    'aprovisionamiento_base_datos',
+)
+
+
+def current_tenant():
+    return _current_tenant.get()
+
+
+@contextmanager
+def use_tenant(alias):
+    """
+    Ejecuta el bloque con las consultas de los modelos de tenant dirigidas a `alias`.
+    """
+    token = _current_tenant.set(alias)
+    try:
+        yield
+    finally:
+        _current_tenant.reset(token)
+
+
+def tenant_aliases():
+    """
+    Alias de todas las bases de datos de tenants configuradas (la principal incluida).
+    """
+    from .models import Database
+    aliases = ['default']
+    for alias in Database.objects.using('default').values_list('nameDescritive', flat=True):
+        if alias in connections.databases and alias not in aliases and alias != logs_database():
+            aliases.append(alias)
+    return aliases
+
+
+def _is_shared_model(app_label, model_name):
+    return app_label in SHARED_APPS or (app_label == 'teleasistenciaApp' and model_name in SHARED_MODELS)
+
+
+class TenantRouter:
+    """
+    Envía las consultas de los modelos de datos (alarmas, pacientes, agendas...) a la base de datos del tenant
+    en curso (`use_tenant`), de forma que los ViewSets que usan `Model.objects` directamente también trabajan
+    sobre la BBDD del usuario.
+
+    Sin tenant en curso, o para los modelos comunes, no decide y Django usa "default" (o la BBDD de la
+    instancia relacionada). Los `.using()` explícitos siguen teniendo prioridad.
+    """
+
+    def db_for_read(self, model, **hints):
+        if _is_shared_model(model._meta.app_label, model._meta.model_name):
+            return None
+        # Las relaciones de una instancia se leen de la misma BBDD de la que salió
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db is not None:
+            return None
+        alias = _current_tenant.get()
+        if alias is not None and alias in connections.databases:
+            return alias
+        return None
+
+    def db_for_write(self, model, **hints):
+        return self.db_for_read(model, **hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Los usuarios se copian en las BBDD de los tenants, las relaciones con modelos comunes se permiten
+        if _is_shared_model(obj1._meta.app_label, obj1._meta.model_name) or \
+                _is_shared_model(obj2._meta.app_label, obj2._meta.model_name):
+            return True
+        return None
@@ -0,0 +1,30 @@
+"""
+Señales que mantienen al día las cachés del proceso. Se registran en TeleasistenciaAppConfig.ready().
+"""
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from . import databases
+from .models import Database, Database_User
+from .rest_django.utils import tenant_cache
+
+
+@receiver(post_save, sender=Database_User, dispatch_uid='tenant_cache_database_user_save')
+@receiver(post_delete, sender=Database_User, dispatch_uid='tenant_cache_database_user_delete')
+def invalidate_tenant_user(sender, instance, **kwargs):
+    tenant_cache.invalidate(instance.user_id)
+
+
+@receiver(post_save, sender=Database, dispatch_uid='tenant_cache_database_save')
+@receiver(post_delete, sender=Database, dispatch_uid='tenant_cache_database_delete')
+def invalidate_tenant_database(sender, instance, **kwargs):
+    # Puede haber cambiado el alias (nameDescritive) de todos los usuarios de la BBDD
+    tenant_cache.invalidate()
+
+
+@receiver(post_save, sender=Database, dispatch_uid='tenant_databases_save')
+@receiver(post_delete, sender=Database, dispatch_uid='tenant_databases_delete')
+def register_tenant_databases(sender, instance, using, **kwargs):
+    # Se espera al commit para que el resto de procesos lean ya la tabla con el cambio
+    transaction.on_commit(databases.notify_changed, using=using)
@@ -1,3 +1,1599 @@
-from django.test import TestCase
+import asyncio
+import concurrent.futures
+import contextlib
+import datetime
+import gzip
+import io
+import json
+import logging
+import os
+import queue
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.contrib import messages
+from django.contrib.auth.models import Group, User
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.db import OperationalError, connections, router
+from django.db.models import Q
+from django.http import HttpResponse, QueryDict
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve
+from django.utils import timezone
+from django.utils.timezone import now
+from rest_framework.relations import PrimaryKeyRelatedField
+from rest_framework.serializers import ModelSerializer
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+from rest_framework_simplejwt.views import TokenObtainPairView
+
+from schedulerApp import apps as scheduler
+from teleasistencia import views as teleasistencia_views
+from utilidad import logging as utilidad_logging
+from utilidad import metricas
+from utilidad.metricas import registry
+
+from . import middleware
+from .admin import Database_form_admin
+from .authentication import CachedJWTAuthentication, UserCache, user_cache
+from . import (cross_tenant, databases, db_pool, hashing, login_throttle, logs_archive, provisioning, request_metrics,
+               roles, routers, user_import)
+from .log_policy import LogPolicy
+from .log_writer import BatchWriter, LogWriter
+from .models import (Agenda, Alarma, Alarma_Programada, Aprovisionamiento_Base_Datos, Database, Database_User,
+                     Historico_Agenda_Llamadas, Logs_AccionesUsuarios, Logs_ConexionesUsuarios, Logs_ResumenDiario,
+                     Persona, Terminal, Tipo_Agenda, Tipo_Alarma)
+from .rest_django.utils import getTenantByUser, tenant_cache
+from .routers import LogsRouter, current_tenant, logs_database, use_tenant
+from .rest_django.filter_schema import Filter, FilterSchema, indexed_fields, schema_for
+from .rest_django import query_planner, sparse_fields, views_rest
+from .rest_django.serializers import Agenda_Serializer, Tipo_Alarma_Serializer, UserSerializer
+from .rest_django.views_rest import Agenda_ViewSet, Alarma_ViewSet
+
+
+class _ListWriter(BatchWriter):
+    # Escritor de prueba: guarda cada lote en una lista
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batches = []
+
+    def flush_batch(self, items):
+        self.batches.append(list(items))
+
+
+class EscritorPorLotesTests(TestCase):
+    databases = '__all__'
+
+    def test_flush_vuelca_por_lotes(self):
+        writer = _ListWriter('EscritorTestLotes', batch_size=2)
+        with mock.patch.object(writer, '_ensure_started'):
+            for item in range(5):
+                writer.enqueue(item)
+        writer.flush()
+        self.assertEqual(writer.batches, [[0, 1], [2, 3], [4]])
+        self.assertEqual(writer.stats()['written'], 5)
+        self.assertEqual(writer.stats()['queue_depth'], 0)
+
+    def test_cola_llena_descarta_sin_bloquear(self):
+        writer = _ListWriter('EscritorTestDescartes', max_queue_size=2)
+        with mock.patch.object(writer, '_ensure_started'):
+            self.assertEqual([writer.enqueue(item) for item in range(4)], [True, True, False, False])
+        self.assertEqual(writer.dropped, 2)
+        self.assertIn('teleasistencia_escritor_descartados_total{escritor="EscritorTestDescartes"} 2',
+                      registry.exposition())
+
+    def test_error_al_guardar_cuenta_como_fallido(self):
+        writer = _ListWriter('EscritorTestFallos')
+        with mock.patch.object(writer, '_ensure_started'), \
+                mock.patch.object(writer, 'flush_batch', side_effect=RuntimeError('BBDD caída')):
+            writer.enqueue(1)
+            writer.flush()
+        self.assertEqual((writer.written, writer.failed), (0, 1))
+        self.assertIn('teleasistencia_escritor_fallidos_total{escritor="EscritorTestFallos"} 1', registry.exposition())
+
+    def test_stop_vuelca_lo_pendiente(self):
+        writer = _ListWriter('EscritorTestParada', batch_size=1000, flush_interval_ms=50)
+        for item in range(10):
+            writer.enqueue(item)
+        writer.stop()
+        self.assertFalse(writer._thread.is_alive())
+        self.assertEqual(sorted(item for batch in writer.batches for item in batch), list(range(10)))
+        exposition = registry.exposition()
+        self.assertIn('teleasistencia_escritor_escritos_total{escritor="EscritorTestParada"} 10', exposition)
+        self.assertIn('teleasistencia_escritor_cola{escritor="EscritorTestParada"} 0', exposition)
+
+    def test_log_writer_guarda_con_bulk_create(self):
+        writer = LogWriter('LogWriterTest')
+        with mock.patch.object(writer, '_ensure_started'):
+            writer.enqueue(Logs_AccionesUsuarios, dict(direccion_ip='127.0.0.1', ruta='/api-rest/alarma',
+                                                       metodo_http='GET', estado_http='200'))
+            writer.enqueue(Logs_ConexionesUsuarios, Logs_ConexionesUsuarios(direccion_ip='127.0.0.1',
+                                                                             username='ana', tipo_login='OTRO'))
+        writer.flush()
+        self.assertTrue(Logs_AccionesUsuarios.objects.filter(ruta='/api-rest/alarma').exists())
+        self.assertTrue(Logs_ConexionesUsuarios.objects.filter(username='ana').exists())
+
+
+class LoggingMiddlewareTests(TestCase):
+
+    def test_no_lee_el_body_fuera_del_login(self):
+        request = RequestFactory().post('/api-rest/users', {'nombre': 'ana'})
+        self.assertIsNone(middleware._read_login_body(request))
+        # El body sigue sin leer: las subidas pasan por los upload handlers
+        self.assertFalse(hasattr(request, '_body'))
+
+    def test_username_del_login_en_json_y_urlencoded(self):
+        factory = RequestFactory()
+        json_request = factory.post('/api/token/', '{"username": "ana"}', content_type='application/json')
+        form_request = factory.post('/api/token/', 'username=luis&password=x',
+                                    content_type='application/x-www-form-urlencoded')
+        self.assertEqual(middleware._extract_username(middleware._read_login_body(json_request)), 'ana')
+        self.assertEqual(middleware._extract_username(middleware._read_login_body(form_request)), 'luis')
+
+    @override_settings(LOGS_LOGIN_BODY_MAX_SIZE=10)
+    def test_body_de_login_demasiado_grande(self):
+        request = RequestFactory().post('/api/token/', '{"username": "ana"}', content_type='application/json')
+        self.assertIsNone(middleware._read_login_body(request))
+
+    def test_modo_asincrono_registra_el_login(self):
+        async def get_response(request):
+            return HttpResponse(status=200)
+
+        logging_middleware = middleware.LoggingMiddleware(get_response)
+        request = RequestFactory().post('/api/token/', '{"username": "ana"}', content_type='application/json')
+        with mock.patch.object(middleware.log_writer, 'enqueue', return_value=True) as enqueue:
+            response = async_to_sync(logging_middleware)(request)
+        self.assertEqual(response.status_code, 200)
+        (model, log), _ = enqueue.call_args
+        self.assertIs(model, Logs_ConexionesUsuarios)
+        self.assertEqual((log.username, log.login_correcto, log.tipo_login), ('ana', True, 'TOKEN_API'))
+
+
+    def test_ruta_larga_se_recorta_a_la_columna(self):
+        request = RequestFactory().get('/api-rest/' + 'a' * 300)
+        request.user = User(pk=1, username='ana')
+        with mock.patch.object(middleware.log_writer, 'enqueue', return_value=True) as enqueue:
+            middleware._log_action_request(request, HttpResponse(status=404), {})
+        (model, log), _ = enqueue.call_args
+        self.assertEqual(len(log['ruta']), Logs_AccionesUsuarios._meta.get_field('ruta').max_length)
+
+class RetencionLogsTests(TestCase):
+    databases = '__all__'
+
+    def crear_log(self, timestamp, ruta='/api-rest/alarma/12', user_id=None):
+        return Logs_AccionesUsuarios.objects.using(logs_database()).create(
+            timestamp=timestamp, direccion_ip='127.0.0.1', user_id=user_id, ruta=ruta, metodo_http='GET',
+            estado_http='200')
+
+    def test_normalize_route_agrupa_los_ids(self):
+        self.assertEqual(logs_archive.normalize_route('/api-rest/alarma/12/'), '/api-rest/alarma/{id}/')
+        self.assertEqual(logs_archive.normalize_route('/api-rest/alarma_programada'), '/api-rest/alarma_programada')
+
+    def test_resumen_diario_agrupa_por_ruta_normalizada(self):
+        day = datetime.date(2024, 1, 15)
+        start = timezone.make_aware(datetime.datetime(2024, 1, 15, 10))
+        self.crear_log(start, '/api-rest/alarma/1')
+        self.crear_log(start, '/api-rest/alarma/2')
+        self.crear_log(start + datetime.timedelta(days=1), '/api-rest/alarma/3')
+
+        self.assertEqual(logs_archive.rollup_day(day), 1)
+        resumen = Logs_ResumenDiario.objects.using(logs_database()).get(fecha=day)
+        self.assertEqual((resumen.ruta, resumen.total), ('/api-rest/alarma/{id}', 2))
+
+    def test_archivado_por_meses_borra_de_la_bbdd(self):
+        today = datetime.date(2024, 3, 10)
+        self.crear_log(timezone.make_aware(datetime.datetime(2024, 1, 5)))
+        self.crear_log(timezone.make_aware(datetime.datetime(2024, 2, 5)))
+        reciente = self.crear_log(timezone.make_aware(datetime.datetime(2024, 3, 9)))
+
+        with tempfile.TemporaryDirectory() as directory:
+            archived = logs_archive.archive_expired(Logs_AccionesUsuarios, today=today, retention_days=30,
+                                                    archive_dir=directory)
+            self.assertEqual(archived, 2)
+            files = sorted(os.listdir(directory))
+            self.assertEqual(files, ['teleasistenciaApp_logs_accionesusuarios_2024-01.jsonl.gz',
+                                     'teleasistenciaApp_logs_accionesusuarios_2024-02.jsonl.gz'])
+            with gzip.open(os.path.join(directory, files[0]), 'rt') as f:
+                self.assertEqual(json.loads(f.readline())['ruta'], '/api-rest/alarma/12')
+        self.assertEqual(list(Logs_AccionesUsuarios.objects.using(logs_database()).values_list('pk', flat=True)),
+                         [reciente.pk])
+
+    def test_archivado_interrumpido_no_duplica_logs(self):
+        # Un fallo después de escribir el fichero y antes de borrar los logs no los repite en la siguiente ejecución
+        today = datetime.date(2024, 3, 10)
+        self.crear_log(timezone.make_aware(datetime.datetime(2024, 1, 5)))
+        self.crear_log(timezone.make_aware(datetime.datetime(2024, 1, 6)))
+
+        with tempfile.TemporaryDirectory() as directory:
+            with mock.patch('django.db.models.query.QuerySet.delete', side_effect=OperationalError):
+                with self.assertRaises(OperationalError):
+                    logs_archive.archive_expired(Logs_AccionesUsuarios, today=today, retention_days=30,
+                                                 archive_dir=directory)
+            self.assertEqual(logs_archive.archive_expired(Logs_AccionesUsuarios, today=today, retention_days=30,
+                                                          archive_dir=directory), 0)
+            self.assertEqual(os.listdir(directory), ['teleasistenciaApp_logs_accionesusuarios_2024-01.jsonl.gz'])
+            with gzip.open(os.path.join(directory, 'teleasistenciaApp_logs_accionesusuarios_2024-01.jsonl.gz'),
+                           'rt') as f:
+                self.assertEqual(len(f.readlines()), 2)
+        self.assertFalse(Logs_AccionesUsuarios.objects.using(logs_database()).exists())
+
+    def test_router_envia_los_logs_a_su_bbdd(self):
+        router_logs = LogsRouter()
+        with override_settings(LOGS_DATABASE='db2'):
+            self.assertEqual(router_logs.db_for_write(Logs_AccionesUsuarios), 'db2')
+            self.assertIsNone(router_logs.db_for_read(Alarma))
+            self.assertFalse(router_logs.allow_migrate('default', 'teleasistenciaApp', 'logs_accionesusuarios'))
+        with override_settings(LOGS_DATABASE='no_configurada'):
+            self.assertEqual(router_logs.db_for_read(Logs_ConexionesUsuarios), 'default')
+
+
+def crear_usuario(username, *grupos):
+    # Usuario de prueba con los grupos indicados (se crean si no existen)
+    user = User.objects.create_user(username, password='Prueba-Test-1')
+    for nombre in grupos:
+        user.groups.add(Group.objects.get_or_create(name=nombre)[0])
+    return user
+
+
+def cliente(user):
+    client = APIClient()
+    client.force_authenticate(user)
+    return client
+
+
+class ApiTestCase(TestCase):
+    """
+    Peticiones a la API: los logs que encola el LoggingMiddleware no se guardan (el hilo escritor usaría su propia
+    conexión, fuera de la transacción del test).
+    """
+    databases = '__all__'
+
+    def setUp(self):
+        patcher = mock.patch.object(middleware.log_writer, 'enqueue', return_value=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class ApiLogsTests(ApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.profesor = crear_usuario('profesor_logs', 'profesor')
+        for estado in ('200', '404'):
+            Logs_AccionesUsuarios.objects.using(logs_database()).create(
+                direccion_ip='10.0.0.1', user_id=self.profesor.pk, ruta='/api-rest/alarma', metodo_http='GET',
+                estado_http=estado)
+        Logs_ConexionesUsuarios.objects.using(logs_database()).create(
+            direccion_ip='10.0.0.1', username='profesor_logs', login_correcto=True, tipo_login='TOKEN_API')
+
+    def test_filtros_y_paginacion_por_cursor(self):
+        response = cliente(self.profesor).get('/api-rest/logs_acciones_usuarios',
+                                               {'user': self.profesor.pk, 'estado_http': '404', 'page_size': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([log['estado_http'] for log in response.data['results']], ['404'])
+        self.assertNotIn('count', response.data)
+
+    def test_valores_no_validos_son_400(self):
+        client = cliente(self.profesor)
+        for params in ({'user': 'abc'}, {'desde': 'ayer'}):
+            response = client.get('/api-rest/logs_acciones_usuarios', params)
+            self.assertEqual(response.status_code, 400, params)
+        response = client.get('/api-rest/logs_conexiones_usuarios', {'login_correcto': 'quizas'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_booleanos_en_minusculas(self):
+        client = cliente(self.profesor)
+        response = client.get('/api-rest/logs_conexiones_usuarios', {'login_correcto': 'true'})
+        self.assertEqual(len(response.data['results']), 1)
+        response = client.get('/api-rest/logs_conexiones_usuarios', {'login_correcto': 'false'})
+        self.assertEqual(len(response.data['results']), 0)
+
+    def test_solo_administradores_y_profesores(self):
+        teleoperador = crear_usuario('teleoperador_logs', 'teleoperador')
+        self.assertEqual(cliente(teleoperador).get('/api-rest/logs_acciones_usuarios').status_code, 403)
+
+
+class LimiteLoginTests(TestCase):
+
+    def test_ventana_deslizante_en_memoria(self):
+        window = login_throttle.SlidingWindow()
+        with mock.patch('time.monotonic', return_value=100.0):
+            self.assertEqual(window.hit('ip:1', 2, 60), 0)
+        with mock.patch('time.monotonic', return_value=130.0):
+            self.assertEqual([window.hit('ip:1', 2, 60) for _ in range(2)], [0, 30.0])
+        # El primer intento sale de la ventana a los 60 s y deja un hueco
+        with mock.patch('time.monotonic', return_value=160.5):
+            self.assertEqual(window.hit('ip:1', 2, 60), 0)
+            self.assertGreater(window.hit('ip:1', 2, 60), 0)
+        window.reset('ip:1', 60)
+        self.assertEqual(window.hit('ip:1', 2, 60), 0)
+
+    @override_settings(CACHES={'throttle': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                            'LOCATION': 'login-throttle-test'}})
+    def test_ventana_aproximada_en_cache(self):
+        window = login_throttle.CacheSlidingWindow('throttle')
+        # Mitad de la ventana: los 2 intentos de la anterior cuentan como 1
+        with mock.patch('time.time', return_value=600.0 - 60):
+            self.assertEqual([window.hit('user:ana', 3, 60) for _ in range(2)], [0, 0])
+        with mock.patch('time.time', return_value=630.0):
+            self.assertEqual([window.hit('user:ana', 3, 60) for _ in range(2)], [0, 0])
+            self.assertEqual(window.hit('user:ana', 3, 60), 30.0)
+
+    @override_settings(LOGIN_THROTTLE={'IP': (10, 60), 'USERNAME': (2, 60), 'CACHE': None})
+    def test_limite_por_usuario_y_reinicio_tras_login_correcto(self):
+        with mock.patch.object(login_throttle, '_backend', login_throttle.SlidingWindow()):
+            self.assertEqual(login_throttle.check_login('10.0.0.1', 'Ana'), 0)
+            self.assertEqual(login_throttle.check_login('10.0.0.2', 'ana'), 0)
+            self.assertGreater(login_throttle.check_login('10.0.0.3', 'ANA'), 0)
+            login_throttle.login_succeeded('ana')
+            self.assertEqual(login_throttle.check_login('10.0.0.4', 'ana'), 0)
+
+
+    @override_settings(LOGIN_THROTTLE={'IP': (3, 60), 'USERNAME': (5, 60), 'CACHE': None})
+    def test_la_ip_solo_cuenta_los_intentos_fallidos(self):
+        with mock.patch.object(login_throttle, '_backend', login_throttle.SlidingWindow()):
+            # Un centro entero entrando desde la misma IP
+            for i in range(10):
+                self.assertEqual(login_throttle.check_login('10.0.0.1', 'teleoperador%s' % i), 0)
+            for _ in range(3):
+                login_throttle.login_failed('10.0.0.1')
+            self.assertGreater(login_throttle.check_login('10.0.0.1', 'otro'), 0)
+            self.assertEqual(login_throttle.check_login('10.0.0.2', 'otro'), 0)
+
+class MetricasPeticionTests(ApiTestCase):
+
+    def test_cuenta_consultas_y_bytes(self):
+        token = request_metrics.start_request()
+        list(User.objects.all())
+        list(Group.objects.all())
+        metrics = request_metrics.finish_request(token, HttpResponse(b'12345'))
+        self.assertEqual((metrics['num_consultas'], metrics['bytes_respuesta']), (2, 5))
+        self.assertGreaterEqual(metrics['duracion_ms'], metrics['duracion_consultas_ms'])
+
+    def test_ruta_de_la_urlconf(self):
+        factory = RequestFactory()
+        request = factory.get('/api-rest/alarma/12')
+        request.resolver_match = resolve('/api-rest/alarma/12')
+        self.assertEqual(request_metrics.request_route(request), '/api-rest/alarma/{pk}')
+        # Sin resolver (404) todas las URLs van a la misma ruta
+        self.assertEqual(request_metrics.request_route(factory.get('/api-rest/wp-login.php')), 'otros')
+
+    def test_numero_de_rutas_limitado(self):
+        stats = request_metrics.RouteStats(reservoir_size=2, max_routes=2)
+        for i in range(5):
+            stats.observe('GET', '/ruta/%s' % i, 10.0 * i, 1, 100)
+        rutas = {(r['ruta'], r['peticiones']) for r in stats.summary()}
+        self.assertEqual(rutas, {('/ruta/0', 1), ('/ruta/1', 1), ('otros', 3)})
+        # El reservorio no pasa de reservoir_size duraciones
+        self.assertEqual(len(stats._routes[('GET', 'otros')]['samples']), 2)
+
+    def test_peticiones_a_rutas_desconocidas_no_crean_rutas(self):
+        request_metrics.route_stats.reset()
+        user = crear_usuario('profesor_metricas', 'profesor')
+        client = cliente(user)
+        for path in ('/api-rest/scan-%s' % i for i in range(3)):
+            client.get(path)
+        client.get('/api-rest/metricas_rutas')
+        response = client.get('/api-rest/metricas_rutas')
+        rutas = {r['ruta'] for r in response.data}
+        self.assertEqual(rutas, {'otros', '/api-rest/metricas_rutas'})
+
+
+class MetricasPrometheusTests(ApiTestCase):
+
+    def test_formato_de_exposicion(self):
+        contador = metricas.counter('test_peticiones_total', 'Peticiones de prueba', ['ruta'])
+        histograma = metricas.histogram('test_duracion_segundos', 'Duración de prueba', buckets=(0.1, 1))
+        # Cada hilo escribe en su propio diccionario y /metrics suma todos
+        hilos = [threading.Thread(target=lambda: contador.labels('/a"b').inc(2)) for _ in range(3)]
+        for hilo in hilos:
+            hilo.start()
+        for hilo in hilos:
+            hilo.join()
+        histograma.observe(0.05)
+        histograma.observe(0.5)
+        exposition = registry.exposition()
+        self.assertIn('# TYPE test_peticiones_total counter', exposition)
+        self.assertIn('test_peticiones_total{ruta="/a\\"b"} 6', exposition)
+        self.assertIn('test_duracion_segundos_bucket{le="0.1"} 1', exposition)
+        self.assertIn('test_duracion_segundos_bucket{le="+Inf"} 2', exposition)
+        self.assertIn('test_duracion_segundos_count 2', exposition)
+
+    @override_settings(METRICS_TOKEN='secreto')
+    def test_acceso_con_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer otro').status_code, 401)
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secreto')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+
+    @override_settings(METRICS_TOKEN=None)
+    def test_sin_token_solo_el_personal(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        user = crear_usuario('no_staff_metricas')
+        self.client.force_login(user)
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        user.is_staff = True
+        user.save()
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+
+    def test_multiproceso_ignora_ficheros_ajenos(self):
+        # Sin el hilo escritor: seguiría escribiendo en el directorio temporal después del test
+        with tempfile.TemporaryDirectory() as directory, override_settings(METRICS_MULTIPROCESS_DIR=directory), \
+                mock.patch.object(registry, '_ensure_writer'):
+            with open(os.path.join(directory, 'config.json'), 'w') as f:
+                f.write('{}')
+            metricas.counter('test_multiproceso_total', 'Prueba multiproceso').inc()
+            self.assertIn('test_multiproceso_total 1', registry.exposition())
+
+    def test_el_hilo_escritor_sobrevive_a_los_errores(self):
+        with override_settings(METRICS_FLUSH_INTERVAL=0), \
+                mock.patch.object(metricas, 'error') as error, \
+                mock.patch.object(registry, 'write_process_file', side_effect=[TypeError, KeyboardInterrupt]):
+            with self.assertRaises(KeyboardInterrupt):
+                registry._write_loop()
+        error.assert_called_once()
+
+    def test_etiquetas_acotadas(self):
+        client = cliente(crear_usuario('profesor_etiquetas', 'profesor'))
+        client.get('/api-rest/scan-etiquetas-1')
+        client.generic('PROPFIND', '/api-rest/metricas_rutas')
+        samples = middleware.HTTP_PETICIONES.samples()
+        self.assertNotIn('/api-rest/scan-etiquetas-1', {ruta for ruta, _, _ in samples})
+        self.assertIn(('/api-rest/metricas_rutas', 'otros', '405'), samples)
+
+
+class CacheUsuariosJWTTests(TestCase):
+
+    def setUp(self):
+        user_cache.clear()
+        self.user = crear_usuario('usuario_jwt')
+        self.raw_token = str(AccessToken.for_user(self.user)).encode()
+
+    def autenticar(self):
+        request = RequestFactory().get('/api-rest/alarma', HTTP_AUTHORIZATION='Bearer %s' % self.raw_token.decode())
+        return CachedJWTAuthentication().authenticate(request)
+
+    def test_segunda_peticion_sin_consultas(self):
+        self.assertEqual(self.autenticar()[0].pk, self.user.pk)
+        with self.assertNumQueries(0):
+            user, token = self.autenticar()
+        self.assertEqual(user.pk, self.user.pk)
+        # Cada petición recibe su propia copia del usuario
+        self.assertIsNot(user, self.autenticar()[0])
+
+    def test_guardar_el_usuario_invalida_sus_tokens(self):
+        self.autenticar()
+        self.user.is_active = False
+        self.user.save()
+        self.assertIsNone(user_cache.get(self.raw_token))
+
+    def test_caducidad_y_tamano_maximo(self):
+        cache = UserCache(ttl=60, max_size=2)
+        tokens = [b'a.b.firma%d' % i for i in range(3)]
+        for raw in tokens:
+            cache.set(raw, {'exp': time.time() + 3600}, self.user)
+        # Se descarta la entrada menos usada
+        self.assertIsNone(cache.get(tokens[0]))
+        self.assertIsNotNone(cache.get(tokens[2]))
+        # Nunca más allá de la caducidad del token
+        cache.set(b'a.b.caducado', {'exp': time.time() - 1}, self.user)
+        self.assertIsNone(cache.get(b'a.b.caducado'))
+        with mock.patch('time.time', return_value=time.time() + 61):
+            self.assertIsNone(cache.get(tokens[2]))
+
+
+class UtilidadLoggingTests(TestCase):
+
+    def setUp(self):
+        self.salida = io.StringIO()
+        self.addCleanup(utilidad_logging.configure)
+
+    def configurar(self, **config):
+        with mock.patch('sys.stdout', self.salida):
+            utilidad_logging.configure(config)
+
+    def lineas(self):
+        utilidad_logging.flush()
+        return self.salida.getvalue().splitlines()
+
+    def test_nivel_por_etiqueta_sin_formatear_lo_desactivado(self):
+        self.configurar(LEVEL='INFO', TAGS={'Ruidosa': 'WARNING'})
+        argumento = mock.MagicMock()
+        utilidad_logging.yellow('Ruidosa', 'valor %s', argumento)
+        utilidad_logging.green('Normal', 'hola %s', 'mundo')
+        # El mensaje desactivado no llega a formatearse
+        argumento.__str__.assert_not_called()
+        self.assertEqual(self.lineas(), ['[%sNormal%s]: hola mundo' % (utilidad_logging.FG_GREEN,
+                                                                      utilidad_logging.RESET)])
+
+    def test_formato_json(self):
+        self.configurar(JSON=True)
+        utilidad_logging.error('fallo %s', 3)
+        linea = json.loads(self.lineas()[0])
+        self.assertEqual((linea['level'], linea['tag'], linea['msg']), ('ERROR', 'ERROR', 'fallo 3'))
+
+    def test_cola_llena_descarta_sin_bloquear(self):
+        handler = utilidad_logging._DropQueueHandler(queue.Queue(maxsize=1))
+        dropped = utilidad_logging._DropQueueHandler.dropped
+        for i in range(3):
+            handler.emit(logging.LogRecord('t', logging.INFO, __file__, 1, 'm %s', (i,), None))
+        self.assertEqual(utilidad_logging._DropQueueHandler.dropped - dropped, 2)
+        self.assertEqual(handler.queue.get_nowait().msg, 'm 0')
+
+
+class PoliticaLogsTests(TestCase):
+
+    def setUp(self):
+        self.policy = LogPolicy(read_rate=1.0, sampling={'/api-rest/alarma': 0.25, '/api-rest/alarma/historico': 0},
+                                ignore=['/api-rest/metricas_rutas'])
+
+    def test_prefijos_por_segmentos_completos(self):
+        with mock.patch('random.random', return_value=0.5):
+            self.assertFalse(self.policy.should_log('GET', '/api-rest/alarma/5'))
+            # alarma_programada no es un segmento de /api-rest/alarma: lectura por defecto
+            self.assertTrue(self.policy.should_log('GET', '/api-rest/alarma_programada'))
+        with mock.patch('random.random', return_value=0.1):
+            self.assertTrue(self.policy.should_log('GET', '/api-rest/alarma'))
+
+    def test_gana_el_prefijo_mas_largo(self):
+        with mock.patch('random.random', return_value=0.0):
+            self.assertFalse(self.policy.should_log('GET', '/api-rest/alarma/historico/3'))
+
+    def test_escrituras_siempre_salvo_rutas_ignoradas(self):
+        self.assertTrue(self.policy.should_log('POST', '/api-rest/alarma/historico'))
+        self.assertTrue(self.policy.should_log('DELETE', '/api-rest/alarma/3'))
+        self.assertFalse(self.policy.should_log('POST', '/api-rest/metricas_rutas/reiniciar'))
+        self.assertFalse(self.policy.should_log('GET', '/api-rest/metricas_rutas'))
+
+    def test_ruta_exacta_solo_el_listado(self):
+        policy = LogPolicy(sampling={'/api-rest/alarma$': 0})
+        self.assertFalse(policy.should_log('GET', '/api-rest/alarma'))
+        self.assertFalse(policy.should_log('GET', '/api-rest/alarma/'))
+        self.assertTrue(policy.should_log('GET', '/api-rest/alarma/5'))
+        self.assertTrue(policy.should_log('POST', '/api-rest/alarma'))
+
+    def test_por_defecto_se_guardan_las_lecturas_de_alarmas(self):
+        policy = LogPolicy.from_settings()
+        with mock.patch('random.random', return_value=0.99):
+            self.assertTrue(policy.should_log('GET', '/api-rest/alarma'))
+            self.assertTrue(policy.should_log('GET', '/api-rest/alarma/5'))
+
+    @override_settings(LOGS_ACCIONES_POLITICA={'LECTURA_POR_DEFECTO': 0, 'IGNORAR': ['/api-rest/users']})
+    def test_configuracion_desde_settings(self):
+        policy = LogPolicy.from_settings()
+        self.assertFalse(policy.should_log('GET', '/api-rest/paciente'))
+        self.assertTrue(policy.should_log('PUT', '/api-rest/paciente/1'))
+        self.assertFalse(policy.should_log('PUT', '/api-rest/users/1'))
+
+
+def asignar_bbdd(user, alias):
+    # Asigna al usuario la Database con ese alias (nameDescritive), creándola si no existe
+    database = Database.objects.get_or_create(nameDescritive=alias, defaults={
+        'engine': 'django.db.backends.sqlite3', 'name': alias})[0]
+    return Database_User.objects.update_or_create(user=user, defaults={'database': database})[0]
+
+
+class TenantPorPeticionTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        tenant_cache.invalidate()
+        self.user = crear_usuario('usuario_tenant')
+        asignar_bbdd(self.user, 'db2')
+
+    def test_bbdd_del_usuario_en_cache(self):
+        self.assertEqual(getTenantByUser(self.user).alias, 'db2')
+        with self.assertNumQueries(0):
+            self.assertEqual(getTenantByUser(self.user).alias, 'db2')
+        # Cambiar la BBDD del usuario invalida la caché
+        asignar_bbdd(self.user, 'default')
+        self.assertEqual(getTenantByUser(self.user).alias, 'default')
+
+    def test_middleware_fija_el_tenant_de_la_vista(self):
+        vistos = []
+
+        def get_response(request):
+            vistos.append((request.database, current_tenant()))
+            return HttpResponse()
+
+        request = RequestFactory().get('/api-rest/alarma',
+                                       HTTP_AUTHORIZATION='Bearer %s' % AccessToken.for_user(self.user))
+        middleware.TenantDatabaseMiddleware(get_response)(request)
+        self.assertEqual(vistos, [('db2', 'db2')])
+        self.assertIsNone(current_tenant())
+
+    def test_middleware_sin_bbdd_asignada(self):
+        user = crear_usuario('usuario_sin_tenant')
+        request = RequestFactory().get('/api-rest/alarma', HTTP_AUTHORIZATION='Bearer %s' % AccessToken.for_user(user))
+        response = middleware.TenantDatabaseMiddleware(lambda request: HttpResponse(status=204))(request)
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(hasattr(request, 'database'))
+
+
+class RouterTenantsTests(TestCase):
+    databases = '__all__'
+
+    def test_modelos_del_tenant_van_a_su_bbdd(self):
+        with use_tenant('db2'):
+            tipo = Tipo_Alarma.objects.create(nombre='Caída', codigo='C1')
+            self.assertEqual(tipo._state.db, 'db2')
+            # Los modelos comunes siguen en "default" y el .using() explícito tiene prioridad
+            self.assertEqual(router.db_for_write(User), 'default')
+            self.assertFalse(Tipo_Alarma.objects.using('default').filter(pk=tipo.pk, codigo='C1').exists())
+        self.assertIsNone(current_tenant())
+        self.assertFalse(Tipo_Alarma.objects.filter(codigo='C1').exists())
+        self.assertTrue(Tipo_Alarma.objects.using('db2').filter(codigo='C1').exists())
+
+    def test_alias_no_configurado_usa_default(self):
+        with use_tenant('no_existe'):
+            self.assertEqual(router.db_for_read(Alarma), 'default')
+
+    def test_una_bbdd_rota_no_para_al_resto_de_tenants(self):
+        for alias in ('default', 'db2'):
+            with use_tenant(alias):
+                tipo = Tipo_Alarma.objects.create(nombre='Programada', codigo='P1')
+                Alarma_Programada.objects.create(id_tipo_alarma=tipo,
+                                                 fecha_registro=now() - datetime.timedelta(minutes=1))
+        use_tenant_real = routers.use_tenant
+
+        @contextlib.contextmanager
+        def use_tenant_roto(alias):
+            if alias == 'default':
+                raise OperationalError('database is locked')
+            with use_tenant_real(alias):
+                yield
+
+        with mock.patch.object(routers, 'tenant_aliases', return_value=['default', 'db2']), \
+                mock.patch.object(routers, 'use_tenant', use_tenant_roto), \
+                mock.patch('teleasistenciaApp.databases.refresh_connections'):
+            scheduler.procesar_alarmas_programadas()
+        self.assertFalse(Alarma_Programada.objects.using('db2').exists())
+        self.assertEqual(Alarma.objects.using('db2').count(), 1)
+        self.assertEqual(Alarma_Programada.objects.using('default').count(), 1)
+
+
+def aislar_registro_bbdd(test, alias):
+    # Sólo se gestionan las filas de Database del test, no las que este proceso ya activó al arrancar. La versión
+    # leída se restaura para que la siguiente petición no vuelva a sincronizar la tabla fuera del test
+    for name, value in (('_applied', {}), ('_problems', {}), ('_removed', set()),
+                        ('_seen_version', databases._seen_version)):
+        patcher = mock.patch.object(databases, name, value)
+        patcher.start()
+        test.addCleanup(patcher.stop)
+
+    def quitar_alias():
+        if alias in databases._applied:
+            databases._deactivate(alias)
+        databases.release_stale_connections()
+
+    test.addCleanup(quitar_alias)
+    directory = tempfile.TemporaryDirectory()
+    test.addCleanup(directory.cleanup)
+    return os.path.join(directory.name, '%s.sqlite3' % alias)
+
+
+@override_settings(TENANT_DATABASES_VERSION_FILE=None)
+class RegistroBasesDatosTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.fichero = aislar_registro_bbdd(self, 'tenant_nuevo')
+        sqlite3.connect(self.fichero).close()
+
+    def crear(self, name):
+        return Database.objects.create(nameDescritive='tenant_nuevo', engine='django.db.backends.sqlite3', name=name)
+
+    def test_alta_y_baja_sin_reiniciar(self):
+        database = self.crear(self.fichero)
+        self.assertEqual(databases.sync(), {})
+        self.assertEqual(connections.databases['tenant_nuevo']['NAME'], self.fichero)
+        with connections['tenant_nuevo'].cursor() as cursor:
+            cursor.execute('SELECT 1')
+
+        database.delete()
+        databases.sync()
+        self.assertNotIn('tenant_nuevo', connections.databases)
+
+    def test_bbdd_que_no_responde_no_se_activa(self):
+        self.crear(self.fichero + '.no_existe')
+        problems = databases.sync()
+        self.assertIn('No existe el fichero', problems['tenant_nuevo'])
+        self.assertEqual(databases.activation_problem('tenant_nuevo'), problems['tenant_nuevo'])
+        self.assertNotIn('tenant_nuevo', connections.databases)
+
+    def test_health_check_sin_el_lock(self):
+        # Mientras se comprueba una BBDD otros hilos pueden tomar el lock (refresh, release_stale_connections...)
+        self.crear(self.fichero)
+        libre = []
+
+        def tomar_lock():
+            if databases._lock.acquire(timeout=1):
+                databases._lock.release()
+                libre.append(True)
+
+        def health_check(settings_dict):
+            hilo = threading.Thread(target=tomar_lock)
+            hilo.start()
+            hilo.join()
+            return None
+
+        with mock.patch.object(databases, 'health_check', health_check):
+            self.assertEqual(databases.sync(), {})
+        self.assertEqual(libre, [True])
+        self.assertIn('tenant_nuevo', connections.databases)
+
+    @override_settings(TENANT_DATABASES_HEALTH_CHECK_TIMEOUT=3)
+    def test_health_check_con_tiempo_maximo_de_conexion(self):
+        with mock.patch.object(databases, 'ConnectionHandler') as handler:
+            databases.health_check({'ENGINE': 'django.db.backends.postgresql', 'NAME': 'tenant', 'HOST': '10.0.0.1',
+                                    'OPTIONS': {'sslmode': 'require'}})
+        (probe,), _ = handler.call_args
+        self.assertEqual(probe['default']['OPTIONS'], {'sslmode': 'require', 'connect_timeout': 3})
+
+    def test_admin_avisa_con_un_solo_health_check(self):
+        admin_user = User.objects.create_superuser('admin_bbdd', password='Prueba-Test-1')
+        self.client.force_login(admin_user)
+        # En el test los on_commit se ejecutan al salir del bloque, después de la respuesta: se mira message_user
+        with mock.patch.object(databases, 'health_check', wraps=databases.health_check) as health_check, \
+                mock.patch.object(Database_form_admin, 'message_user') as message_user, \
+                mock.patch.object(middleware.log_writer, 'enqueue'), \
+                self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/admin/teleasistenciaApp/database/add/', {
+                'nameDescritive': 'tenant_nuevo', 'engine': 'django.db.backends.sqlite3',
+                'name': self.fichero + '.no_existe'})
+        self.assertEqual(health_check.call_count, 1)
+        (_, mensaje, nivel), _ = message_user.call_args
+        self.assertIn('tenant_nuevo no se ha activado: No existe el fichero', mensaje)
+        self.assertEqual(nivel, messages.WARNING)
+
+
+@override_settings(TENANT_CONNECTIONS={'MAX_AGE': 60, 'HEALTH_CHECK_AFTER': 30, 'MAX_CONNECTIONS': 1,
+                                        'WAIT_TIMEOUT': 0.01})
+class LimiteConexionesTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        patcher = mock.patch.object(db_pool, '_pools', {})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_huecos_y_estadisticas(self):
+        pool = db_pool.ConnectionPool('pruebas', 1)
+        self.assertTrue(pool.try_acquire())
+        self.assertFalse(pool.try_acquire())
+        with self.assertRaises(db_pool.PoolTimeout):
+            pool.acquire(0.01)
+        pool.release()
+        pool.acquire(0.01)
+        pool.release()
+        stats = pool.stats()
+        self.assertEqual((stats['en_uso'], stats['peticiones'], stats['rechazadas']), (0, 2, 1))
+
+    def test_espera_a_que_se_libere_un_hueco(self):
+        pool = db_pool.ConnectionPool('pruebas', 1)
+        pool.try_acquire()
+        threading.Timer(0.05, pool.release).start()
+        pool.acquire(5)
+        self.assertEqual(pool.stats()['esperas'], 1)
+        self.assertGreater(pool.stats()['espera_maxima_ms'], 0)
+
+    def test_middleware_responde_503_sin_huecos(self):
+        tenant_cache.invalidate()
+        user = crear_usuario('usuario_pool')
+        asignar_bbdd(user, 'db2')
+        db_pool.get_pool('db2').try_acquire()
+        request = RequestFactory().get('/api-rest/alarma', HTTP_AUTHORIZATION='Bearer %s' % AccessToken.for_user(user))
+        get_response = mock.Mock()
+        with mock.patch.object(middleware, 'error'):
+            response = middleware.TenantDatabaseMiddleware(get_response)(request)
+        self.assertEqual(response.status_code, 503)
+        get_response.assert_not_called()
+
+    def test_cierra_conexiones_inactivas_que_no_responden(self):
+        rota = mock.Mock(connection=object(), in_atomic_block=False, **{'is_usable.return_value': False})
+        en_transaccion = mock.Mock(connection=object(), in_atomic_block=True)
+        with mock.patch.object(db_pool, 'connections', **{'all.return_value': [rota, en_transaccion]}):
+            db_pool.check_connections()
+        rota.close.assert_called_once_with()
+        en_transaccion.is_usable.assert_not_called()
+
+    def test_health_check_desactivado(self):
+        rota = mock.Mock(connection=object(), in_atomic_block=False)
+        with override_settings(TENANT_CONNECTIONS={'HEALTH_CHECK_AFTER': None}), \
+                mock.patch.object(db_pool, 'connections', **{'all.return_value': [rota]}):
+            db_pool.check_connections()
+        rota.is_usable.assert_not_called()
+
+
+class RolesTokenTests(ApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        caches['default'].clear()
+        patcher = mock.patch.object(roles, '_groups', {})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # La caché del test se trata como compartida entre procesos (memcached, redis...)
+        self.shared_cache = roles._shared_cache
+        patcher = mock.patch.object(roles, '_shared_cache', return_value=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = crear_usuario('usuario_roles', 'teleoperador')
+
+    def token(self):
+        token = AccessToken.for_user(self.user)
+        for claim, value in roles.token_claims(self.user).items():
+            token[claim] = value
+        return token
+
+    def grupos(self, token=None):
+        request = RequestFactory().get('/api-rest/alarma')
+        request.user, request.auth = self.user, token
+        return roles.user_groups(request)
+
+    def test_grupos_del_token_sin_consultas(self):
+        token = self.token()
+        self.assertEqual(token[roles.GROUPS_CLAIM], ['teleoperador'])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.grupos(token), {'teleoperador'})
+
+    def test_cambio_de_grupos_invalida_el_token(self):
+        token = self.token()
+        version = roles.current_version(self.user.pk)
+        profesor = Group.objects.create(name='profesor')
+        self.user.groups.add(profesor)
+        self.assertGreater(roles.current_version(self.user.pk), version)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.grupos(token), {'teleoperador', 'profesor'})
+        # Los grupos leídos quedan en el proceso con su versión
+        with self.assertNumQueries(0):
+            self.assertEqual(self.grupos(token), {'teleoperador', 'profesor'})
+        # Renombrar un grupo cambia la versión de sus usuarios
+        version = roles.current_version(self.user.pk)
+        profesor.name = 'docente'
+        profesor.save()
+        self.assertGreater(roles.current_version(self.user.pk), version)
+
+    def test_user_view_set_update_cambia_la_version(self):
+        admin = crear_usuario('admin_roles', 'administrador')
+        token = self.token()
+        profesor = Group.objects.get_or_create(name='profesor')[0]
+        response = cliente(admin).put('/api-rest/users/%d' % self.user.pk, {'groups': profesor.pk})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(roles.current_version(self.user.pk), token[roles.VERSION_CLAIM])
+        self.assertEqual(self.grupos(token), {'profesor'})
+
+    def test_version_perdida_se_recupera_del_token(self):
+        token = self.token()
+        caches['default'].delete(roles.VERSION_KEY % self.user.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.grupos(token), {'teleoperador'})
+        self.assertEqual(roles.current_version(self.user.pk), token[roles.VERSION_CLAIM])
+
+        # Si los grupos del token ya no son los actuales se crea una versión nueva
+        Membership = User.groups.through
+        Membership.objects.filter(user=self.user).delete()
+        caches['default'].delete(roles.VERSION_KEY % self.user.pk)
+        self.assertEqual(self.grupos(token), frozenset())
+        self.assertNotEqual(roles.current_version(self.user.pk), token[roles.VERSION_CLAIM])
+
+    def test_sesion_usa_los_grupos_del_proceso(self):
+        self.assertEqual(self.grupos(), {'teleoperador'})
+        with self.assertNumQueries(0):
+            self.assertEqual(self.grupos(), {'teleoperador'})
+
+    def test_con_cache_local_no_se_confia_en_el_token(self):
+        # Con la LocMemCache otros procesos no verían el cambio de versión: los grupos salen siempre de la BBDD
+        token = self.token()
+        with mock.patch.object(roles, '_shared_cache', self.shared_cache):
+            self.assertFalse(roles._shared_cache())
+            self.user.groups.clear()
+            with self.assertNumQueries(1):
+                self.assertEqual(self.grupos(token), frozenset())
+
+
+class AgregadosTenantsTests(ApiTestCase):
+
+    def agregado(self, function):
+        patcher = mock.patch.dict(cross_tenant.AGGREGATES, {'prueba': function})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_suma_los_resultados_de_cada_bbdd(self):
+        self.agregado(lambda alias, params: {'total': params['n'], alias: 1})
+        resultado = cross_tenant.run_aggregate('prueba', {'n': 2}, ['default', 'db2'])
+        self.assertEqual(resultado['total'], {'total': 4, 'default': 1, 'db2': 1})
+        self.assertEqual([tenant['database'] for tenant in resultado['tenants']], ['default', 'db2'])
+        self.assertEqual(cross_tenant._merge(3, 4), 7)
+
+    @override_settings(CROSS_TENANT={'MAX_WORKERS': 8, 'TIMEOUT': 0.1})
+    def test_bbdd_lenta_o_con_error_no_cuenta_en_el_total(self):
+        liberar = threading.Event()
+        self.addCleanup(liberar.set)
+
+        def agregado(alias, params):
+            if alias == 'db2':
+                liberar.wait(5)
+                return 5
+            raise OperationalError('no such table')
+
+        self.agregado(agregado)
+        with mock.patch.object(cross_tenant, 'error'):
+            resultado = cross_tenant.run_aggregate('prueba', aliases=['default', 'db2'])
+        self.assertEqual(resultado['total'], 0)
+        tenants = {tenant['database']: tenant for tenant in resultado['tenants']}
+        self.assertEqual(tenants['default']['error'], 'no such table')
+        self.assertIn('Tiempo de espera agotado', tenants['db2']['error'])
+
+    def test_lista_vacia_no_es_todas_las_bbdd(self):
+        self.agregado(lambda alias, params: 1)
+        with mock.patch.object(cross_tenant, 'tenant_aliases') as tenant_aliases:
+            resultado = cross_tenant.run_aggregate('prueba', aliases=[])
+        tenant_aliases.assert_not_called()
+        self.assertEqual((resultado['total'], resultado['tenants']), (0, []))
+
+    @override_settings(CROSS_TENANT={'MAX_WORKERS': 1, 'TIMEOUT': 0.5})
+    def test_el_plazo_empieza_con_la_consulta_y_sqlite_se_interrumpe(self):
+        # Con un solo hilo: la consulta de default no termina nunca y se interrumpe, db2 espera en cola sin que
+        # ese tiempo cuente en su plazo
+        def agregado(alias, params):
+            with connections[alias].cursor() as cursor:
+                if alias == 'default':
+                    cursor.execute('WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) '
+                                   'SELECT count(*) FROM c')
+                time.sleep(0.3)
+                return 1
+
+        self.agregado(agregado)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+        with mock.patch.object(cross_tenant, '_executor', executor), mock.patch.object(cross_tenant, 'error'):
+            resultado = cross_tenant.run_aggregate('prueba', aliases=['default', 'db2'])
+        tenants = {tenant['database']: tenant for tenant in resultado['tenants']}
+        self.assertIn('Tiempo de espera agotado', tenants['default']['error'])
+        self.assertEqual((tenants['db2'].get('resultado'), resultado['total']), (1, 1))
+
+    def test_agregado_que_no_existe(self):
+        with self.assertRaises(KeyError):
+            cross_tenant.run_aggregate('no_existe')
+        admin = crear_usuario('admin_agregados', 'administrador')
+        self.assertEqual(cliente(admin).get('/api-rest/agregados_tenants/no_existe').status_code, 404)
+
+    def test_vista_filtra_bbdd_y_exige_administrador(self):
+        admin = crear_usuario('admin_agregados', 'administrador')
+        Database.objects.create(nameDescritive='db2', engine='django.db.backends.sqlite3', name='db2')
+        with mock.patch.object(views_rest, 'run_aggregate', return_value={}) as run_aggregate:
+            response = cliente(admin).get('/api-rest/agregados_tenants/alarmas',
+                                          {'databases': 'db2,no_existe', 'desde': '2024-01-01'})
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('no_existe', response.data)
+            run_aggregate.assert_not_called()
+            response = cliente(admin).get('/api-rest/agregados_tenants/alarmas',
+                                          {'databases': 'db2', 'desde': '2024-01-01'})
+        self.assertEqual(response.status_code, 200)
+        (nombre, params, aliases), _ = run_aggregate.call_args
+        self.assertEqual((nombre, aliases), ('alarmas', ['db2']))
+        self.assertEqual(params['desde'].year, 2024)
+        teleoperador = crear_usuario('teleoperador_agregados', 'teleoperador')
+        self.assertEqual(cliente(teleoperador).get('/api-rest/agregados_tenants').status_code, 403)
+
+
+@override_settings(TENANT_DATABASES_VERSION_FILE=None)
+class AprovisionamientoTests(ApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.fichero = aislar_registro_bbdd(self, 'centro_nuevo')
+        self.database = Database.objects.create(nameDescritive='centro_nuevo', engine='django.db.backends.sqlite3',
+                                                name=self.fichero)
+
+    def test_alta_completa(self):
+        Tipo_Alarma.objects.create(nombre='Caída', codigo='C1')
+        crear_usuario('admin_centro', 'administrador')
+        crear_usuario('teleoperador_centro', 'teleoperador')
+        job = Aprovisionamiento_Base_Datos.objects.create(database=self.database)
+        progreso = []
+        step = provisioning._step
+        with mock.patch.object(provisioning, '_step', side_effect=lambda job, *args: (
+                step(job, *args), progreso.append(job.progreso))):
+            provisioning.run_provisioning(job.pk)
+
+        job.refresh_from_db()
+        self.assertEqual((job.estado, job.progreso, job.mensaje), ('Completado', 100, ''), job.mensaje)
+        self.assertEqual(progreso, sorted(progreso))
+        self.assertTrue(Tipo_Alarma.objects.using('centro_nuevo').filter(codigo='C1').exists())
+        self.assertEqual(list(User.objects.using('centro_nuevo').values_list('username', flat=True)), ['admin_centro'])
+        # Se puede repetir sin duplicar nada
+        provisioning.copy_rows('centro_nuevo', [(Tipo_Alarma, Tipo_Alarma.objects.all())])
+        self.assertEqual(Tipo_Alarma.objects.using('centro_nuevo').count(), 1)
+
+    def test_error_queda_en_el_trabajo(self):
+        job = Aprovisionamiento_Base_Datos.objects.create(database=self.database)
+        with mock.patch.object(provisioning, 'create_database', side_effect=OSError('Disco lleno')), \
+                mock.patch.object(provisioning, 'error'):
+            provisioning.run_provisioning(job.pk)
+        job.refresh_from_db()
+        self.assertEqual((job.estado, job.paso, job.mensaje), ('Error', 'Crear base de datos', 'Disco lleno'))
+        self.assertIsNotNone(job.fecha_fin)
+
+    def test_crea_el_fichero_sqlite(self):
+        fichero = os.path.join(os.path.dirname(self.fichero), 'carpeta', 'centro.sqlite3')
+        provisioning.create_database({'ENGINE': 'django.db.backends.sqlite3', 'NAME': fichero})
+        self.assertTrue(os.path.exists(fichero))
+
+    def test_vista_lanza_una_sola_alta(self):
+        admin = crear_usuario('admin_aprovisionamiento', 'administrador')
+        client = cliente(admin)
+        with mock.patch.object(views_rest, 'start_provisioning', side_effect=lambda database: (
+                Aprovisionamiento_Base_Datos.objects.create(database=database))) as start_provisioning:
+            response = client.post('/api-rest/aprovisionamiento_base_datos', {'id_database': self.database.pk})
+            self.assertEqual(response.status_code, 202)
+            response = client.post('/api-rest/aprovisionamiento_base_datos', {'id_database': self.database.pk})
+            self.assertEqual(response.status_code, 409)
+        start_provisioning.assert_called_once_with(self.database)
+        default = Database.objects.create(nameDescritive='default', engine='django.db.backends.sqlite3', name='x')
+        response = client.post('/api-rest/aprovisionamiento_base_datos', {'id_database': default.pk})
+        self.assertEqual(response.status_code, 405)
+
+
+    @override_settings(APROVISIONAMIENTO_TIMEOUT=60)
+    def test_alta_a_medias_tras_reiniciar_se_puede_repetir(self):
+        admin = crear_usuario('admin_aprovisionamiento', 'administrador')
+        hace_un_rato = now() - datetime.timedelta(seconds=30)
+        perdida = Aprovisionamiento_Base_Datos.objects.create(
+            database=self.database, estado='En curso', fecha_inicio=now() - datetime.timedelta(hours=2))
+        with mock.patch.object(views_rest, 'start_provisioning', side_effect=lambda database: (
+                Aprovisionamiento_Base_Datos.objects.create(database=database, fecha_inicio=hace_un_rato))):
+            response = cliente(admin).post('/api-rest/aprovisionamiento_base_datos',
+                                           {'id_database': self.database.pk})
+        self.assertEqual(response.status_code, 202)
+        perdida.refresh_from_db()
+        self.assertEqual(perdida.estado, 'Error')
+        self.assertIn('se puede volver a lanzar', perdida.mensaje)
+        # Una reciente o en curso en este proceso no se toca
+        self.assertEqual(provisioning.expire_stale_jobs(), 0)
+        with mock.patch.object(provisioning, '_active', {perdida.pk}):
+            Aprovisionamiento_Base_Datos.objects.filter(pk=perdida.pk).update(estado='En curso')
+            self.assertEqual(provisioning.expire_stale_jobs(self.database), 0)
+
+class ImportacionUsuariosTests(ApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        tenant_cache.invalidate()
+        self.admin = crear_usuario('admin_importacion', 'administrador')
+        asignar_bbdd(self.admin, 'db2')
+        self.teleoperador = Group.objects.get_or_create(name='teleoperador')[0]
+        Group.objects.using('db2').create(pk=self.teleoperador.pk, name='teleoperador')
+
+    def test_valida_todas_las_filas_antes_de_crear(self):
+        crear_usuario('ya_existe')
+        filas = [
+            {'username': 'nuevo1', 'password': 'Clave-1', 'groups': 'teleoperador', 'email': 'n1@example.com'},
+            {'username': 'nuevo1', 'password': 'Clave-1', 'groups': 'teleoperador'},
+            {'username': 'ya_existe', 'password': 'Clave-1', 'groups': 'teleoperador'},
+            {'username': 'sin_clave', 'groups': 'teleoperador'},
+            {'username': 'sin_grupo', 'password': 'Clave-1', 'groups': 'no_existe'},
+            {'username': 'admin2', 'password': 'Clave-1', 'groups': 'administrador'},
+            {'password': 'Clave-1', 'groups': 'teleoperador'},
+        ]
+        resultado = user_import.import_users(filas, getTenantByUser(self.admin), allow_admin=False)
+        self.assertEqual((resultado['creados'], resultado['errores']), (1, 6))
+        self.assertEqual([fila.get('error') for fila in resultado['resultados']], [
+            None, "El usuario ya existe", "El usuario ya existe", "Falta contraseña", "No existe el grupo no_existe",
+            "No se puede asignar el grupo administrador", "Falta el nombre de usuario"])
+        user = User.objects.get(username='nuevo1')
+        self.assertEqual(resultado['resultados'][0]['id'], user.pk)
+        self.assertTrue(user.check_password('Clave-1'))
+        self.assertEqual(user.email, 'n1@example.com')
+
+    def test_validadores_de_los_campos_de_user(self):
+        filas = [
+            {'username': 'u' * 151, 'password': 'Clave-1', 'groups': 'teleoperador'},
+            {'username': 'con espacios', 'password': 'Clave-1', 'groups': 'teleoperador'},
+            {'username': 'email_mal', 'password': 'Clave-1', 'groups': 'teleoperador', 'email': 'no-es-un-email'},
+            {'username': 'bien', 'password': 'Clave-1', 'groups': 'teleoperador'},
+        ]
+        resultado = user_import.import_users(filas, getTenantByUser(self.admin), allow_admin=False)
+        self.assertEqual((resultado['creados'], resultado['errores']), (1, 3))
+        errores = [fila.get('error') for fila in resultado['resultados']]
+        self.assertTrue(errores[0].startswith('username: '), errores[0])
+        self.assertIn('150', errores[0])
+        self.assertTrue(errores[1].startswith('username: '), errores[1])
+        self.assertTrue(errores[2].startswith('email: '), errores[2])
+        self.assertIsNone(errores[3])
+        self.assertEqual(list(User.objects.filter(username__in=['con espacios', 'email_mal', 'bien'])
+                              .values_list('username', flat=True)), ['bien'])
+
+    def test_crea_en_la_bbdd_principal_y_en_la_del_tenant(self):
+        profesor = Group.objects.get_or_create(name='profesor')[0]
+        filas = [{'username': 'tele1', 'password': 'Clave-1', 'groups': str(self.teleoperador.pk)},
+                 {'username': 'profe1', 'password': 'Clave-1', 'groups': 'profesor'}]
+        user_import.import_users(filas, getTenantByUser(self.admin), allow_admin=True)
+        for username, grupo in (('tele1', self.teleoperador), ('profe1', profesor)):
+            user = User.objects.get(username=username)
+            self.assertEqual(list(user.groups.all()), [grupo])
+            self.assertEqual(Database_User.objects.get(user=user).database.nameDescritive, 'db2')
+            self.assertEqual(User.objects.using('db2').get(pk=user.pk).password, user.password)
+        # Sólo se copian los grupos que existen en la BBDD del tenant
+        self.assertEqual(list(User.objects.using('db2').get(username='tele1').groups.values_list('name', flat=True)),
+                         ['teleoperador'])
+        self.assertFalse(User.objects.using('db2').get(username='profe1').groups.exists())
+
+    def test_vista_con_csv(self):
+        fichero = io.BytesIO('\ufeffusername,password,groups\ncsv1, Clave-1 ,teleoperador\n'.encode())
+        fichero.name = 'usuarios.csv'
+        response = cliente(self.admin).post('/api-rest/users/importar', {'fichero': fichero}, format='multipart')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['creados'], 1)
+        self.assertTrue(User.objects.get(username='csv1').check_password('Clave-1'))
+
+    def test_vista_sin_filas(self):
+        response = cliente(self.admin).post('/api-rest/users/importar', {'usuarios': 'no es una lista'},
+                                            format='json')
+        self.assertEqual(response.status_code, 405)
+
+
+@override_settings(PASSWORD_HASHING={'PROCESOS': 1, 'MINIMO_PARALELO': 8, 'VERIFICAR_EN_POOL': False},
+                   LOGIN_THROTTLE={'IP': (100, 60), 'USERNAME': (3, 60), 'CACHE': None})
+class LoginAsincronoTests(ApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(login_throttle, '_backend', login_throttle.SlidingWindow())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(teleasistencia_views.last_login_writer, 'enqueue')
+        self.enqueue = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = crear_usuario('usuario_login', 'teleoperador')
+
+    def login(self, **data):
+        return self.client.post('/api/token/', data, content_type='application/json')
+
+    def login_sincrono(self, **data):
+        request = RequestFactory().post('/api/token/', data, content_type='application/json')
+        view = TokenObtainPairView.as_view(serializer_class=teleasistencia_views.TokenObtainPairSerializerWithLastLogin)
+        response = view(request)
+        response.render()
+        return response
+
+    def test_login_correcto(self):
+        response = self.login(username='usuario_login', password='Prueba-Test-1')
+        self.assertEqual(response.status_code, 200)
+        token = AccessToken(response.json()['access'])
+        self.assertEqual((token['user_id'], token[roles.GROUPS_CLAIM]), (self.user.pk, ['teleoperador']))
+        self.enqueue.assert_called_once()
+
+    def test_mismas_respuestas_que_la_vista_sincrona(self):
+        inactivo = crear_usuario('usuario_inactivo')
+        inactivo.is_active = False
+        inactivo.save()
+        for data in ({'username': 'usuario_login', 'password': 'mal'}, {'username': 'no_existe', 'password': 'x'},
+                     {'username': 'usuario_inactivo', 'password': 'Prueba-Test-1'}, {'username': 'usuario_login'},
+                     {'username': '', 'password': 'x'}):
+            with mock.patch.object(login_throttle, '_backend', login_throttle.SlidingWindow()):
+                sincrona = self.login_sincrono(**data)
+            with mock.patch.object(login_throttle, '_backend', login_throttle.SlidingWindow()):
+                asincrona = self.login(**data)
+            self.assertEqual(asincrona.status_code, sincrona.status_code, data)
+            self.assertEqual(asincrona.json(), json.loads(sincrona.content), data)
+            self.assertEqual(asincrona.get('WWW-Authenticate'), sincrona.get('WWW-Authenticate'), data)
+
+    def test_limite_de_intentos(self):
+        for _ in range(3):
+            self.assertEqual(self.login(username='usuario_login', password='mal').status_code, 401)
+        response = self.login(username='usuario_login', password='Prueba-Test-1')
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Demasiados intentos', response.json()['detail'])
+        self.assertGreater(int(response['Retry-After']), 0)
+
+    def test_cambio_de_turno_desde_una_ip(self):
+        # Muchos logins correctos desde la IP de un centro no llegan al límite por IP
+        for i in range(5):
+            crear_usuario('turno_%s' % i)
+        with override_settings(LOGIN_THROTTLE={'IP': (3, 60), 'USERNAME': (3, 60), 'CACHE': None}):
+            for _ in range(2):
+                for i in range(5):
+                    self.assertEqual(self.login(username='turno_%s' % i, password='Prueba-Test-1').status_code, 200)
+            for _ in range(3):
+                self.assertEqual(self.login(username='turno_0', password='mal').status_code, 401)
+            self.assertEqual(self.login(username='turno_1', password='Prueba-Test-1').status_code, 429)
+            self.assertEqual(self.login_sincrono(username='turno_1', password='Prueba-Test-1').status_code, 429)
+
+    def test_limite_en_cache_compartida_fuera_del_bucle(self):
+        # Con LOGIN_THROTTLE['CACHE'] los contadores se consultan en un hilo, no en el bucle de eventos
+        llamadas = []
+
+        def fuera_del_bucle(*args):
+            try:
+                asyncio.get_running_loop()
+                llamadas.append('bucle')
+            except RuntimeError:
+                llamadas.append('hilo')
+            return 0
+
+        backend = mock.Mock(**{'hit.side_effect': fuera_del_bucle, 'peek.side_effect': fuera_del_bucle,
+                               'reset.side_effect': fuera_del_bucle})
+        with override_settings(LOGIN_THROTTLE={'IP': (100, 60), 'USERNAME': (3, 60), 'CACHE': 'default'}), \
+                mock.patch.object(login_throttle, '_backend', backend):
+            self.assertEqual(self.login(username='usuario_login', password='mal').status_code, 401)
+            self.assertEqual(self.login(username='usuario_login', password='Prueba-Test-1').status_code, 200)
+        # peek (IP) + hit (usuario) + hit (fallo de la IP), peek + hit + reset (login correcto)
+        self.assertEqual(llamadas, ['hilo'] * 6)
+
+    def test_la_espera_del_pool_no_bloquea_el_bucle(self):
+        future = concurrent.futures.Future()
+        pool = mock.Mock(**{'submit.return_value': future})
+
+        async def comprobar():
+            task = asyncio.ensure_future(hashing.averify_password('clave', 'hash'))
+            await asyncio.sleep(0.01)
+            # Mientras el pool calcula el hash el bucle atiende otras tareas
+            self.assertFalse(task.done())
+            future.set_result((True, False))
+            return await task
+
+        with override_settings(PASSWORD_HASHING={'PROCESOS': 1, 'MINIMO_PARALELO': 8, 'VERIFICAR_EN_POOL': True}), \
+                mock.patch.object(hashing, '_get_pool', return_value=pool):
+            self.assertEqual(asyncio.run(comprobar()), (True, False))
+        pool.submit.assert_called_once_with(hashing._check, 'clave', 'hash')
+
+
+class DirectorioUsuariosTests(ApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        tenant_cache.invalidate()
+        self.admin = crear_usuario('admin_directorio', 'administrador')
+        asignar_bbdd(self.admin, 'default')
+        for username, first_name, last_name in (('mlopez', 'María', 'López'), ('jgarcia', 'Juan', 'García'),
+                                                ('mruiz', 'Marta', 'Ruiz')):
+            user = crear_usuario(username, 'teleoperador')
+            User.objects.filter(pk=user.pk).update(first_name=first_name, last_name=last_name)
+            asignar_bbdd(user, 'default')
+        # De otro tenant: no aparece
+        asignar_bbdd(crear_usuario('motro'), 'db2')
+
+    def usernames(self, response):
+        return [user['username'] for user in response.data['results']]
+
+    def test_busqueda_por_prefijo(self):
+        client = cliente(self.admin)
+        response = client.get('/api-rest/directorio_usuarios', {'buscar': 'm'})
+        self.assertEqual(self.usernames(response), ['mlopez', 'mruiz'])
+        # Sin distinguir mayúsculas
+        self.assertEqual(self.usernames(client.get('/api-rest/directorio_usuarios', {'buscar': 'gar'})), ['jgarcia'])
+        self.assertEqual(self.usernames(client.get('/api-rest/directorio_usuarios', {'buscar': 'Mart'})), ['mruiz'])
+        self.assertEqual(self.usernames(client.get('/api-rest/directorio_usuarios', {'buscar': 'MLO'})), ['mlopez'])
+        user = User.objects.get(username='jgarcia')
+        user.last_name = 'GARCÍA'
+        user.save()
+        self.assertEqual(self.usernames(client.get('/api-rest/directorio_usuarios', {'buscar': 'garc'})), ['jgarcia'])
+
+    def test_paginacion_por_cursor_ordenada_por_username(self):
+        client = cliente(self.admin)
+        response = client.get('/api-rest/directorio_usuarios', {'page_size': 2})
+        self.assertEqual(self.usernames(response), ['admin_directorio', 'jgarcia'])
+        response = client.get(response.data['next'])
+        self.assertEqual(self.usernames(response), ['mlopez', 'mruiz'])
+        self.assertIsNone(response.data['next'])
+
+    def test_mismas_consultas_sea_cual_sea_el_numero_de_usuarios(self):
+        tenant = getTenantByUser(self.admin)
+
+        def consultas():
+            with CaptureQueriesContext(connections['default']) as queries:
+                UserSerializer(views_rest.usuarios_del_tenant(tenant), many=True,
+                               context={'request': RequestFactory().get('/')}).data
+            return len(queries)
+
+        antes = consultas()
+        for i in range(5):
+            asignar_bbdd(crear_usuario('extra%d' % i, 'profesor'), 'default')
+        self.assertEqual(consultas(), antes)
+
+    def test_solo_administradores_y_profesores(self):
+        teleoperador = User.objects.get(username='mlopez')
+        self.assertEqual(cliente(teleoperador).get('/api-rest/directorio_usuarios').status_code, 403)
+
+
+class _AgendaSoloClaves(ModelSerializer):
+    historico_agenda = PrimaryKeyRelatedField(many=True, read_only=True)
+
+    class Meta:
+        model = Agenda
+        fields = ['id', 'id_paciente', 'id_tipo_agenda', 'historico_agenda']
+
+
+class PlanificadorConsultasTests(ApiTestCase):
+
+    def test_relaciones_de_un_objeto_y_de_varios(self):
+        # OneToOne inversa (imagen) y Meta.select_related en el JOIN; ManyToMany y lo que cuelga de ella aparte
+        self.assertEqual(query_planner.serializer_lookups(UserSerializer),
+                         (['database_user', 'imagen_user'], ['groups', 'groups__permissions']))
+        self.assertEqual(query_planner.serializer_lookups(Tipo_Alarma_Serializer), (['id_clasificacion_alarma'], []))
+        select, prefetch = query_planner.serializer_lookups(Agenda_Serializer)
+        self.assertIn('id_paciente__id_persona', select)
+        # Dentro de una relación de varios objetos todo va en prefetch_related
+        self.assertIn('historico_agenda__id_teleoperador', prefetch)
+        self.assertFalse([lookup for lookup in select if lookup.startswith('historico_agenda')])
+
+    def test_claves_primarias_sin_consulta(self):
+        # Las ForeignKey como clave no necesitan nada; las de varios objetos sí
+        self.assertEqual(query_planner.serializer_lookups(_AgendaSoloClaves), ([], ['historico_agenda']))
+
+    def test_recortado_con_fields_y_expand(self):
+        fields = sparse_fields.parse('id')
+        self.assertEqual(query_planner.serializer_lookups(Agenda_Serializer, fields=fields), ([], []))
+        fields = sparse_fields.parse('id,id_tipo_agenda')
+        self.assertEqual(query_planner.serializer_lookups(Agenda_Serializer, fields=fields), (['id_tipo_agenda'], []))
+        # Lo que no se expande queda como clave: el histórico (varios objetos) sólo necesita sus ids
+        expand = sparse_fields.parse('id_tipo_agenda')
+        self.assertEqual(query_planner.serializer_lookups(Agenda_Serializer, expand=expand),
+                         (['id_tipo_agenda'], ['historico_agenda']))
+
+    def test_listado_con_las_mismas_consultas_sea_cual_sea_el_numero_de_filas(self):
+        tenant_cache.invalidate()
+        user = crear_usuario('profesor_planificador', 'profesor')
+        asignar_bbdd(user, 'default')
+        client = cliente(user)
+        tipo = Tipo_Agenda.objects.create(nombre='Llamada', codigo='L1')
+
+        def consultas():
+            with CaptureQueriesContext(connections['default']) as queries:
+                response = client.get('/api-rest/agenda')
+            self.assertEqual(response.status_code, 200)
+            return len(queries)
+
+        def crear_agenda():
+            agenda = Agenda.objects.create(id_tipo_agenda=tipo, fecha_prevista=now())
+            Historico_Agenda_Llamadas.objects.create(id_agenda=agenda, id_teleoperador=user)
+
+        crear_agenda()
+        consultas()
+        antes = consultas()
+        for _ in range(3):
+            crear_agenda()
+        self.assertEqual(consultas(), antes)
+
+
+class PaginacionCursorTests(ApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        tenant_cache.invalidate()
+        self.client = cliente(crear_usuario('profesor_paginacion', 'profesor'))
+        self.tipos = [Tipo_Agenda.objects.create(nombre='Tipo %d' % i, codigo='T%d' % i) for i in range(2)]
+        base = now()
+        # La fecha de registro se repite: se desempata por id
+        self.agendas = [Agenda.objects.create(id_tipo_agenda=self.tipos[i % 2], fecha_prevista=base,
+                                              fecha_registro=base - datetime.timedelta(hours=i // 2))
+                        for i in range(5)]
+
+    def ids(self, response):
+        return [agenda['id'] for agenda in response.data['results']]
+
+    def test_orden_del_cursor_sobre_campos_indexados(self):
+        # Cada página es una consulta por rango sobre un índice, no una ordenación de toda la tabla
+        vistas = [vista for vista in vars(views_rest).values()
+                  if isinstance(vista, type) and getattr(vista, 'cursor_ordering', None)]
+        self.assertTrue(vistas)
+        for vista in vistas:
+            campo = vista.cursor_ordering[0].lstrip('-')
+            self.assertIn(campo, indexed_fields(vista.queryset.model), vista.__name__)
+
+    def test_sin_parametros_la_lista_completa(self):
+        response = self.client.get('/api-rest/agenda')
+        self.assertIsInstance(response.data, list)
+        self.assertEqual(len(response.data), 5)
+
+    def test_paginas_en_el_orden_de_la_vista(self):
+        esperado = [agenda.pk for agenda in sorted(self.agendas, key=lambda a: (a.fecha_registro, a.pk), reverse=True)]
+        response = self.client.get('/api-rest/agenda', {'page_size': 2})
+        vistos = self.ids(response)
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            vistos += self.ids(response)
+        self.assertEqual(vistos, esperado)
+        self.assertIsNotNone(response.data['previous'])
+
+    def test_con_filtros(self):
+        # page_size no se toma como filtro del modelo
+        response = self.client.get('/api-rest/agenda', {'page_size': 10, 'id_tipo_agenda': self.tipos[0].pk})
+        self.assertEqual(sorted(self.ids(response)), [a.pk for a in self.agendas if a.id_tipo_agenda == self.tipos[0]])
+
+    def test_cursor_no_valido(self):
+        self.assertEqual(self.client.get('/api-rest/agenda', {'cursor': 'no-es-un-cursor'}).status_code, 404)
+
+
+class CamposAMedidaTests(ApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        tenant_cache.invalidate()
+        user = crear_usuario('profesor_campos', 'profesor')
+        self.client = cliente(user)
+        tipo = Tipo_Agenda.objects.create(nombre='Seguimiento', codigo='S1')
+        agenda = Agenda.objects.create(id_tipo_agenda=tipo, fecha_prevista=now())
+        Historico_Agenda_Llamadas.objects.create(id_agenda=agenda, id_teleoperador=user, observaciones='Llamada')
+
+    def agenda(self, **params):
+        response = self.client.get('/api-rest/agenda', params)
+        self.assertEqual(response.status_code, 200)
+        return response.data[0]
+
+    def test_sin_parametros_la_respuesta_de_siempre(self):
+        historico = self.agenda()['historico_agenda'][0]
+        self.assertEqual(historico['id_teleoperador']['username'], 'profesor_campos')
+
+    def test_fields(self):
+        agenda = self.agenda(fields='id,id_tipo_agenda.nombre')
+        self.assertEqual(set(agenda), {'id', 'id_tipo_agenda'})
+        self.assertEqual(agenda['id_tipo_agenda'], {'nombre': 'Seguimiento'})
+
+    def test_expand_deja_el_resto_como_clave(self):
+        agenda = self.agenda(expand='id_tipo_agenda')
+        self.assertEqual(agenda['id_tipo_agenda']['codigo'], 'S1')
+        self.assertIsInstance(agenda['historico_agenda'][0], int)
+
+    def test_expand_sin_subcamino_mantiene_el_depth(self):
+        historico = self.agenda(expand='historico_agenda')['historico_agenda'][0]
+        self.assertEqual(historico['id_teleoperador']['username'], 'profesor_campos')
+        self.assertEqual(historico['id_agenda']['id_tipo_agenda']['codigo'], 'S1')
+
+    def test_expand_con_subcamino(self):
+        historico = self.agenda(expand='historico_agenda.id_teleoperador')['historico_agenda'][0]
+        self.assertEqual(historico['id_teleoperador']['username'], 'profesor_campos')
+        self.assertIsInstance(historico['id_agenda'], int)
+
+
+class EsquemaFiltrosTests(ApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        tenant_cache.invalidate()
+        self.client = cliente(crear_usuario('profesor_filtros', 'profesor'))
+        self.tipo = Tipo_Agenda.objects.create(nombre='Llamada', codigo='L1')
+        dia = timezone.make_aware(datetime.datetime(2024, 3, 10, 12))
+        self.agendas = [Agenda.objects.create(id_tipo_agenda=self.tipo if i else None,
+                                              fecha_prevista=dia + datetime.timedelta(days=i)) for i in range(3)]
+
+    def ids(self, **params):
+        response = self.client.get('/api-rest/agenda', params)
+        self.assertEqual(response.status_code, 200, response.data)
+        return sorted(agenda['id'] for agenda in response.data)
+
+    def test_solo_campos_con_indice(self):
+        with self.assertRaisesMessage(ImproperlyConfigured, 'no tiene índice'):
+            FilterSchema(Agenda, {'observaciones': ('exact',)})
+        with self.assertRaisesMessage(ImproperlyConfigured, 'Orden observaciones'):
+            FilterSchema(Agenda, {'id': ('exact',)}, ordering=('observaciones',))
+        with self.assertRaises(ImproperlyConfigured):
+            FilterSchema(Agenda, {'no_existe': ('exact',)})
+        # Por una relación se comprueba el índice del campo del modelo relacionado
+        with self.assertRaisesMessage(ImproperlyConfigured, 'Tipo_Agenda.codigo no tiene índice'):
+            FilterSchema(Agenda, {'tipo': Filter(path='id_tipo_agenda__codigo')})
+        schema = FilterSchema(Agenda, {'tipo': Filter(path='id_tipo_agenda__id')})
+        self.assertEqual(schema.query(QueryDict('tipo=1')), Q(id_tipo_agenda__id__exact=1))
+
+    def test_lookups(self):
+        primera, segunda, tercera = [agenda.pk for agenda in self.agendas]
+        self.assertEqual(self.ids(id__in='%d,%d' % (primera, tercera)), [primera, tercera])
+        self.assertEqual(self.ids(id_tipo_agenda__isnull='true'), [primera])
+        self.assertEqual(self.ids(fecha_prevista__date='2024-03-11'), [segunda])
+        self.assertEqual(self.ids(fecha_prevista__range='2024-03-11,2024-03-13'), [segunda, tercera])
+        self.assertEqual(self.ids(fecha_prevista__gte='2024-03-12'), [tercera])
+
+    def test_parametros_no_validos_son_400(self):
+        for params in ({'observaciones': 'x'}, {'id__gt': '1'}, {'id': 'abc'}, {'fecha_prevista__date': 'ayer'},
+                       {'fecha_prevista__range': '2024-03-11'}, {'ordering': 'observaciones'}):
+            response = self.client.get('/api-rest/agenda', params)
+            self.assertEqual(response.status_code, 400, params)
+        response = self.client.get('/api-rest/agenda', {'no_existe': '1'})
+        self.assertIn('Filtros: fecha_prevista', str(response.data['no_existe']))
+
+    def test_ordering(self):
+        response = self.client.get('/api-rest/agenda', {'ordering': '-fecha_prevista'})
+        self.assertEqual([agenda['id'] for agenda in response.data], [agenda.pk for agenda in reversed(self.agendas)])
+        response = self.client.get('/api-rest/agenda', {'ordering': 'fecha_prevista', 'page_size': 2})
+        self.assertEqual([agenda['id'] for agenda in response.data['results']], [a.pk for a in self.agendas[:2]])
+
+    def test_cada_forma_de_peticion_se_compila_una_vez(self):
+        schema = FilterSchema(Agenda, {'id': ('exact', 'in')})
+        with mock.patch.object(schema, '_compile', wraps=schema._compile) as compile:
+            schema.query(QueryDict('id=1'))
+            schema.query(QueryDict('id=2&page_size=10'))
+            schema.query(QueryDict('id__in=1,2'))
+        self.assertEqual(compile.call_count, 2)
+
+
+class PlanesDeConsultaTests(TestCase):
+    """
+    Las consultas de los caminos calientes (scheduler, listados de alarmas y agendas, búsquedas por DNI o número de
+    terminal, logs por fecha) tienen que usar un índice: si un cambio de modelo o de filtro los deja sin él, el
+    EXPLAIN pasa a ser un recorrido de la tabla entera y el test falla.
+
+    En SQLite se busca un "SCAN <tabla>" sin índice y, en las consultas ordenadas, un "USE TEMP B-TREE" (ordenar
+    en memoria). En PostgreSQL se desactivan los Seq Scan (con las tablas vacías del test siempre serían lo más
+    barato) y se busca un "Seq Scan on <tabla>", que sólo aparece si no hay índice posible.
+    """
+    databases = '__all__'
+
+    def assertUsaIndice(self, queryset, ordenada=False):
+        alias = router.db_for_read(queryset.model)
+        queryset = queryset.using(alias)
+        connection = connections[alias]
+        tabla = queryset.model._meta.db_table
+
+        if connection.vendor == 'sqlite':
+            plan = queryset.explain()
+            sin_indice = re.search(r'SCAN (TABLE )?"?%s"?( AS \w+)?\s*$' % re.escape(tabla), plan, re.MULTILINE)
+            self.assertIsNone(sin_indice, "Consulta sin índice:\n%s\n%s" % (queryset.query, plan))
+            if ordenada:
+                self.assertNotIn('USE TEMP B-TREE', plan, "Orden sin índice:\n%s\n%s" % (queryset.query, plan))
+        elif connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+            plan = queryset.explain()
+            sin_indice = re.search(r'Seq Scan on "?%s"?(\s|$)' % re.escape(tabla), plan)
+            self.assertIsNone(sin_indice, "Consulta sin índice:\n%s\n%s" % (queryset.query, plan))
+        else:
+            raise unittest.SkipTest("EXPLAIN sólo se comprueba en SQLite y PostgreSQL")
+
+    @staticmethod
+    def filtros(view, params):
+        # Q que genera el esquema de filtros de la vista para los parámetros GET `params`
+        return schema_for(view).query(QueryDict(params))
+
+    # ========================= Alarmas ========================= #
+    def test_alarmas_por_estado_y_dia(self):
+        inicio = now() - datetime.timedelta(days=1)
+        self.assertUsaIndice(Alarma.objects.filter(estado_alarma='Abierta', fecha_registro__gte=inicio,
+                                                   fecha_registro__lt=now()))
+
+    def test_alarmas_de_un_dia(self):
+        self.assertUsaIndice(Alarma.objects.filter(self.filtros(Alarma_ViewSet, 'fecha_registro=2024-01-15')))
+
+    def test_alarmas_por_estado(self):
+        self.assertUsaIndice(Alarma.objects.filter(self.filtros(Alarma_ViewSet, 'estado_alarma=Abierta')))
+
+    def test_alarmas_ordenadas_por_fecha(self):
+        # Paginación por cursor de /alarma
+        self.assertUsaIndice(Alarma.objects.order_by('-fecha_registro')[:20], ordenada=True)
+
+    def test_alarmas_programadas_vencidas(self):
+        # Consulta del scheduler (schedulerApp.apps.procesar_alarmas_programadas)
+        self.assertUsaIndice(Alarma_Programada.objects.filter(fecha_registro__lte=now()).order_by('fecha_registro'),
+                             ordenada=True)
+
+    # ========================= Agenda ========================= #
+    def test_agendas_pendientes(self):
+        inicio = now()
+        self.assertUsaIndice(Agenda.objects.filter(fecha_resolucion__isnull=True, fecha_prevista__gte=inicio,
+                                                   fecha_prevista__lt=inicio + datetime.timedelta(days=1)))
+
+    def test_agendas_de_un_dia(self):
+        self.assertUsaIndice(Agenda.objects.filter(self.filtros(Agenda_ViewSet, 'fecha_prevista=2024-01-15')))
+
+    # ========================= Búsquedas ========================= #
+    def test_persona_por_dni(self):
+        self.assertUsaIndice(Persona.objects.filter(self.filtros(Persona, 'dni=12345678A')))
+
+    def test_terminal_por_numero(self):
+        self.assertUsaIndice(Terminal.objects.filter(numero_terminal='T-0001'))
+
+    # ========================= Logs ========================= #
+    def test_logs_por_fecha(self):
+        inicio = now() - datetime.timedelta(days=1)
+        self.assertUsaIndice(Logs_AccionesUsuarios.objects.filter(timestamp__gte=inicio, timestamp__lt=now()))
+        self.assertUsaIndice(Logs_ConexionesUsuarios.objects.filter(timestamp__lt=inicio))
@@ -0,0 +1,139 @@
+"""
+Importación masiva de usuarios (UserViewSet.importar) desde CSV o JSON.
+
+Cada fila tiene username, password, first_name, last_name, email y groups (id o nombre del grupo). Las filas se
+validan todas antes de escribir nada (también con los validadores de los campos de User: longitud, caracteres del
+username, formato del email...), las contraseñas válidas se cifran en paralelo (hashing.py) y los usuarios,
+sus Database_User y sus grupos se insertan con bulk_create en la BBDD principal y en la del tenant, dentro de
+una transacción en cada una. Se devuelve el resultado de cada fila.
+"""
+import csv
+import io
+
+from django.contrib.auth.models import Group, User
+from django.core.exceptions import ValidationError
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from .hashing import hash_passwords
+from .models import Database_User
+from .provisioning import copy_rows
+
+BATCH_SIZE = 500
+
+
+def parse_rows(request):
+    """
+    Filas de la petición: un fichero CSV (campo "fichero", con cabecera) o un JSON con una lista de usuarios
+    (directamente o en "usuarios").
+    """
+    fichero = request.FILES.get('fichero')
+    if fichero is not None:
+        text = io.TextIOWrapper(fichero.file, encoding='utf-8-sig')
+        return [{key.strip(): (value or '').strip() for key, value in row.items() if key}
+                for row in csv.DictReader(text)]
+
+    data = request.data
+    if isinstance(data, dict):
+        data = data.get('usuarios', [])
+    return [row for row in data if isinstance(row, dict)] if isinstance(data, list) else []
+
+
+def import_users(rows, tenant, allow_admin):
+    """
+    Crea los usuarios de `rows` en la BBDD del tenant (TenantDatabase) y en la principal.
+    Con `allow_admin` False no se permite el grupo administrador.
+    """
+    results = [{'fila': i + 1, 'username': row.get('username')} for i, row in enumerate(rows)]
+    groups = {}
+    for group in Group.objects.all():
+        groups[str(group.pk)] = groups[group.name] = group
+
+    # ----------------------------- Validación ----------------------------- #
+    usernames = [row.get('username') for row in rows if row.get('username')]
+    existing = set(User.objects.filter(username__in=usernames).values_list('username', flat=True))
+    seen = set()
+    valid = []
+    for row, result in zip(rows, results):
+        username = row.get('username')
+        group = groups.get(str(row.get('groups') or ''))
+        if not username:
+            result['error'] = "Falta el nombre de usuario"
+        elif username in existing or username in seen:
+            result['error'] = "El usuario ya existe"
+        elif not row.get('password'):
+            result['error'] = "Falta contraseña"
+        elif group is None:
+            result['error'] = "No existe el grupo %s" % row.get('groups')
+        elif group.name == 'administrador' and not allow_admin:
+            result['error'] = "No se puede asignar el grupo administrador"
+        else:
+            user = User(username=username, first_name=row.get('first_name') or '',
+                        last_name=row.get('last_name') or '', email=row.get('email') or '')
+            problem = _field_errors(user)
+            if problem:
+                result['error'] = problem
+            else:
+                valid.append((row, result, group, user))
+        seen.add(username)
+
+    # ------------------------------ Creación ------------------------------ #
+    if valid:
+        hashes = hash_passwords(row['password'] for row, _, _, _ in valid)
+        users = []
+        for (_, _, _, user), password in zip(valid, hashes):
+            user.password = password
+            users.append(user)
+        _create(users, [group for _, _, group, _ in valid], tenant)
+        for (_, result, _, _), user in zip(valid, users):
+            result['id'] = user.pk
+
+    for result in results:
+        result['estado'] = 'error' if 'error' in result else 'creado'
+    return {
+        'creados': sum(1 for result in results if result['estado'] == 'creado'),
+        'errores': sum(1 for result in results if result['estado'] == 'error'),
+        'resultados': results,
+    }
+
+
+def _field_errors(user):
+    """
+    Errores de los validadores de los campos de User (None si no hay). La contraseña todavía no está cifrada y que
+    el username no exista ya se ha comprobado con una sola consulta para todas las filas.
+    """
+    try:
+        user.full_clean(exclude=['password'], validate_unique=False)
+    except ValidationError as e:
+        return '; '.join('%s: %s' % (field, ' '.join(messages)) for field, messages in e.message_dict.items())
+    return None
+
+
+def _create(users, groups, tenant):
+    Membership = User.groups.through
+
+    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+        User.objects.bulk_create(users, batch_size=BATCH_SIZE)
+        if any(user.pk is None for user in users):
+            # Los backends que no devuelven las claves en el INSERT múltiple (sqlite, MySQL)
+            ids = dict(User.objects.filter(username__in=[user.username for user in users])
+                       .values_list('username', 'id'))
+            for user in users:
+                user.pk = ids[user.username]
+
+        Database_User.objects.bulk_create(
+            [Database_User(user_id=user.pk, database_id=tenant.database_id) for user in users], batch_size=BATCH_SIZE)
+        Membership.objects.bulk_create(
+            [Membership(user_id=user.pk, group_id=group.pk) for user, group in zip(users, groups)],
+            batch_size=BATCH_SIZE)
+
+        # El usuario se copia con la misma clave en la BBDD del tenant, como en UserViewSet.create
+        if tenant.alias != DEFAULT_DB_ALIAS:
+            alias = tenant.alias
+            with transaction.atomic(using=alias):
+                tenant_groups = set(Group.objects.using(alias).values_list('pk', flat=True))
+                copy_rows(alias, [
+                    (User, [User(**{field.attname: getattr(user, field.attname)
+                                    for field in User._meta.concrete_fields}) for user in users]),
+                    (Membership, [Membership(user_id=user.pk, group_id=group.pk)
+                                  for user, group in zip(users, groups) if group.pk in tenant_groups]),
+                ])
@@ -10,7 +10,23 @@ Para importar en cualquier APP:
     from utilidad.logging import *
         o
     from utilidad.logging import log, red, green, yellow, blue, magenta, cyan
+
+Los mensajes se envían al módulo `logging` estándar (un logger `teleasistencia.<etiqueta>` por etiqueta):
+    - Se escriben desde un hilo propio (QueueHandler/QueueListener), así que un print lento de la terminal nunca
+      bloquea a los hilos de las peticiones o de los websockets. Si la cola se llena los mensajes se descartan.
+    - El nivel se puede ajustar por etiqueta en settings.UTILIDAD_LOGGING. Un mensaje de un nivel desactivado sólo
+      cuesta una comprobación; para no construir el texto se pueden pasar los argumentos aparte:
+          magenta("Consumer", "Notificando clientes: %s", body)
+    - Con 'JSON': True cada mensaje se escribe como una línea JSON (sin códigos ANSI).
 """
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+from datetime import datetime, timezone
 
 
 # ANSI ESCAPE CODES
@@ -63,9 +79,140 @@ def _build_tag(tag, ansi_color):
         return f"[%s]" % tag
 
 
-def log(tag, msg, ansi_color=None):
+# ============================ Configuración ============================ #
+ROOT_LOGGER = "teleasistencia"
+DEFAULT_CONFIG = {
+    'LEVEL': 'INFO',      # Nivel por defecto de todas las etiquetas
+    'TAGS': {},           # Nivel por etiqueta, p.ej. {'LoggingMiddleware': 'WARNING', 'Consumer': 'DEBUG'}
+    'JSON': False,        # Escribir líneas JSON en lugar de texto coloreado
+    'QUEUE_SIZE': 10000,  # Mensajes pendientes de escribir como máximo
+}
+
+_loggers = {}
+_listener = None
+_config_lock = threading.Lock()
+
+
+class _ColorFormatter(logging.Formatter):
+    def format(self, record):
+        text = "%s: %s" % (_build_tag(record.tag, record.ansi_color), record.getMessage())
+        if record.exc_text:
+            text += "\n" + record.exc_text
+        return text
+
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record):
+        line = {
+            "timestamp": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "tag": record.tag,
+            "msg": record.getMessage(),
+        }
+        if record.exc_text:
+            line["exc"] = record.exc_text
+        return json.dumps(line, ensure_ascii=False, default=str)
+
+
+class _DropQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler que nunca bloquea: si la cola está llena el mensaje se descarta.
     """
-    Hace print() de un mensaje con el siguiente formato:
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _DropQueueHandler.dropped += 1
+
+    def prepare(self, record):
+        # Se formatea el mensaje en el hilo que lo emite (los argumentos pueden cambiar después)
+        # y se deja la etiqueta y el color para el formateador del hilo escritor
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def configure(config=None):
+    """
+    (Re)configura el logging. Sin parámetros usa settings.UTILIDAD_LOGGING (si Django está configurado)
+    sobre DEFAULT_CONFIG.
+    """
+    global _listener
+    if config is None:
+        config = _settings_config()
+    config = dict(DEFAULT_CONFIG, **config)
+
+    with _config_lock:
+        if _listener is not None:
+            _listener.stop()
+
+        root = logging.getLogger(ROOT_LOGGER)
+        root.setLevel(config['LEVEL'])
+        root.propagate = False
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+
+        # Restablecer los niveles de las etiquetas ya usadas y aplicar los configurados
+        for logger in _loggers.values():
+            logger.setLevel(logging.NOTSET)
+        for tag, level in config['TAGS'].items():
+            _get_logger(tag).setLevel(level)
+
+        log_queue = queue.Queue(maxsize=config['QUEUE_SIZE'])
+        root.addHandler(_DropQueueHandler(log_queue))
+
+        stream_handler = logging.StreamHandler(sys.stdout)
+        stream_handler.setFormatter(_JsonFormatter() if config['JSON'] else _ColorFormatter())
+        _listener = logging.handlers.QueueListener(log_queue, stream_handler)
+        _listener.start()
+
+
+def _settings_config():
+    try:
+        from django.conf import settings
+        return getattr(settings, 'UTILIDAD_LOGGING', {}) if settings.configured else {}
+    except ImportError:
+        return {}
+
+
+def _ensure_configured():
+    if _listener is None:
+        configure()
+
+
+def flush():
+    """
+    Espera a que se escriban todos los mensajes pendientes (p. ej. al parar el servidor).
+    """
+    if _listener is not None:
+        with _config_lock:
+            _listener.stop()
+            _listener.start()
+
+
+def _get_logger(tag):
+    # logging.getLogger toma un lock global, así que se guardan los loggers de cada etiqueta
+    logger = _loggers.get(tag)
+    if logger is None:
+        logger = _loggers[tag] = logging.getLogger("%s.%s" % (ROOT_LOGGER, tag))
+    return logger
+
+
+@atexit.register
+def _stop_listener():
+    if _listener is not None:
+        _listener.stop()
+
+
+# =============================== Mensajes =============================== #
+def log(tag, msg, ansi_color=None, *args, level=logging.INFO, exc_info=None):
+    """
+    Escribe un mensaje con el siguiente formato:
         `[tag]: msg`
     La etiqueta se puede customizar con secuencias de escape ANSI.
 
@@ -74,30 +221,39 @@ def log(tag, msg, ansi_color=None):
     tag: str
         Etiqueta del LOG
     msg: str
-        Mensaje del LOG
+        Mensaje del LOG. Si se pasan `args` se formatea con `msg % args` sólo si el nivel está activo.
     ansi_color: str, optional
         Secuencia de escape ANSI de colores y efectos a aplicar al texto de la etiqueta del mensaje.
+    level: int, optional
+        Nivel del mensaje (logging.DEBUG, logging.INFO...)
     """
-    print(f"%s: %s" % (_build_tag(tag, ansi_color), msg))
+    _ensure_configured()
+    logger = _get_logger(tag)
+    if logger.isEnabledFor(level):
+        logger.log(level, msg, *args, exc_info=exc_info, extra={'tag': tag, 'ansi_color': ansi_color})
+
 
+def debug(tag, msg, *args):
+    log(tag, msg, FG_CYAN, *args, level=logging.DEBUG)
 
-def ok(msg):
-    green("OK", msg)
 
+def ok(msg, *args):
+    green("OK", msg, *args)
 
-def info(msg):
-    log("INFO", msg, None)
 
+def info(msg, *args):
+    log("INFO", msg, None, *args)
 
-def warn(msg):
-    yellow("WARN", msg)
 
+def warn(msg, *args):
+    log("WARN", msg, FG_YELLOW, *args, level=logging.WARNING)
 
-def error(msg):
-    red("ERROR", msg)
 
+def error(msg, *args, exc_info=None):
+    log("ERROR", msg, FG_RED, *args, level=logging.ERROR, exc_info=exc_info)
 
-def red(tag, msg):
+
+def red(tag, msg, *args):
     """
     Realiza un log() de un mensaje la etiqueta roja.
 
@@ -108,10 +264,10 @@ def red(tag, msg):
     msg: str
         Mensaje del LOG
     """
-    log(tag, msg, FG_RED)
+    log(tag, msg, FG_RED, *args)
 
 
-def green(tag, msg):
+def green(tag, msg, *args):
     """
     Realiza un log() de un mensaje la etiqueta verde.
 
@@ -122,10 +278,10 @@ def green(tag, msg):
     msg: str
         Mensaje del LOG
     """
-    log(tag, msg, FG_GREEN)
+    log(tag, msg, FG_GREEN, *args)
 
 
-def yellow(tag, msg):
+def yellow(tag, msg, *args):
     """
     Realiza un log() de un mensaje la etiqueta amarilla.
 
@@ -136,10 +292,10 @@ def yellow(tag, msg):
     msg: str
         Mensaje del LOG
     """
-    log(tag, msg, FG_YELLOW)
+    log(tag, msg, FG_YELLOW, *args)
 
 
-def blue(tag, msg):
+def blue(tag, msg, *args):
     """
     Realiza un log() de un mensaje la etiqueta azul.
 
@@ -150,10 +306,10 @@ def blue(tag, msg):
     msg: str
         Mensaje del LOG
     """
-    log(tag, msg, FG_BLUE)
+    log(tag, msg, FG_BLUE, *args)
 
 
-def magenta(tag, msg):
+def magenta(tag, msg, *args):
     """
     Realiza un log() de un mensaje la etiqueta magenta.
 
@@ -164,10 +320,10 @@ def magenta(tag, msg):
     msg: str
         Mensaje del LOG
     """
-    log(tag, msg, FG_MAGENTA)
+    log(tag, msg, FG_MAGENTA, *args)
 
 
-def cyan(tag, msg):
+def cyan(tag, msg, *args):
     """
     Realiza un log() de un mensaje la etiqueta cyan.
 
@@ -178,5 +334,4 @@ def cyan(tag, msg):
     msg: str
         Mensaje del LOG
     """
-    log(tag, msg, FG_CYAN)
-
+    log(tag, msg, FG_CYAN, *args)
@@ -0,0 +1,374 @@
+"""
+Métricas del servidor en formato de exposición de texto de Prometheus (endpoint /metrics).
+
+Para importar en cualquier APP:
+    from utilidad.metricas import counter, gauge, histogram
+
+    ALARMAS = counter('teleasistencia_alarmas_creadas_total', 'Alarmas creadas')
+    ALARMAS.inc()
+
+    DURACION = histogram('teleasistencia_x_segundos', 'Duración de x', ['ruta'])
+    DURACION.labels('/api-rest/alarma').observe(0.25)
+
+Los contadores e histogramas se guardan por hilo (cada hilo sólo escribe en su propio diccionario), así que
+incrementarlos no toma ningún lock. Los valores de todos los hilos se suman sólo al generar /metrics.
+Los gauges se actualizan muy poco (conexiones, tareas periódicas) y usan un lock normal.
+
+Con varios procesos (settings.METRICS_MULTIPROCESS_DIR) cada proceso vuelca periódicamente sus valores a
+`<dir>/<pid>.json` y /metrics suma los ficheros de todos los procesos.
+"""
+import json
+import os
+import threading
+import time
+
+from django.conf import settings
+
+from utilidad.logging import error
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def labels(self, *values):
+        if len(values) != len(self.labelnames):
+            raise ValueError("%s espera las etiquetas %s" % (self.name, self.labelnames))
+        return _Child(self, tuple(str(v) for v in values))
+
+    def samples(self):
+        """
+        Devuelve {etiquetas: valor} con los valores de este proceso.
+        """
+        raise NotImplementedError
+
+
+class _Child:
+    """
+    Métrica con los valores de las etiquetas ya fijados.
+    """
+    __slots__ = ('_metric', '_key')
+
+    def __init__(self, metric, key):
+        self._metric = metric
+        self._key = key
+
+    def inc(self, amount=1):
+        self._metric._inc(self._key, amount)
+
+    def dec(self, amount=1):
+        self._metric._inc(self._key, -amount)
+
+    def set(self, value):
+        self._metric._set(self._key, value)
+
+    def observe(self, value):
+        self._metric._observe(self._key, value)
+
+
+class _Sharded(_Metric):
+    """
+    Base de las métricas guardadas por hilo.
+    """
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._local = threading.local()
+        self._shards = []  # [(hilo, valores)]
+        self._retired = {}  # Valores acumulados de los hilos que ya han terminado
+        self._shards_lock = threading.Lock()
+
+    def _shard(self):
+        try:
+            return self._local.values
+        except AttributeError:
+            values = self._local.values = {}
+            # Sólo se toma el lock la primera vez que un hilo usa la métrica
+            with self._shards_lock:
+                self._retire_dead_threads()
+                self._shards.append((threading.current_thread(), values))
+            return values
+
+    def _retire_dead_threads(self):
+        # Los servidores de desarrollo crean un hilo por petición: se juntan los valores de los hilos terminados
+        # para que la lista no crezca indefinidamente
+        alive = []
+        for thread, values in self._shards:
+            if thread.is_alive():
+                alive.append((thread, values))
+            else:
+                for key, value in values.items():
+                    self._retired[key] = self._merge(self._retired.get(key), value)
+        self._shards = alive
+
+    def _merge(self, current, value):
+        raise NotImplementedError
+
+    def samples(self):
+        """
+        Suma los valores de todos los hilos. dict() copia cada diccionario de una vez (bajo el GIL)
+        aunque su hilo siga escribiendo.
+        """
+        with self._shards_lock:
+            self._retire_dead_threads()
+            shards = [dict(self._retired)] + [dict(values) for _, values in self._shards]
+        total = {}
+        for shard in shards:
+            for key, value in shard.items():
+                total[key] = self._merge(total.get(key), value)
+        return total
+
+
+class Counter(_Sharded):
+    type = 'counter'
+
+    def inc(self, amount=1):
+        self._inc((), amount)
+
+    def _inc(self, key, amount):
+        values = self._shard()
+        values[key] = values.get(key, 0) + amount
+
+    def _merge(self, current, value):
+        return value if current is None else current + value
+
+
+class Histogram(_Sharded):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value):
+        self._observe((), value)
+
+    def time(self):
+        """
+        Context manager que observa la duración (segundos) del bloque.
+        """
+        return _Timer(self)
+
+    def _observe(self, key, value):
+        values = self._shard()
+        data = values.get(key)
+        if data is None:
+            # [contador por bucket (no acumulado)..., +Inf, suma]
+            data = values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                data[i] += 1
+                break
+        else:
+            data[len(self.buckets)] += 1
+        data[-1] += value
+
+    def _merge(self, current, value):
+        return list(value) if current is None else [a + b for a, b in zip(current, value)]
+
+
+class _Timer:
+    def __init__(self, histogram, key=()):
+        self.histogram = histogram
+        self.key = key
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram._observe(self.key, time.perf_counter() - self.start)
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), multiprocess_mode='sum'):
+        """
+        multiprocess_mode: cómo se combinan los valores de varios procesos ('sum' o 'max').
+        """
+        super().__init__(name, documentation, labelnames)
+        self.multiprocess_mode = multiprocess_mode
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        self._inc((), amount)
+
+    def dec(self, amount=1):
+        self._inc((), -amount)
+
+    def set(self, value):
+        self._set((), value)
+
+    def _inc(self, key, amount):
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _set(self, key, value):
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self):
+        with self._lock:
+            return dict(self._values)
+
+
+# ============================ Registro ============================ #
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._writer = None
+
+    def register(self, cls, name, documentation, labelnames=(), **kwargs):
+        """
+        Devuelve la métrica `name`, creándola si no existe (así se puede declarar desde varios módulos).
+        """
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, labelnames, **kwargs)
+        self._ensure_writer()
+        return metric
+
+    # ------------------------- Multiproceso ------------------------- #
+    def _ensure_writer(self):
+        directory = getattr(settings, 'METRICS_MULTIPROCESS_DIR', None)
+        if not directory or self._writer is not None:
+            return
+        with self._lock:
+            if self._writer is None:
+                os.makedirs(directory, exist_ok=True)
+                self._writer = threading.Thread(target=self._write_loop, name='MetricsWriter', daemon=True)
+                self._writer.start()
+
+    def _write_loop(self):
+        interval = getattr(settings, 'METRICS_FLUSH_INTERVAL', 5)
+        while True:
+            time.sleep(interval)
+            try:
+                self.write_process_file()
+            except Exception:
+                # El hilo sigue: en la siguiente vuelta se vuelve a intentar
+                error("MetricsWriter: no se pudo volcar el fichero de métricas del proceso", exc_info=True)
+
+    def write_process_file(self):
+        """
+        Vuelca los valores de este proceso a `<METRICS_MULTIPROCESS_DIR>/<pid>.json` (escritura atómica).
+        """
+        directory = settings.METRICS_MULTIPROCESS_DIR
+        data = {name: [[list(k), v] for k, v in metric.samples().items()] for name, metric in self._metrics.items()}
+        path = os.path.join(directory, '%s.json' % os.getpid())
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+
+    def _merged_samples(self):
+        """
+        Valores de todas las métricas: de este proceso o, en modo multiproceso, combinando los de todos.
+        """
+        directory = getattr(settings, 'METRICS_MULTIPROCESS_DIR', None)
+        if not directory:
+            return {name: metric.samples() for name, metric in self._metrics.items()}
+
+        self.write_process_file()
+        merged = {name: {} for name in self._metrics}
+        for filename in os.listdir(directory):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                # Ficheros ajenos en el directorio (sin un pid por nombre) se ignoran
+                alive = _pid_alive(int(filename[:-5]))
+                with open(os.path.join(directory, filename)) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for name, samples in data.items():
+                metric = self._metrics.get(name)
+                if metric is None:
+                    continue
+                # Los gauges de procesos que ya no existen no se cuentan (conexiones abiertas, etc.)
+                if metric.type == 'gauge' and not alive:
+                    continue
+                target = merged[name]
+                for key, value in samples:
+                    key = tuple(key)
+                    if key not in target:
+                        target[key] = value
+                    elif metric.type == 'histogram':
+                        target[key] = [a + b for a, b in zip(target[key], value)]
+                    elif metric.type == 'gauge' and metric.multiprocess_mode == 'max':
+                        target[key] = max(target[key], value)
+                    else:
+                        target[key] += value
+        return merged
+
+    # -------------------------- Exposición -------------------------- #
+    def exposition(self):
+        """
+        Genera el texto de /metrics.
+        """
+        lines = []
+        for name, samples in sorted(self._merged_samples().items()):
+            metric = self._metrics[name]
+            lines.append('# HELP %s %s' % (name, metric.documentation))
+            lines.append('# TYPE %s %s' % (name, metric.type))
+            for key, value in sorted(samples.items()):
+                labels = list(zip(metric.labelnames, key))
+                if metric.type == 'histogram':
+                    accumulated = 0
+                    for bound, count in zip(metric.buckets + (float('inf'),), value[:-1]):
+                        accumulated += count
+                        le = '+Inf' if bound == float('inf') else repr(float(bound))
+                        lines.append('%s_bucket%s %s' % (name, _format_labels(labels + [('le', le)]), accumulated))
+                    lines.append('%s_sum%s %s' % (name, _format_labels(labels), value[-1]))
+                    lines.append('%s_count%s %s' % (name, _format_labels(labels), accumulated))
+                else:
+                    lines.append('%s%s %s' % (name, _format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"'))
+        for k, v in labels
+    )
+    return '{%s}' % ','.join(escaped)
+
+
+def _pid_alive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+registry = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return registry.register(Counter, name, documentation, labelnames)
+
+
+def gauge(name, documentation, labelnames=(), multiprocess_mode='sum'):
+    return registry.register(Gauge, name, documentation, labelnames, multiprocess_mode=multiprocess_mode)
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return registry.register(Histogram, name, documentation, labelnames, buckets=buckets)